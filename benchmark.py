@@ -0,0 +1,206 @@
+#!/usr/bin/env python2
+import os, sys
+import argparse
+import json
+import shutil
+import tempfile
+import time
+from subprocess import call
+from sgftools import layout
+
+#Runs full sgfanalyze.py analyses against fakeleela.py and reports how fast
+#positions go through the pipeline, and where the time goes. Since the fake
+#engine's search time is fixed and known, whatever isn't spent inside the
+#engine is overhead on the python side.
+#
+#Every command the engines handle is logged with the time it was read and the
+#time it was answered, from which the time is split into phases:
+#
+#  startup  process launch until the first command is read
+#  setup    boardsize, komi, time_settings, time_left, protocol_version
+#  sync     play, undo and clear_board to move the board to the next position
+#  search   genmove, or lz-analyze with --backend lz-analyze
+#  driver   time an engine spent waiting for its next command
+#
+#Phases are summed over engines, so with several engines they add up to more than the wall time.
+#
+#With --layouts it instead compares ways of splitting the cores between
+#engines, from one engine using every core up to one single threaded engine
+#per core, and reports which gets through the most positions per hour. Give
+#it the real engine with --leela and a --visits budget for this, since the
+#fake engine doesn't use any cpu to search.
+
+PHASES = ['startup', 'setup', 'sync', 'search', 'driver']
+
+#Commands that search a position, one per position analyzed
+SEARCH_COMMANDS = ('genmove', 'lz-analyze', 'lz-genmove_analyze')
+
+def command_phase(cmd):
+    if cmd in ('play', 'undo', 'clear_board'):
+        return 'sync'
+    if cmd in SEARCH_COMMANDS:
+        return 'search'
+    return 'setup'
+
+#Returns phase totals and the number of positions searched
+def summarize_log(log_fn):
+    processes = {}
+    with open(log_fn) as log_file:
+        for line in log_file:
+            parts = line.split(None, 3)
+            if len(parts) < 4:
+                continue
+            words = parts[3].split()
+            #Commands may be logged with their GTP id in front
+            if len(words) > 1 and words[0].isdigit():
+                words.pop(0)
+            (pid, started, finished, cmd) = (parts[0], float(parts[1]), float(parts[2]), words[0])
+            processes.setdefault(pid, []).append((started, finished, cmd))
+
+    totals = dict((phase, 0.0) for phase in PHASES)
+    positions = 0
+    for events in processes.values():
+        events.sort()
+        prev_finished = None
+        for (started, finished, cmd) in events:
+            if cmd == 'launch':
+                prev_finished = None
+                launched = started
+                continue
+            if prev_finished is None:
+                totals['startup'] += started - launched
+            else:
+                totals['driver'] += started - prev_finished
+            prev_finished = finished
+            if cmd in ('exit', 'quit'):
+                continue
+            totals[command_phase(cmd)] += finished - started
+            if cmd in SEARCH_COMMANDS:
+                positions += 1
+    return (totals, positions)
+
+def run_once(args, analyze_args, log_fn, cache_dir):
+    env = dict(os.environ)
+    env['FAKELEELA_LATENCY'] = str(args.latency)
+    env['FAKELEELA_STARTUP'] = str(args.startup)
+    env['FAKELEELA_MOVES'] = str(args.moves)
+    env['FAKELEELA_UPDATES'] = str(args.updates)
+    env['FAKELEELA_NOISE'] = str(args.noise)
+    env['FAKELEELA_LOG'] = log_fn
+
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    executable = args.leela if args.leela is not None else os.path.join(script_dir, 'fakeleela.py')
+    cmd = [sys.executable, os.path.join(script_dir, 'sgfanalyze.py'), args.SGF_FILE,
+           '--leela', executable,
+           '--cache', cache_dir] + analyze_args
+
+    with open(os.devnull, 'w') as devnull:
+        start_time = time.time()
+        result = call(cmd, env=env, stdout=devnull, stderr=(None if args.verbose else devnull))
+        wall_time = time.time() - start_time
+    if result != 0:
+        raise Exception("sgfanalyze.py failed with exit code %d" % (result))
+    return wall_time
+
+def report(name, wall_time, totals, positions):
+    rate = positions / wall_time if wall_time > 0 else 0
+    print "%s: %d positions in %.2fs, %.2f positions/sec" % (name, positions, wall_time, rate)
+    if totals is None:
+        return
+    for phase in PHASES:
+        per_position = 1000.0 * totals[phase] / positions if positions > 0 else 0
+        print "  %-8s %8.2fs  %8.1fms/position" % (phase, totals[phase], per_position)
+    overhead = totals['driver'] + totals['setup'] + totals['sync']
+    if positions > 0:
+        print "  overhead outside search and startup: %.1fms/position" % (1000.0 * overhead / positions)
+
+#Number of positions searched in an sgfanalyze.py --timeline trace
+def count_positions(trace_fn):
+    with open(trace_fn) as trace_file:
+        trace = json.load(trace_file)
+    return len([event for event in trace['traceEvents'] if event['name'] == 'analyze'])
+
+def calibrate_layouts(args, analyze_args, work_dir):
+    cores = args.cores if args.cores is not None else layout.cpu_count()
+    rates = []
+    for engines in layout.candidate_engine_counts(cores):
+        placements = layout.plan(cores, engines, args.pin_cpus)
+        layout_args = ['--engines', str(engines), '--threads', 'auto', '--cores', str(cores)]
+        if args.pin_cpus:
+            layout_args.append('--pin-cpus')
+        positions = 0
+        wall_time = 0.0
+        for run in range(args.runs):
+            name = 'layout_%d_%d' % (engines, run)
+            trace_fn = os.path.join(work_dir, name + '.json')
+            wall_time += run_once(args, analyze_args + layout_args + ['--timeline', trace_fn],
+                                  os.path.join(work_dir, name + '.log'), os.path.join(work_dir, name))
+            positions += count_positions(trace_fn)
+        rate = 3600.0 * positions / wall_time if wall_time > 0 else 0
+        print "%-36s %6d positions in %7.2fs, %9.0f positions/hour" % (layout.describe(placements), positions, wall_time, rate)
+        rates.append((rate, engines, placements))
+    (rate, engines, placements) = max(rates)
+    print "Best layout on this host: %s, %.0f positions/hour" % (layout.describe(placements), rate)
+    print "  sgfanalyze.py --engines %d --threads auto%s%s" % (
+        engines, "" if args.cores is None else " --cores %d" % (cores), " --pin-cpus" if args.pin_cpus else "")
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmark sgfanalyze.py against the fake leela engine. Any options not listed here are passed on to sgfanalyze.py.")
+    parser.add_argument("SGF_FILE", help="SGF file to analyze")
+    parser.add_argument('--runs', default=3, type=int, metavar="N",
+                        help="Number of analyses to run, each with an empty cache (default=3)")
+    parser.add_argument('--latency', default=0.05, type=float, metavar="S",
+                        help="Seconds the fake engine searches each position for (default=0.05)")
+    parser.add_argument('--startup', default=0.2, type=float, metavar="S",
+                        help="Seconds the fake engine takes to start (default=0.2)")
+    parser.add_argument('--moves', default=5, type=int, metavar="N",
+                        help="Candidate moves the fake engine reports per position (default=5)")
+    parser.add_argument('--updates', default=1, type=int, metavar="N",
+                        help="Progress lines the fake engine prints while searching (default=1)")
+    parser.add_argument('--noise', default=0, type=int, metavar="N",
+                        help="Extra unparsed lines the fake engine prints per position (default=0)")
+    parser.add_argument('--verbose', action='store_true',
+                        help="Show the output of sgfanalyze.py")
+    parser.add_argument('--leela', default=None, metavar="CMD",
+                        help="Run this engine instead of the fake one, in which case the time spent per phase isn't reported")
+    parser.add_argument('--layouts', action='store_true',
+                        help="Compare splitting the cores between different numbers of engines, and report the fastest")
+    parser.add_argument('--cores', default=None, type=int, metavar="N",
+                        help="Cores to split between engines with --layouts (default: all of this machine's, %d)" % (layout.cpu_count()))
+    parser.add_argument('--pin-cpus', dest='pin_cpus', action='store_true',
+                        help="Pin each engine to its own block of cpus with --layouts")
+
+    (args, analyze_args) = parser.parse_known_args()
+    if not os.path.exists(args.SGF_FILE):
+        parser.error("No such file: %s" % (args.SGF_FILE))
+
+    work_dir = tempfile.mkdtemp(prefix='leela_benchmark_')
+    try:
+        if args.layouts:
+            calibrate_layouts(args, analyze_args, work_dir)
+            sys.exit(0)
+        all_totals = dict((phase, 0.0) for phase in PHASES)
+        all_positions = 0
+        all_wall_time = 0.0
+        for run in range(args.runs):
+            log_fn = os.path.join(work_dir, 'engine_%d.log' % (run))
+            cache_dir = os.path.join(work_dir, 'cache_%d' % (run))
+            if args.leela is None:
+                wall_time = run_once(args, analyze_args, log_fn, cache_dir)
+                (totals, positions) = summarize_log(log_fn)
+                for phase in PHASES:
+                    all_totals[phase] += totals[phase]
+            else:
+                # Only the fake engine logs its commands, so count positions from the timeline instead
+                trace_fn = os.path.join(work_dir, 'trace_%d.json' % (run))
+                wall_time = run_once(args, analyze_args + ['--timeline', trace_fn], log_fn, cache_dir)
+                (totals, positions) = (None, count_positions(trace_fn))
+                all_totals = None
+            report("Run %d" % (run + 1), wall_time, totals, positions)
+            all_positions += positions
+            all_wall_time += wall_time
+        if args.runs > 1:
+            report("Total", all_wall_time, all_totals, all_positions)
+    finally:
+        shutil.rmtree(work_dir)
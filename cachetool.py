@@ -0,0 +1,37 @@
+#!/usr/bin/env python2
+import os, sys
+import argparse
+from sgftools import cache, cachemaint
+
+STEPS = ['merge', 'prune', 'evict', 'compact']
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description="Keep an sgfanalyze.py cache directory within a size budget. Safe to run while analyses are using the cache.")
+    parser.add_argument('--cache', dest='ckpt_dir', metavar="DIR",
+                        default=os.path.expanduser('~/.leela_checkpoints'),
+                        help="Cache directory to maintain, default ~/.leela_checkpoints")
+    parser.add_argument('--cache-format', dest='cache_format', default='sqlite', choices=sorted(cache.FORMATS.keys()),
+                        help="Format sgfanalyze.py stores the cache in (default=sqlite). With sqlite, entries still in per-game checkpoint files are moved into the database")
+    parser.add_argument('--max-size', dest='max_size_mb', default=None, type=float, metavar="MB",
+                        help="Delete entries until the cached analyses take up at most this many megabytes")
+    parser.add_argument('--policy', default='lru', choices=cachemaint.POLICIES,
+                        help="Which entries to delete first to get within --max-size: 'lru' those used longest ago (default), 'value' those made with the fewest visits")
+    parser.add_argument('--skip', action='append', default=[], choices=STEPS,
+                        help="Leave out a step: merge checkpoint files into the database, prune entries superseded by stronger searches, evict entries to get within --max-size, compact the database file. May be given more than once")
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true',
+                        help="Report what would be done without changing anything")
+    parser.add_argument('-v','--verbosity', default=0, type=int, metavar="V",
+                        help="Set the verbosity level")
+
+    args = parser.parse_args()
+    if not os.path.isdir(args.ckpt_dir):
+        parser.error("No such cache directory: %s" % (args.ckpt_dir))
+    if args.dry_run and args.cache_format == 'sqlite' and not os.path.exists(os.path.join(args.ckpt_dir, cache.DB_FILENAME)):
+        parser.error("%s has no cache database yet, run without --dry-run to create it" % (args.ckpt_dir))
+
+    steps = [step for step in STEPS if step not in args.skip]
+    max_bytes = None if args.max_size_mb is None else int(args.max_size_mb * 1048576)
+    report = cachemaint.maintain(args.ckpt_dir, args.cache_format, max_bytes, args.policy, steps, args.dry_run, args.verbosity)
+    if args.dry_run:
+        print "Dry run, nothing was changed"
+    report.print_summary()
@@ -0,0 +1,366 @@
+#!/usr/bin/env python2
+import os, sys
+import time
+import random
+import hashlib
+import select
+import json
+
+#A stand-in for the Leela GTP engine, for exercising and benchmarking the
+#analysis scripts without a real engine or minutes of search per position.
+#It speaks the subset of GTP that leela.CLI uses and answers genmove with
+#made up, but deterministic, analysis output in Leela's formats, and also
+#Leela Zero's lz-analyze as used by leelazero.ZeroCLI. The same position
+#always gets the same analysis.
+#
+#It is configured through environment variables:
+#
+#  FAKELEELA_LATENCY   seconds each genmove "searches" for (default 0.05)
+#  FAKELEELA_STARTUP   seconds to "load" before reading commands (default 0.2)
+#  FAKELEELA_MOVES     candidate moves reported per genmove (default 5)
+#  FAKELEELA_UPDATES   progress lines printed while searching (default 1)
+#  FAKELEELA_NOISE     extra unparsed stderr lines per genmove, like leela's board dump (default 0)
+#  FAKELEELA_CRASH_EVERY  exit without a reply on every Nth genmove (default never)
+#  FAKELEELA_HANG_EVERY   stop answering on every Nth genmove, or Nth position with --analysis (default never)
+#  FAKELEELA_LOG       append a line per command to this file, see benchmark.py
+#  FAKELEELA_STOP_ON_INPUT  0 to keep a genmove searching when more input arrives (default 1)
+#
+#--visits N and --playouts N limit the reported visits and playouts like they limit leela's search.
+#With --analysis it instead answers batch JSON analysis queries, like KataGo's analysis engine.
+
+LATENCY = float(os.environ.get('FAKELEELA_LATENCY', '0.05'))
+STARTUP = float(os.environ.get('FAKELEELA_STARTUP', '0.2'))
+NUM_MOVES = int(os.environ.get('FAKELEELA_MOVES', '5'))
+NUM_UPDATES = int(os.environ.get('FAKELEELA_UPDATES', '1'))
+NOISE = int(os.environ.get('FAKELEELA_NOISE', '0'))
+CRASH_EVERY = int(os.environ.get('FAKELEELA_CRASH_EVERY', '0'))
+HANG_EVERY = int(os.environ.get('FAKELEELA_HANG_EVERY', '0'))
+LOG = os.environ.get('FAKELEELA_LOG')
+STOP_ON_INPUT = os.environ.get('FAKELEELA_STOP_ON_INPUT', '1') != '0'
+
+COLUMNS = 'ABCDEFGHJKLMNOPQRSTUVWXYZ'
+
+#Unbuffered reading of stdin, so that we can tell whether another command is waiting
+class LineReader(object):
+    def __init__(self, fd):
+        self.fd = fd
+        self.buffer = ''
+        self.eof = False
+
+    # Whether a line becomes available within timeout seconds
+    def wait(self, timeout):
+        deadline = None if timeout is None else time.time() + timeout
+        while '\n' not in self.buffer and not self.eof:
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                return False
+            (ready, _, _) = select.select([self.fd], [], [], remaining)
+            if len(ready) > 0:
+                self.fill()
+        return True
+
+    def fill(self):
+        data = os.read(self.fd, 4096)
+        if data == '':
+            self.eof = True
+        self.buffer += data
+
+    # Returns the next line, or '' at eof
+    def readline(self):
+        while '\n' not in self.buffer and not self.eof:
+            self.fill()
+        if '\n' not in self.buffer:
+            (line, self.buffer) = (self.buffer, '')
+            return line
+        (line, self.buffer) = self.buffer.split('\n', 1)
+        return line + '\n'
+
+class FakeLeela(object):
+    def __init__(self, visits_limit, playouts_limit):
+        self.visits_limit = visits_limit
+        self.playouts_limit = playouts_limit
+        self.size = 19
+        self.board = []
+        self.genmove_count = 0
+        #Position and candidate visits of the last search, whose subtree the next search may reuse
+        self.last_root = None
+        self.last_visits = {}
+        #The GTP id of the command being answered, if it had one
+        self.command_id = ''
+        self.input = LineReader(sys.stdin.fileno())
+        self.log_file = None
+        if LOG is not None:
+            self.log_file = open(LOG, 'a')
+
+    def log(self, started, cmd):
+        if self.log_file is not None:
+            #One write per line, so that several engines can share a log file
+            self.log_file.write("%d %.6f %.6f %s\n" % (os.getpid(), started, time.time(), cmd))
+            self.log_file.flush()
+
+    def respond(self, s=''):
+        sys.stdout.write('=%s %s\n\n' % (self.command_id, s))
+        sys.stdout.flush()
+
+    def fail(self, s):
+        sys.stdout.write('?%s %s\n\n' % (self.command_id, s))
+        sys.stdout.flush()
+
+    def empty_points(self):
+        occupied = set(m for (c, m) in self.board)
+        points = ['%s%d' % (COLUMNS[x], y+1) for x in range(self.size) for y in range(self.size)]
+        return [p for p in points if p not in occupied]
+
+    def limit(self, v):
+        if self.visits_limit is not None:
+            v = min(v, self.visits_limit)
+        if self.playouts_limit is not None:
+            v = min(v, self.playouts_limit)
+        return v
+
+    # The made up analysis of the current position: candidate moves as
+    # (move, visits, winrate, policy, pv), best first, and the total visits
+    def analysis(self, color):
+        rng = random.Random(hashlib.md5(str(self.size) + repr(self.board) + color).hexdigest())
+        points = self.empty_points()
+        rng.shuffle(points)
+        moves = points[:NUM_MOVES]
+
+        total = 0
+        candidates = []
+        for (i, m) in enumerate(moves):
+            v = self.limit(rng.randint(10, 1000) if i else 2000)
+            total += v
+            w = rng.uniform(30, 70)
+            pv = ' '.join([m] + points[NUM_MOVES:NUM_MOVES+rng.randint(1,6)])
+            candidates.append((m, v, w, rng.uniform(0, 50), pv))
+        return (candidates, total)
+
+    def genmove(self, color):
+        self.genmove_count += 1
+        if CRASH_EVERY and self.genmove_count % CRASH_EVERY == 0:
+            os._exit(1)
+        if HANG_EVERY and self.genmove_count % HANG_EVERY == 0:
+            time.sleep(3600)
+
+        (candidates, total) = self.analysis(color)
+        (best_move, best_visits, best_winrate, best_policy, best_pv) = candidates[0]
+        #Like leela zero, keep the subtree of the move played since the last search
+        reused = 0
+        if self.last_root is not None and self.board[:-1] == self.last_root:
+            reused = min(total, self.last_visits.get(self.board[-1][1], 0))
+        self.last_root = list(self.board)
+        self.last_visits = dict((m, v) for (m, v, w, n, pv) in candidates)
+
+        err = sys.stderr
+        for i in range(NUM_UPDATES):
+            # Like leela, stop searching as soon as more input arrives
+            if not STOP_ON_INPUT:
+                time.sleep(LATENCY / NUM_UPDATES)
+            elif self.input.wait(LATENCY / NUM_UPDATES):
+                break
+            err.write('Nodes: %d, Win: %5.2f%% (MC:50.00%%/VN:50.00%%), PV: %s\n' % (total * (i+1) / NUM_UPDATES, best_winrate, best_pv))
+            err.flush()
+        if NUM_UPDATES == 0:
+            time.sleep(LATENCY)
+        err.write('MC winrate=%.4f, NN eval=%.4f, score=B+%.1f\n' % (best_winrate/100, best_winrate/100, 3.5))
+        for (m, v, w, n, pv) in candidates:
+            err.write('%4s -> %7d (W: %5.2f%%) (U: %5.2f%%) (V: %5.2f%%: %6d) (N: %4.1f%%) PV: %s\n' % (m, v, w, w-1, w+1, v, n, pv))
+        err.write('====================================\n')
+        err.write('%d visits, score %5.2f%% (from %5.2f%%) PV: %s\n' % (best_visits, best_winrate, best_winrate-1, best_pv))
+        err.write('\n%d visits, %d nodes, %d playouts, %d p/s\n\n' % (total, total, total - reused, 1000))
+        for i in range(NOISE):
+            err.write(' %2d . . . . . . . . . . . . . . . . . . . %2d\n' % (i % self.size + 1, i % self.size + 1))
+        err.flush()
+
+        self.board.append((color, best_move))
+        self.respond(best_move)
+
+    # Leela Zero's continuous analysis: an info line every interval centiseconds, in which visits
+    # grow until FAKELEELA_LATENCY has passed, until the next command arrives
+    def lz_analyze(self, args):
+        color = 'black' if len(self.board) == 0 or self.board[-1][0] == 'white' else 'white'
+        if len(args) > 0 and args[0].lower() in ('b', 'w', 'black', 'white'):
+            color = 'black' if args.pop(0).lower().startswith('b') else 'white'
+        interval = int(args[0]) / 100.0 if len(args) > 0 else 1.0
+
+        self.genmove_count += 1
+        if CRASH_EVERY and self.genmove_count % CRASH_EVERY == 0:
+            os._exit(1)
+        (candidates, total) = self.analysis(color)
+        sys.stdout.write('=%s\n' % (self.command_id))
+        sys.stdout.flush()
+        started = time.time()
+        while True:
+            if HANG_EVERY and self.genmove_count % HANG_EVERY == 0:
+                time.sleep(3600)
+            if self.input.wait(interval):
+                break
+            done = min(1.0, (time.time() - started) / LATENCY) if LATENCY > 0 else 1.0
+            infos = []
+            for (order, (m, v, w, n, pv)) in enumerate(candidates):
+                infos.append('info move %s visits %d winrate %d prior %d lcb %d order %d pv %s' % (
+                    m, int(v * done), to_hundredths(w, 2), to_hundredths(n, 1), to_hundredths(w, 2) - 50, order, pv))
+            sys.stdout.write(' '.join(infos) + '\n')
+            sys.stdout.flush()
+        sys.stdout.write('\n')
+        sys.stdout.flush()
+
+    def showboard(self):
+        sys.stderr.write(repr(self.board) + '\n')
+        sys.stderr.flush()
+        self.respond()
+
+    def run(self):
+        while True:
+            line = self.input.readline()
+            if not line:
+                break
+            parts = line.split()
+            if not parts:
+                continue
+            started = time.time()
+            self.command_id = ''
+            if parts[0].isdigit():
+                self.command_id = parts.pop(0)
+                if not parts:
+                    continue
+            cmd = parts[0]
+            if cmd in ('exit', 'quit'):
+                self.respond()
+                self.log(started, ' '.join(parts))
+                break
+            elif cmd == 'boardsize':
+                self.size = int(parts[1])
+                self.board = []
+                self.last_root = None
+                self.respond()
+            elif cmd == 'clear_board':
+                self.board = []
+                self.last_root = None
+                self.respond()
+            elif cmd in ('komi', 'time_settings', 'time_left', 'name'):
+                self.respond()
+            elif cmd == 'protocol_version':
+                self.respond('2')
+            elif cmd == 'play':
+                self.board.append((parts[1], parts[2].upper()))
+                self.respond()
+            elif cmd == 'undo':
+                if len(self.board) > 0:
+                    self.board.pop()
+                    self.respond()
+                else:
+                    self.fail('cannot undo')
+            elif cmd == 'genmove':
+                self.genmove(parts[1])
+            elif cmd == 'lz-analyze':
+                self.lz_analyze(parts[1:])
+            elif cmd == 'showboard':
+                self.showboard()
+            else:
+                self.fail('unknown command')
+            self.log(started, ' '.join(parts))
+
+# Percentage w in Leela Zero's hundredths of a percent, rounded like leela's output prints it
+def to_hundredths(w, decimals):
+    return int(round(float('%.*f' % (decimals, w)) * 100))
+
+#Stand-in for a batch JSON analysis engine, run with --analysis. Queries that
+#arrive within FAKELEELA_LATENCY of the first one waiting are answered together,
+#in reverse order, as one neural net batch would be, and so are the turns of a
+#query.
+class FakeAnalysisEngine(object):
+    def __init__(self):
+        self.input = LineReader(sys.stdin.fileno())
+        self.answered = 0
+
+    # The responses to a query, one per turn it asks for
+    def answers(self, query):
+        if 'moves' not in query:
+            return [{'id': query.get('id'), 'error': 'Missing field moves'}]
+        turns = query.get('analyzeTurns', [len(query['moves'])])
+        if any(turn < 0 or turn > len(query['moves']) for turn in turns):
+            return [{'id': query['id'], 'error': 'Invalid value for field analyzeTurns'}]
+        return [self.answer(query, turn) for turn in reversed(turns)]
+
+    def answer(self, query, turn):
+        self.answered += 1
+        if HANG_EVERY > 0 and self.answered % HANG_EVERY == 0:
+            while True:
+                time.sleep(1)
+        engine = FakeLeela(query.get('maxVisits'), None)
+        engine.size = query.get('boardXSize', 19)
+        engine.board = [('black' if color == 'B' else 'white', str(move).upper())
+                        for (color, move) in query.get('initialStones', []) + query['moves'][:turn]]
+        if turn > 0:
+            color = 'black' if engine.board[-1][0] == 'white' else 'white'
+        else:
+            color = 'white' if query.get('initialPlayer') == 'W' else 'black'
+        (candidates, total) = engine.analysis(color)
+
+        move_infos = []
+        for (order, (m, v, w, n, pv)) in enumerate(candidates):
+            #Rounded like leela prints them, and from black's point of view
+            winrate = 0.01 * float('%5.2f' % w)
+            move_infos.append({
+                'move': m,
+                'visits': v,
+                'winrate': winrate if color == 'black' else 1.0 - winrate,
+                'prior': 0.01 * float('%4.1f' % n),
+                'order': order,
+                'pv': pv.split(),
+            })
+        return {'id': query['id'], 'turnNumber': turn, 'isDuringSearch': False,
+                'moveInfos': move_infos, 'rootInfo': {'visits': total + 1, 'currentPlayer': color[0].upper()}}
+
+    def run(self):
+        batch = []
+        batch_started = None
+        while True:
+            timeout = None
+            if len(batch) > 0:
+                timeout = max(0.0, batch_started + LATENCY - time.time())
+            if self.input.wait(timeout):
+                line = self.input.readline()
+                if line == '':
+                    break
+                if line.strip() == '':
+                    continue
+                try:
+                    query = json.loads(line)
+                except ValueError:
+                    self.reply({'error': 'Could not parse json'})
+                    continue
+                if len(batch) == 0:
+                    batch_started = time.time()
+                batch.append(query)
+                continue
+            for query in reversed(batch):
+                for response in self.answers(query):
+                    self.reply(response)
+            batch = []
+        for query in reversed(batch):
+            for response in self.answers(query):
+                self.reply(response)
+
+    def reply(self, response):
+        sys.stdout.write(json.dumps(response) + '\n')
+        sys.stdout.flush()
+
+def arg_value(argv, name):
+    if name in argv and argv.index(name) + 1 < len(argv):
+        return int(argv[argv.index(name) + 1])
+    return None
+
+if __name__=='__main__':
+    if '--analysis' in sys.argv:
+        time.sleep(STARTUP)
+        FakeAnalysisEngine().run()
+        sys.exit(0)
+    engine = FakeLeela(arg_value(sys.argv, '--visits'), arg_value(sys.argv, '--playouts'))
+    engine.log(time.time(), 'launch')
+    time.sleep(STARTUP)
+    sys.stderr.write('Leela fake\n')
+    sys.stderr.flush()
+    engine.run()
@@ -0,0 +1,36 @@
+#!/usr/bin/env python2
+import os, sys
+import argparse
+import signal
+from sgftools import daemon, layout
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description="Keep Leela engines running and serve analyses to sgfanalyze.py --daemon")
+    required = parser.add_argument_group('required named arguments')
+    required.add_argument('--leela', dest='executable', required=True, metavar="CMD",
+                        help="Command to run Leela executable")
+    parser.add_argument('--socket', default=daemon.DEFAULT_SOCKET, metavar="PATH",
+                        help="Unix socket to listen on, default %s" % (daemon.DEFAULT_SOCKET))
+    parser.add_argument('--engines', default=1, type=int, metavar="N",
+                        help="How many Leela processes to keep running (default=1)")
+    parser.add_argument('--threads', default=None, metavar="N|auto",
+                        help="Search threads for each Leela process, 'auto' splits the cores evenly between them (default: Leela's own default)")
+    parser.add_argument('--cores', default=None, type=int, metavar="N",
+                        help="Cores to split between the Leela processes for --threads auto and --pin-cpus (default: all of this machine's, %d)" % (layout.cpu_count()))
+    parser.add_argument('--pin-cpus', dest='pin_cpus', action='store_true',
+                        help="Run each Leela process on its own block of cpus, using taskset")
+    parser.add_argument('-v','--verbosity', default=0, type=int, metavar="V",
+                        help="Set the verbosity level, 0: errors only, 1: engine activity, 2+: leela state")
+
+    args = parser.parse_args()
+    try:
+        placements = layout.placements_from_args(args.threads, args.cores, args.engines, args.pin_cpus)
+    except ValueError as e:
+        parser.error(str(e))
+    server = daemon.AnalysisDaemon(args.executable, args.socket, args.engines, args.verbosity, placements)
+    # Shut the engines down cleanly when killed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,255 @@
+#!/usr/bin/env python2
+import os, sys
+import argparse
+import functools
+import itertools
+import traceback
+from sgftools import gotools, leela, leelazero, progressbar, enginepool, supervisor, layout, cache
+import sgfanalyze
+
+#Analyzes the positions that come up most often in a collection of games
+#ahead of time, into the same cache sgfanalyze.py uses, so analyses of new
+#games find their openings already done.
+#
+#The main line of every game goes into a trie keyed by the moves of each
+#node, counting the games that pass through each node. Nodes some games
+#share are then looked up by position, which merges move orders and
+#orientations that reach the same position, and the positions reached in
+#the most games are analyzed, the most common first. Games with different
+#board sizes, komi or handicap never share positions, so each combination
+#gets a trie and engines of its own.
+
+class TrieNode(object):
+    __slots__ = ['children', 'games']
+
+    def __init__(self):
+        self.children = {}
+        self.games = 0
+
+# What it takes to set an engine up for a game: board size, komi and whether it has handicap stones
+def game_settings(root):
+    board_size = 19
+    if 'SZ' in root.keys():
+        board_size = int(root['SZ'].data[0])
+    (komi, is_handicap_game, notes) = sgfanalyze.komi_and_handicap(root)
+    return (board_size, komi, is_handicap_game)
+
+def find_sgf_files(paths):
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for (dirpath, dirnames, filenames) in os.walk(path):
+            dirnames.sort()
+            for name in sorted(filenames):
+                if name.lower().endswith('.sgf'):
+                    yield os.path.join(dirpath, name)
+
+# Add the first depth moves of each game's main line to a trie per game settings
+def build_tries(sgf_files, depth, make_engine, verbosity):
+    tries = {}
+    games = 0
+    for sgf_fn in sgf_files:
+        try:
+            sgf = gotools.import_sgf(sgf_fn)
+            C = sgf.cursor()
+            settings = game_settings(C.node)
+            #A stand in engine to collect the commands for each node, which are what analyses are keyed by
+            engine = make_engine(settings)
+            sgfanalyze.add_moves_to_leela(C, engine)
+            steps = [tuple(engine.history)]
+            while not C.atEnd and len(steps) <= depth:
+                C.next()
+                before = len(engine.history)
+                sgfanalyze.add_moves_to_leela(C, engine)
+                steps.append(tuple(engine.history[before:]))
+        except Exception as e:
+            print >>sys.stderr, "Skipping %s, it could not be read: %s" % (sgf_fn, str(e) or e.__class__.__name__)
+            continue
+        node = tries.setdefault(settings, TrieNode())
+        for step in steps:
+            node = node.children.setdefault(step, TrieNode())
+            node.games += 1
+        games += 1
+        if verbosity > 1:
+            print >>sys.stderr, "Read %d moves of %s" % (len(steps) - 1, sgf_fn)
+    return (tries, games)
+
+# The history and game count of every trie node past the root's own stones played in at least min_games games
+def shared_nodes(trie, min_games):
+    found = []
+    stack = [(child, list(step), 0) for (step, child) in trie.children.items()]
+    while len(stack) > 0:
+        (node, history, moves) = stack.pop()
+        if node.games < min_games:
+            continue
+        if moves > 0:
+            found.append((history, node.games))
+        for (step, child) in node.children.items():
+            stack.append((child, history + list(step), moves + 1))
+    return found
+
+# The positions of a trie reached in at least min_games games, as (games, moves played, history),
+# with the ones reached by different move orders or in different orientations counted together
+def common_positions(trie, engine, min_games):
+    #A position may add up to min_games over several nodes, each of which at least two games share
+    positions = {}
+    for (history, games) in shared_nodes(trie, min(2, min_games)):
+        engine.history = history
+        (position_hash, symmetry) = engine.canonical_position()
+        if position_hash in positions:
+            positions[position_hash][0] += games
+        else:
+            positions[position_hash] = [games, len(history), history]
+    return [tuple(p) for p in positions.values() if p[0] >= min_games]
+
+default_depth = 30
+default_min_games = 10
+default_max_positions = 1000
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description="Analyze the positions most common in a collection of SGF files into sgfanalyze.py's cache ahead of time. "
+                                                 "Give it the same search options as the analyses it is for, or a larger budget of the same kind")
+    parser.add_argument('--depth', default=default_depth, type=int, metavar="MOVES",
+                        help="Only consider positions in the first this many moves of each game (default=%d)" % (default_depth))
+    parser.add_argument('--min-games', dest='min_games', default=default_min_games, type=int, metavar="N",
+                        help="Only analyze positions reached in at least this many games (default=%d)" % (default_min_games))
+    parser.add_argument('--positions', dest='max_positions', default=default_max_positions, type=int, metavar="N",
+                        help="Analyze at most this many positions, the most common ones (default=%d)" % (default_max_positions))
+    parser.add_argument('--list', dest='list_only', action='store_true',
+                        help="Print the positions that would be analyzed, with how many games reach each, and don't analyze them")
+    parser.add_argument('--secs-per-search', dest='seconds_per_search', default=None, type=float, metavar="S",
+                        help="How many seconds to use per search (default=%d, or %d as a cap when --visits or --playouts is given)" % (
+                            sgfanalyze.default_secs_per_search, sgfanalyze.default_work_budget_secs))
+    parser.add_argument('--visits', default=None, type=int, metavar="N",
+                        help="Stop each search after this many visits instead of after a fixed time, requires a Leela version with --visits")
+    parser.add_argument('--playouts', default=None, type=int, metavar="N",
+                        help="Stop each search after this many playouts instead of after a fixed time, using Leela's --playouts limit")
+    parser.add_argument('--early-stop', dest='early_stop_window', default=None, type=int, metavar="N",
+                        help="Stop a search early once the best move and its winrate have held steady for N status updates from Leela")
+    parser.add_argument('--early-stop-tolerance', dest='early_stop_tolerance', default=0.01, type=float, metavar="T",
+                        help="How much the winrate may move, as a fraction, and still count as steady for --early-stop (default=0.01)")
+    parser.add_argument('--backend', default='leela', choices=['leela', 'lz-analyze'],
+                        help="How to get analysis from the engine, as for sgfanalyze.py (default=leela)")
+    parser.add_argument('--leela', dest='executable', metavar="CMD",
+                        help="Command to run Leela executable")
+    parser.add_argument('--engines', default=1, type=int, metavar="N",
+                        help="Run this many Leela processes in parallel (default=1)")
+    parser.add_argument('--threads', default=None, metavar="N|auto",
+                        help="Search threads for each Leela process, 'auto' splits the cores evenly between the --engines processes (default: Leela's own default)")
+    parser.add_argument('--cores', default=None, type=int, metavar="N",
+                        help="Cores to split between the Leela processes for --threads auto and --pin-cpus (default: all of this machine's, %d)" % (layout.cpu_count()))
+    parser.add_argument('--pin-cpus', dest='pin_cpus', action='store_true',
+                        help="Run each Leela process on its own block of cpus, using taskset")
+    parser.add_argument('--restarts', default=2, type=int, metavar="N",
+                        help="If leela crashes or hangs, restart it and retry the analysis step this many times before reporting a failure")
+    parser.add_argument('--cache', dest='ckpt_dir', metavar="DIR",
+                        default=os.path.expanduser('~/.leela_checkpoints'),
+                        help="Cache directory to fill, default ~/.leela_checkpoints")
+    parser.add_argument('--cache-format', dest='cache_format', default='sqlite', choices=sorted(cache.FORMATS.keys()),
+                        help="How the cache is stored, as for sgfanalyze.py (default=sqlite)")
+    parser.add_argument('--cache-compress', dest='cache_compress', action='store_true',
+                        help="Compress the analyses stored with zlib")
+    parser.add_argument('-v','--verbosity', default=0, type=int, metavar="V",
+                        help="Set the verbosity level, 0: progress only, 1: progress+status, 2: progress+status+state")
+    parser.add_argument("SGF", nargs='+', help="SGF files, or directories to search for them")
+
+    args = parser.parse_args()
+    if args.executable is None and not args.list_only:
+        parser.error("--leela is required unless just listing positions with --list")
+    if args.min_games < 1 or args.depth < 1:
+        parser.error("--min-games and --depth must be at least 1")
+    try:
+        placements = layout.placements_from_args(args.threads, args.cores, args.engines, args.pin_cpus)
+    except ValueError as e:
+        parser.error(str(e))
+
+    sgfanalyze.RESTART_COUNT = args.restarts
+    if args.seconds_per_search is None:
+        if args.visits is not None or args.playouts is not None:
+            args.seconds_per_search = sgfanalyze.default_work_budget_secs
+        else:
+            args.seconds_per_search = sgfanalyze.default_secs_per_search
+
+    engine_class = leelazero.ZeroCLI if args.backend == 'lz-analyze' else leela.CLI
+    make_engine = functools.partial(engine_class,
+                                   executable=args.executable,
+                                   seconds_per_search=args.seconds_per_search,
+                                   verbosity=args.verbosity,
+                                   visits=args.visits,
+                                   playouts=args.playouts)
+    if args.early_stop_window is not None:
+        make_engine = functools.partial(make_engine, early_stop=leela.EarlyStop(args.early_stop_window, args.early_stop_tolerance))
+    def make_game_engine(settings):
+        (board_size, komi, is_handicap_game) = settings
+        return make_engine(board_size=board_size, komi=komi, is_handicap_game=is_handicap_game)
+    def make_placed_engine(settings, placement):
+        engine = make_game_engine(settings)
+        engine.threads = placement.threads
+        engine.cpus = placement.cpus
+        return engine
+    # Each engine keeps its placement across restarts
+    if placements is not None:
+        free_placements = itertools.cycle(placements)
+    def make_leela(settings):
+        if placements is None:
+            return supervisor.EngineSupervisor(functools.partial(make_game_engine, settings), args.restarts, args.verbosity)
+        return supervisor.EngineSupervisor(functools.partial(make_placed_engine, settings, next(free_placements)), args.restarts, args.verbosity)
+
+    (tries, games) = build_tries(find_sgf_files(args.SGF), args.depth, make_game_engine, args.verbosity)
+    positions = []
+    for (settings, trie) in tries.items():
+        positions += [(games_reaching, moves, settings, history) for (games_reaching, moves, history) in
+                      common_positions(trie, make_game_engine(settings), args.min_games)]
+    #Most common first, and of those the earliest in the game
+    positions.sort(key=lambda p: (-p[0], p[1], p[2], p[3]))
+    positions = positions[:args.max_positions]
+    print >>sys.stderr, "Read %d games, %d positions were reached in at least %d of them" % (games, len(positions), args.min_games)
+
+    if args.list_only:
+        for (games_reaching, moves, settings, history) in positions:
+            print "%d games\t%dx%d komi %g\t%s" % (games_reaching, settings[0], settings[0], settings[1],
+                                                   " ".join(cmd.split()[1][0].upper() + " " + cmd.split()[2] for cmd in history))
+        sys.exit(0)
+
+    #There are no per game entries to look for, so the legacy namespace is the shared one too
+    checkpoints = cache.open_checkpoints(args.ckpt_dir, cache.SHARED, args.cache_format, args.verbosity, compress=args.cache_compress)
+    pool = None
+    analyzed = 0
+    cached = 0
+    try:
+        # Leave out what the cache already has, so that engines only start for settings with work to do
+        todo = {}
+        for (games_reaching, moves, settings, history) in positions:
+            engine = make_game_engine(settings)
+            engine.history = history
+            keys = sgfanalyze.checkpoint_keys(engine)
+            if checkpoints.get(*keys) is not None:
+                cached += 1
+            else:
+                todo.setdefault(settings, []).append(history)
+        print >>sys.stderr, "%d of them are cached already, analyzing %d" % (cached, len(positions) - cached)
+
+        pb = progressbar.ProgressBar(max_value=max(1, len(positions) - cached))
+        pb.start()
+        for (settings, histories) in sorted(todo.items()):
+            pool = enginepool.EnginePool(functools.partial(make_leela, settings), args.engines, args.verbosity)
+            pool.start()
+            for (i, history) in enumerate(histories):
+                pool.submit(i, history, lambda engine: sgfanalyze.do_analyze(engine, checkpoints, args.verbosity))
+            for i in range(len(histories)):
+                pool.result(i)
+                analyzed += 1
+                pb.update(analyzed, max(1, len(positions) - cached))
+            pool.stop()
+            pool = None
+        pb.finish()
+    except:
+        traceback.print_exc()
+        print >>sys.stderr, "Failure, stopping early\n"
+    finally:
+        if pool is not None:
+            pool.stop()
+        checkpoints.close()
+
+    print >>sys.stderr, "Analyzed %d positions, %d were cached already" % (analyzed, cached)
@@ -2,10 +2,11 @@
 import os, sys
 import argparse
 import hashlib
-import pickle
 import traceback
 import math
-from sgftools import gotools, leela, annotations, progressbar, sgflib
+import functools
+import itertools
+from sgftools import gotools, leela, annotations, progressbar, sgflib, enginepool, daemon, engineloop, supervisor, timeline, leelazero, batchengine, layout, cache
 
 # Stdev of bell curve whose cdf we take to be the "real" probability given Leela's winrate
 DEFAULT_STDEV = 0.22
@@ -142,38 +143,50 @@ def retry_analysis(fn):
         for i in xrange(RESTART_COUNT+1):
             try:
                 return fn(*args, **kwargs)
+            except supervisor.RESTARTABLE_ERRORS:
+                # The engine supervisor has already used up its restarts on these
+                raise
             except Exception as e:
                 if i+1 == RESTART_COUNT+1:
                     raise
                 print >>sys.stderr, "Error in leela, retrying analysis..."
     return wrapped
 
+# The key of the position's analysis in the cache, the key older versions stored it under for this game,
+# and the symmetry taking the position to the orientation it's cached in. Remembered for each game
+# setup, history and budget, since hashing the position replays the whole game.
+checkpoint_keys_memo = {}
+def checkpoint_keys(leela):
+    budget = leela.budget_key()
+    memo_key = (leela.board_size, leela.komi, leela.is_handicap_game, tuple(leela.history), budget)
+    keys = checkpoint_keys_memo.get(memo_key)
+    if keys is None:
+        (position_hash, symmetry) = leela.canonical_position()
+        keys = ('position_' + position_hash + "_" + budget, 'analyze_' + leela.history_hash() + "_" + budget, symmetry)
+        checkpoint_keys_memo[memo_key] = keys
+    return keys
+
 @retry_analysis
-def do_analyze(leela, base_dir, verbosity):
-    ckpt_hash = 'analyze_' + leela.history_hash() + "_" + str(leela.seconds_per_search) + "sec"
-    ckpt_fn = os.path.join(base_dir, ckpt_hash)
-    if verbosity > 2:
-        print >>sys.stderr, "Looking for checkpoint file:", ckpt_fn
-
-    if os.path.exists(ckpt_fn):
-        if verbosity > 1:
-            print >>sys.stderr, "Loading checkpoint file:", ckpt_fn
-        with open(ckpt_fn, 'r') as ckpt_file:
-            stats, move_list = pickle.load(ckpt_file)
+def do_analyze(leela, checkpoints, verbosity):
+    (key, legacy_key, symmetry) = checkpoint_keys(leela)
+    with timeline.span('cache_load', 'cache'):
+        cached = checkpoints.get(key, legacy_key, symmetry)
+
+    if cached is not None:
+        stats, move_list = cached
     else:
-        leela.reset()
-        leela.goto_position()
         stats, move_list = leela.analyze()
-        with open(ckpt_fn, 'w') as ckpt_file:
-            pickle.dump((stats, move_list), ckpt_file)
+        with timeline.span('cache_store', 'cache'):
+            checkpoints.put(key, (stats, move_list), symmetry)
 
     return stats, move_list
 
 # move_list is from a call to do_analyze
 # Iteratively expands a tree of moves by expanding on the leaf with the highest "probability of reaching".
-def do_variations(C, leela, stats, move_list, nodes_per_variation, board_size, game_move, base_dir, verbosity):
+# Returns the tree for record_variations, or None if there is nothing to explore.
+def search_variations(leela, stats, move_list, nodes_per_variation, game_move, checkpoints, verbosity):
     if 'bookmoves' in stats or len(move_list) <= 0:
-        return
+        return None
 
     rootcolor = leela.whoseturn()
     leaves = []
@@ -220,7 +233,7 @@ def do_variations(C, leela, stats, move_list, nodes_per_variation, board_size, g
     def search(node):
         for mv in node["history"]:
             leela.add_move(leela.whoseturn(),mv)
-        stats, move_list = do_analyze(leela,base_dir,verbosity)
+        stats, move_list = do_analyze(leela,checkpoints,verbosity)
         expand(node,stats,move_list)
 
         for mv in node["history"]:
@@ -231,7 +244,10 @@ def do_variations(C, leela, stats, move_list, nodes_per_variation, board_size, g
         if len(leaves) > 0:
             node = max(leaves,key=(lambda n: n["prob"]))
             search(node)
+    return tree
 
+# Add the variations explored by search_variations to the sgf at C
+def record_variations(C, tree, board_size):
     def advance(C, color, mv):
         foundChildIdx = None
         clr = 'W' if color =='white' else 'B'
@@ -279,6 +295,42 @@ def do_variations(C, leela, stats, move_list, nodes_per_variation, board_size, g
     record(tree)
 
 
+# The komi to give Leela, which only plays Chinese rules, and whether the game has handicap stones,
+# from the sgf's root node. Also returns notes on how komi was chosen, to show the user.
+def komi_and_handicap(node):
+    notes = []
+    is_handicap_game = False
+    handicap_stone_count = 0
+    if 'HA' in node.keys() and int(node['HA'].data[0]) > 1:
+        is_handicap_game = True
+        handicap_stone_count = int(node['HA'].data[0])
+
+    is_japanese_rules = False
+    if 'RU' in node.keys():
+        rules = node['RU'].data[0].lower()
+        is_japanese_rules = (rules == 'jp' or rules == 'japanese' or rules == 'japan')
+
+    komi = 7.5
+    if 'KM' in node.keys():
+        komi = float(node['KM'].data[0])
+        if is_handicap_game and is_japanese_rules:
+            old_komi = komi
+            komi = old_komi + handicap_stone_count
+            notes.append("Adjusting komi from %f to %f in converting Japanese rules with %d handicap to Chinese rules" % (old_komi,komi,handicap_stone_count))
+
+    else:
+        if is_handicap_game:
+            komi = 0.5
+        notes.append("Warning: Komi not specified, assuming %f" % (komi))
+    return (komi, is_handicap_game, notes)
+
+def needs_analysis(move_num, comment_requests_analyze, comment_requests_variations):
+    return ((move_num >= args.analyze_start and move_num <= args.analyze_end) or
+            (move_num in comment_requests_analyze) or
+            ((move_num-1) in comment_requests_analyze) or
+            (move_num in comment_requests_variations) or
+            ((move_num-1) in comment_requests_variations))
+
 def calculate_tasks_left(sgf, start_m, end_n, comment_requests_analyze, comment_requests_variations):
     C = sgf.cursor()
     move_num = 0
@@ -306,6 +358,10 @@ def calculate_tasks_left(sgf, start_m, end_n, comment_requests_analyze, comment_
 
 default_analyze_thresh = 0.030
 default_var_thresh = 0.030
+default_secs_per_search = 10
+default_work_budget_secs = 120
+default_memory_cache_entries = 10000
+default_memory_cache_mb = 256
 
 if __name__=='__main__':
     parser = argparse.ArgumentParser()
@@ -320,21 +376,57 @@ if __name__=='__main__':
     parser.add_argument('--var-thresh', dest='variations_threshold', default=default_var_thresh, type=float, metavar="T",
                         help="Explore variations on moves losing approx at least this much win rate when the game is close (default=0.03)")
 
-    parser.add_argument('--secs-per-search', dest='seconds_per_search', default=10, type=float, metavar="S",
-                        help="How many seconds to use per search (default=10)")
+    parser.add_argument('--secs-per-search', dest='seconds_per_search', default=None, type=float, metavar="S",
+                        help="How many seconds to use per search (default=10, or %d as a cap when --visits or --playouts is given)" % (default_work_budget_secs))
+    parser.add_argument('--visits', default=None, type=int, metavar="N",
+                        help="Stop each search after this many visits instead of after a fixed time, requires a Leela version with --visits")
+    parser.add_argument('--playouts', default=None, type=int, metavar="N",
+                        help="Stop each search after this many playouts instead of after a fixed time, using Leela's --playouts limit")
+    parser.add_argument('--early-stop', dest='early_stop_window', default=None, type=int, metavar="N",
+                        help="Stop a search early once the best move and its winrate have held steady for N status updates from Leela. Needs a Leela that gives up a genmove search when more input arrives, or Leela Zero with --backend lz-analyze; with a Leela that keeps searching, searches run their full budget after a warning")
+    parser.add_argument('--early-stop-tolerance', dest='early_stop_tolerance', default=0.01, type=float, metavar="T",
+                        help="How much the winrate may move, as a fraction, and still count as steady for --early-stop (default=0.01)")
+    parser.add_argument('--reuse-tree', dest='reuse_tree', action='store_true',
+                        help="Search the main line in game order on one engine, playing each game move on top of the last search so Leela can reuse its search tree. Results are cached separately from independent searches")
+    parser.add_argument('--engines', default=1, type=int, metavar="N",
+                        help="Run this many Leela processes in parallel when analyzing the main line (default=1)")
+    parser.add_argument('--threads', default=None, metavar="N|auto",
+                        help="Search threads for each Leela process, 'auto' splits the cores evenly between the --engines processes (default: Leela's own default)")
+    parser.add_argument('--cores', default=None, type=int, metavar="N",
+                        help="Cores to split between the Leela processes for --threads auto and --pin-cpus (default: all of this machine's, %d)" % (layout.cpu_count()))
+    parser.add_argument('--pin-cpus', dest='pin_cpus', action='store_true',
+                        help="Run each Leela process on its own block of cpus, using taskset")
     parser.add_argument('--nodes-per-var', dest='nodes_per_variation', default=8, type=int, metavar="N",
                         help="How many nodes to explore with leela in each variation tree (default=8)")
     parser.add_argument('--win-graph', dest='win_graph', metavar="PDF",
                         help="Output pdf graph of win rate to this file, must have matplotlib installed")
     parser.add_argument('-v','--verbosity', default=0, type=int, metavar="V",
                         help="Set the verbosity level, 0: progress only, 1: progress+status, 2: progress+status+state")
-    required.add_argument('--leela', dest='executable', required=True, metavar="CMD",
+    required.add_argument('--leela', dest='executable', metavar="CMD",
                         help="Command to run Leela executable")
+    parser.add_argument('--daemon', dest='daemon_socket', metavar="SOCKET", nargs='?', const=daemon.DEFAULT_SOCKET,
+                        help="Instead of starting Leela, send positions to a running leeladaemon.py listening on this socket (default %s)" % (daemon.DEFAULT_SOCKET))
+    parser.add_argument('--backend', default='leela', choices=['leela', 'lz-analyze', 'json'],
+                        help="How to get analysis from the engine: 'leela' searches with genmove and reads Leela's summary (default), 'lz-analyze' streams Leela Zero's lz-analyze output, 'json' sends queries to a batch analysis engine such as KataGo's, in which case --leela is the whole command to run it")
+    parser.add_argument('--event-loop', dest='event_loop', action='store_true',
+                        help="Drive Leela with the select based event loop driver instead of blocking reads (not available on Windows)")
     parser.add_argument('--cache', dest='ckpt_dir', metavar="DIR",
                         default=os.path.expanduser('~/.leela_checkpoints'),
-                        help="Set a directory to cache partially complete analyses, default ~/.leela_checkpoints")
+                        help="Set a directory to cache analyses in, default ~/.leela_checkpoints. Analyses are kept by position, so they are shared between every game reaching it")
+    parser.add_argument('--cache-any-budget', dest='cache_any_budget', action='store_true',
+                        help="Use a cached analysis of a position whatever search budget it was made with, rather than searching again. Without this, cached analyses made with more time, visits or playouts than asked for are used")
+    parser.add_argument('--memory-cache-entries', dest='memory_cache_entries', default=default_memory_cache_entries, type=int, metavar="N",
+                        help="Keep up to this many recently used analyses in memory as well as in the cache directory, 0 to turn this off (default=%d)" % (default_memory_cache_entries))
+    parser.add_argument('--memory-cache-mb', dest='memory_cache_mb', default=default_memory_cache_mb, type=float, metavar="MB",
+                        help="Keep at most this many megabytes of analyses in memory (default=%g)" % (default_memory_cache_mb))
+    parser.add_argument('--cache-compress', dest='cache_compress', action='store_true',
+                        help="Compress cached analyses with zlib, making the cache about a quarter smaller at a small cost in speed")
+    parser.add_argument('--cache-format', dest='cache_format', default='sqlite', choices=sorted(cache.FORMATS.keys()),
+                        help="How to store the cache: 'sqlite' keeps it all in one database file in the cache directory (default), importing any checkpoint files there the first time, 'pickle' writes one file per position as older versions did")
+    parser.add_argument('--timeline', dest='timeline_file', metavar="FILE",
+                        help="Record how long each Leela command, position sync and parse took and write them to FILE as a Chrome trace (chrome://tracing, ui.perfetto.dev), printing a summary when done")
     parser.add_argument('--restarts', default=2, type=int, metavar="N",
-                        help="If leela crashes, retry the analysis step this many times before reporting a failure")
+                        help="If leela crashes or hangs, restart it and retry the analysis step this many times before reporting a failure")
     parser.add_argument('--wipe-comments', dest='wipe_comments', action='store_true',
                         help="Remove existing comments from the main line of the SGF file")
     parser.add_argument('--skip-white', dest='skip_white', action='store_true',
@@ -348,6 +440,22 @@ if __name__=='__main__':
     parser.add_argument("SGF_FILE", help="SGF file to analyze")
 
     args = parser.parse_args()
+    if args.executable is None and args.daemon_socket is None:
+        parser.error("One of --leela or --daemon is required")
+    if args.backend != 'leela' and (args.event_loop or args.daemon_socket is not None):
+        parser.error("--backend %s can't be used with --event-loop or --daemon" % (args.backend))
+    if args.early_stop_window is not None and (args.backend == 'json' or args.event_loop or args.daemon_socket is not None):
+        parser.error("--early-stop can't be used with --backend json, --event-loop or --daemon")
+    if args.reuse_tree and (args.backend == 'json' or args.event_loop or args.daemon_socket is not None or args.engines > 1):
+        parser.error("--reuse-tree needs a single local engine driven by blocking reads, it can't be used with --backend json, --event-loop, --daemon or --engines")
+    if (args.threads is not None or args.pin_cpus) and (args.backend == 'json' or args.daemon_socket is not None):
+        parser.error("--threads and --pin-cpus can't be used with --backend json or --daemon, set them in the engine's configuration or on leeladaemon.py instead")
+    if args.backend == 'json' and args.engines > 1:
+        parser.error("--engines can't be used with --backend json, the engine is sent every position at once and its own configuration sets how many it searches in parallel")
+    try:
+        placements = layout.placements_from_args(args.threads, args.cores, args.engines, args.pin_cpus)
+    except ValueError as e:
+        parser.error(str(e))
     sgf_fn = args.SGF_FILE
     if not os.path.exists(sgf_fn):
         parser.error("No such file: %s" % (sgf_fn))
@@ -355,14 +463,18 @@ if __name__=='__main__':
 
     RESTART_COUNT = args.restarts
 
-    if not os.path.exists( args.ckpt_dir ):
-        os.mkdir( args.ckpt_dir )
+    if args.timeline_file is not None:
+        timeline.enable()
+
+    if args.seconds_per_search is None:
+        if args.visits is not None or args.playouts is not None:
+            args.seconds_per_search = default_work_budget_secs
+        else:
+            args.seconds_per_search = default_secs_per_search
+
     base_hash = hashlib.md5( os.path.abspath(sgf_fn) ).hexdigest()
-    base_dir = os.path.join(args.ckpt_dir, base_hash)
-    if not os.path.exists( base_dir ):
-        os.mkdir( base_dir )
-    if args.verbosity > 1:
-        print >>sys.stderr, "Checkpoint dir:", base_dir
+    checkpoints = cache.open_checkpoints(args.ckpt_dir, base_hash, args.cache_format, args.verbosity, args.cache_any_budget,
+                                         args.memory_cache_entries, int(args.memory_cache_mb * 1048576), args.cache_compress)
 
     comment_requests_analyze = {}
     comment_requests_variations = {}
@@ -401,29 +513,9 @@ if __name__=='__main__':
                 cnode['C'].data[0] = ""
 
     C = sgf.cursor()
-    is_handicap_game = False
-    handicap_stone_count = 0
-    if 'HA' in C.node.keys() and int(C.node['HA'].data[0]) > 1:
-        is_handicap_game = True
-        handicap_stone_count = int(C.node['HA'].data[0])
-
-    is_japanese_rules = False
-    if 'RU' in C.node.keys():
-        rules = C.node['RU'].data[0].lower()
-        is_japanese_rules = (rules == 'jp' or rules == 'japanese' or rules == 'japan')
-
-    komi = 7.5
-    if 'KM' in C.node.keys():
-        komi = float(C.node['KM'].data[0])
-        if is_handicap_game and is_japanese_rules:
-            old_komi = komi
-            komi = old_komi + handicap_stone_count
-            print >>sys.stderr, "Adjusting komi from %f to %f in converting Japanese rules with %d handicap to Chinese rules" % (old_komi,komi,handicap_stone_count)
-
-    else:
-        if is_handicap_game:
-            komi = 0.5
-        print >>sys.stderr, "Warning: Komi not specified, assuming %f" % (komi)
+    (komi, is_handicap_game, komi_notes) = komi_and_handicap(C.node)
+    for note in komi_notes:
+        print >>sys.stderr, note
 
     (analyze_tasks_initial,variations_tasks_initial) = calculate_tasks_left(sgf, args.analyze_start, args.analyze_end, comment_requests_analyze, comment_requests_variations)
     variations_task_probability = 1.0 / (1.0 + args.variations_threshold * 100.0)
@@ -453,14 +545,47 @@ if __name__=='__main__':
     def refresh_pb():
         pb.update(approx_tasks_done(), approx_tasks_max())
 
-    leela = leela.CLI(board_size=board_size,
-                      executable=args.executable,
-                      is_handicap_game=is_handicap_game,
-                      komi=komi,
-                      seconds_per_search=args.seconds_per_search,
-                      verbosity=args.verbosity)
+    if args.daemon_socket is not None:
+        engine_class = functools.partial(daemon.RemoteCLI, args.daemon_socket)
+    elif args.backend == 'lz-analyze':
+        engine_class = leelazero.ZeroCLI
+    elif args.backend == 'json':
+        engine_class = functools.partial(batchengine.BatchCLI, batchengine.AnalysisProcess(args.executable, args.verbosity))
+    elif args.event_loop:
+        engine_class = engineloop.LoopCLI
+    else:
+        engine_class = leela.CLI
+    make_engine = functools.partial(engine_class,
+                                   board_size=board_size,
+                                   executable=args.executable,
+                                   is_handicap_game=is_handicap_game,
+                                   komi=komi,
+                                   seconds_per_search=args.seconds_per_search,
+                                   verbosity=args.verbosity,
+                                   visits=args.visits,
+                                   playouts=args.playouts)
+    if args.early_stop_window is not None:
+        make_engine = functools.partial(make_engine, early_stop=leela.EarlyStop(args.early_stop_window, args.early_stop_tolerance))
+    if placements is not None:
+        print >>sys.stderr, "Engine layout: %s" % (layout.describe(placements))
+        # Each engine made keeps its placement across restarts. With a pool the first engine made
+        # is never started, so the pool's engines between them get every placement.
+        free_placements = itertools.cycle(placements)
+        def make_placed_engine(placement):
+            engine = make_engine()
+            engine.threads = placement.threads
+            engine.cpus = placement.cpus
+            return engine
+        def make_leela():
+            return supervisor.EngineSupervisor(functools.partial(make_placed_engine, next(free_placements)), args.restarts, args.verbosity)
+    else:
+        make_leela = functools.partial(supervisor.EngineSupervisor, make_engine, args.restarts, args.verbosity)
+    leela = make_leela()
+    pool = None
 
     collected_winrates = {}
+    early_stop_positions = []
+    reuse_positions = []
     collected_best_moves = {}
     collected_best_move_winrates = {}
     needs_variations = {}
@@ -472,7 +597,58 @@ if __name__=='__main__':
         prev_move_list = []
         has_prev = False
 
-        leela.start()
+        if args.engines == 1:
+            leela.reuse_tree = args.reuse_tree
+
+        # List the main line positions to analyze, and look up all of them in the cache at once
+        planned = []
+        add_moves_to_leela(C,leela)
+        while not C.atEnd:
+            C.next()
+            move_num += 1
+            add_moves_to_leela(C,leela)
+            if needs_analysis(move_num, comment_requests_analyze, comment_requests_variations):
+                planned.append((move_num, list(leela.history), checkpoint_keys(leela)))
+        leela.clear_history()
+        histories = dict((position_num, history) for (position_num, history, keys) in planned)
+        move_num = -1
+        C = sgf.cursor()
+        with timeline.span('cache_prefetch', 'cache', {'positions': len(planned)}):
+            checkpoints.prefetch([keys for (_, _, keys) in planned])
+
+        # Main line analyses already looked up in the cache, by position number
+        cached_positions = {}
+        if args.engines > 1:
+            # Hand every main line position to the pool up front, results are consumed below in move order
+            pool = enginepool.EnginePool(make_leela, args.engines, args.verbosity)
+            pool.start()
+            for (position_num, history, keys) in planned:
+                pool.submit(position_num, history, lambda engine: do_analyze(engine,checkpoints,args.verbosity), position_num)
+        else:
+            leela.start()
+            if args.backend == 'json':
+                # Send the engine every position the cache doesn't have in one go, so it can search them all together
+                for (position_num, history, keys) in planned:
+                    cached = checkpoints.get(*keys)
+                    if cached is not None:
+                        cached_positions[position_num] = cached
+                leela.submit_positions([history for (position_num, history, keys) in planned if position_num not in cached_positions])
+
+        # Variations are searched as soon as the mistake they're for shows up, on the engines already running:
+        # in the pool ahead of the main line positions queued after it, or on the single engine right away.
+        # With --reuse-tree they wait for the main line instead, so as not to break up its chain of reused
+        # searches. Either way they're added to the sgf once the main line is done.
+        variation_trees = {}
+        deferred_variations = {}
+        # Run a variation search on the single engine, from the position at position_num
+        def search_from(position_num, search):
+            history = leela.history
+            leela.history = list(histories[position_num])
+            try:
+                return search(leela)
+            finally:
+                leela.history = history
+
         add_moves_to_leela(C,leela)
         while not C.atEnd:
             C.next()
@@ -480,15 +656,20 @@ if __name__=='__main__':
             this_move = add_moves_to_leela(C,leela)
             current_player = leela.whoseturn()
             prev_player = "white" if current_player == "black" else "black"
-            if ((move_num >= args.analyze_start and move_num <= args.analyze_end) or
-                (move_num in comment_requests_analyze) or
-                ((move_num-1) in comment_requests_analyze) or
-                (move_num in comment_requests_variations) or
-                ((move_num-1) in comment_requests_variations)):
-                stats, move_list = do_analyze(leela,base_dir,args.verbosity)
+            if needs_analysis(move_num, comment_requests_analyze, comment_requests_variations):
+                if pool is not None:
+                    stats, move_list = pool.result(move_num)
+                elif move_num in cached_positions:
+                    stats, move_list = cached_positions.pop(move_num)
+                else:
+                    stats, move_list = do_analyze(leela,checkpoints,args.verbosity)
 
                 if 'winrate' in stats and stats['visits'] > 100:
                     collected_winrates[move_num] = (current_player, stats['winrate'])
+                if 'search_seconds' in stats:
+                    early_stop_positions.append(stats)
+                if 'reused_visits' in stats:
+                    reuse_positions.append((stats['visits'], stats['reused_visits']))
                 if len(move_list) > 0 and 'winrate' in move_list[0]:
                     collected_best_moves[move_num] = move_list[0]['pos']
                     collected_best_move_winrates[move_num] = move_list[0]['winrate']
@@ -511,6 +692,16 @@ if __name__=='__main__':
                         needs_variations[move_num-1] = (prev_stats,prev_move_list)
                         if (move_num-1) not in comment_requests_variations:
                             variations_tasks += 1
+                        search = functools.partial(search_variations, stats=prev_stats, move_list=prev_move_list,
+                                                   nodes_per_variation=args.nodes_per_variation, game_move=this_move,
+                                                   checkpoints=checkpoints, verbosity=args.verbosity)
+                        if pool is not None:
+                            pool.submit(('variations', move_num-1), histories[move_num-1], search, move_num-1)
+                        elif leela.reuse_tree:
+                            deferred_variations[move_num-1] = search
+                        else:
+                            variation_trees[move_num-1] = search_from(move_num-1, search)
+                            variations_tasks_done += 1
                 next_game_move = None
                 if not C.atEnd:
                     C.next()
@@ -552,40 +743,66 @@ if __name__=='__main__':
                 prev_move_list = []
                 has_prev = False
 
-        leela.stop()
-        leela.clear_history()
+        # Variations are searched out of order, so there's no tree to reuse
+        leela.reuse_tree = False
 
-        # Now fill in variations for everything we need
+        # Now fill in variations for everything we need, waiting on any still being searched
         move_num = -1
         C = sgf.cursor()
-        leela.start()
-        add_moves_to_leela(C,leela)
         while not C.atEnd:
             C.next()
             move_num += 1
-            add_moves_to_leela(C,leela)
 
             if move_num not in needs_variations:
                 continue
-            stats,move_list = needs_variations[move_num]
-            next_game_move = None
-            if not C.atEnd:
-                C.next()
-                if 'W' in C.node.keys():
-                    next_game_move = C.node['W'].data[0]
-                if 'B' in C.node.keys():
-                    next_game_move = C.node['B'].data[0]
-                C.previous()
-
-            do_variations(C, leela, stats, move_list, args.nodes_per_variation, board_size, next_game_move, base_dir, args.verbosity)
-            variations_tasks_done += 1
+            if move_num in variation_trees:
+                tree = variation_trees.pop(move_num)
+            else:
+                if pool is not None:
+                    tree = pool.result(('variations', move_num))
+                else:
+                    tree = search_from(move_num, deferred_variations.pop(move_num))
+                variations_tasks_done += 1
+            if tree is not None:
+                record_variations(C, tree, board_size)
             refresh_pb()
 
+        if pool is not None:
+            pool.stop()
+            pool = None
+
     except:
         traceback.print_exc()
         print >>sys.stderr, "Failure, reporting partial results...\n"
     finally:
+        if pool is not None:
+            pool.stop()
         leela.stop()
+        checkpoints.close()
+        if timeline.current is not None:
+            timeline.current.write_chrome_trace(args.timeline_file)
+            timeline.current.print_summary()
+
+    if len(early_stop_positions) > 0:
+        # Savings are counted in the budget the searches were given, the time is only a cap alongside visits or playouts
+        savings = []
+        if args.visits is not None:
+            savings.append(('visits_saved', "%d visits"))
+        if args.playouts is not None:
+            savings.append(('playouts_saved', "%d playouts"))
+        if len(savings) == 0:
+            savings.append(('seconds_saved', "%.1f seconds of search time"))
+        stopped = len([stats for stats in early_stop_positions if any(stats.get(name, 0) > 0 for (name, unit) in savings)])
+        print >>sys.stderr, "Early stopping ended %d of %d main line searches early, saving %s" % (
+            stopped, len(early_stop_positions), " and ".join(unit % sum(stats.get(name, 0) for stats in early_stop_positions) for (name, unit) in savings))
+
+    if args.memory_cache_entries > 0:
+        checkpoints.print_summary()
+
+    if len(reuse_positions) > 0:
+        visits = sum(v for (v, reused) in reuse_positions)
+        reused = sum(reused for (v, reused) in reuse_positions)
+        print >>sys.stderr, "Tree reuse: main line searches averaged %.0f visits, of which %.0f came from the previous search" % (float(visits) / len(reuse_positions), float(reused) / len(reuse_positions))
 
     if args.win_graph:
         graph_winrates(collected_winrates, "black", args.win_graph)
@@ -0,0 +1,349 @@
+import sys
+import time
+import json
+import shlex
+from threading import Thread, Lock, Condition
+from subprocess import Popen, PIPE
+from sgftools import leela, timeline
+
+#Backend for analysis engines that speak a batch JSON protocol, such as
+#KataGo's analysis engine. Each query is one line of json naming the turns of a
+#game to analyze, and the engine evaluates every turn of every query it has in
+#shared neural net batches. A reply comes back for each turn whenever it is done:
+#
+#  {"id": "7", "initialStones": [["B", "D4"], ["B", "Q16"]], "moves": [["W", "Q4"], ["B", "D16"]],
+#   "initialPlayer": "W", "rules": "chinese", "komi": 0.5, "boardXSize": 19, "boardYSize": 19,
+#   "analyzeTurns": [1, 2], "maxVisits": 1600}
+#
+#  {"id": "7", "turnNumber": 2, "moveInfos": [{"move": "C3", "visits": 812, "winrate": 0.53,
+#   "prior": 0.21, "order": 0, "pv": ["C3", "D3"]}, ...], "rootInfo": {...}}
+#
+#Winrates are read as black's, which is what the engine reports with
+#reportAnalysisWinratesAs = BLACK in its configuration.
+#
+#The positions of a game are submitted together with BatchCLI.submit_positions,
+#as few queries as cover them all written in one go, and analyze then picks up
+#the reply for its position. Positions that weren't submitted go out as a query
+#of their own. All engine handles made with the same AnalysisProcess share its
+#process, and the process runs while any of them is started.
+
+#A turn of a query waiting on its reply
+class PendingQuery(object):
+    def __init__(self, query_id, turn, owner):
+        self.id = query_id
+        self.turn = turn
+        #The process the query was written to
+        self.owner = owner
+        self.sent = time.time()
+        self.cond = Condition()
+        self.done = False
+        self.response = None
+        self.error = None
+
+    def finish(self, response, error):
+        with self.cond:
+            self.done = True
+            self.response = response
+            self.error = error
+            self.cond.notify_all()
+
+    def failed(self):
+        return self.done and self.error is not None
+
+    # Wait up to timeout seconds, returns whether the reply is in
+    def wait(self, timeout):
+        with self.cond:
+            if not self.done and timeout > 0:
+                self.cond.wait(timeout)
+            return self.done
+
+class AnalysisProcess(object):
+    def __init__(self, command, verbosity):
+        self.command = command
+        self.verbosity = verbosity
+        self.lock = Lock()
+        self.p = None
+        self.users = 0
+        #Threads reading the processes' output, which end when their process does
+        self.readers = []
+        #Turns waiting for a reply as (pending, process), by (query id, turn number)
+        self.pending = {}
+        self.next_id = 0
+        #When the process last said anything on stdout
+        self.last_reply = 0.0
+
+    def is_alive(self):
+        return self.p is not None and self.p.poll() is None
+
+    # Called by each handle as it starts, the first one (or the first after the process died) starts it
+    def acquire(self):
+        with self.lock:
+            self.users += 1
+            if not self.is_alive():
+                self.start_process()
+
+    # Called by each handle as it stops, the last one stops the process
+    def release(self):
+        with self.lock:
+            self.users -= 1
+            if self.users == 0 and self.p is not None:
+                self.stop_process()
+            readers = self.readers if self.users == 0 else []
+        # Let the readers of stopped processes finish failing what was sent to them, outside the lock they need
+        for t in readers:
+            t.join(5)
+
+    def start_process(self):
+        if self.p is not None:
+            self.stop_process()
+        if self.verbosity > 0:
+            print >>sys.stderr, "Starting analysis engine..."
+        p = Popen(shlex.split(self.command), stdout=PIPE, stdin=PIPE, stderr=PIPE)
+        self.p = p
+        self.readers = [t for t in self.readers if t.is_alive()]
+        for (target, pipe) in [(self.read_replies, p.stdout), (self.read_log, p.stderr)]:
+            t = Thread(target=target, args=(p, pipe))
+            t.daemon = True
+            t.start()
+            self.readers.append(t)
+
+    # A hung process may not heed a polite terminate, so kill stops it for sure
+    def stop_process(self, kill=False):
+        if self.verbosity > 0:
+            print >>sys.stderr, "Stopping analysis engine..."
+        p = self.p
+        self.p = None
+        try:
+            p.stdin.close()
+        except IOError:
+            pass
+        try:
+            if kill:
+                p.kill()
+            else:
+                p.terminate()
+        except OSError:
+            pass
+        p.wait()
+
+    # Kill a process that stopped answering, unless it was already replaced. Its reader then fails everything
+    # still waiting on it, and the next handle to start, as the engine supervisor restarts them, starts a new one.
+    def kill(self, p):
+        with self.lock:
+            if self.p is p:
+                print >>sys.stderr, "The analysis engine stopped answering, killing it"
+                self.stop_process(kill=True)
+
+    def read_log(self, p, pipe):
+        for line in iter(pipe.readline, ''):
+            if self.verbosity > 1:
+                sys.stderr.write(line)
+
+    def read_replies(self, p, pipe):
+        for line in iter(pipe.readline, ''):
+            if p is self.p:
+                self.last_reply = time.time()
+            try:
+                response = json.loads(line)
+            except ValueError:
+                if self.verbosity > 1:
+                    sys.stderr.write(line)
+                continue
+            query_id = response.get('id')
+            if 'error' in response:
+                #An error answers the whole query
+                self.finish_query(p, query_id, leela.CommandError([(query_id, response['error'])]))
+            elif 'warning' in response:
+                if self.verbosity > 0:
+                    print >>sys.stderr, "Analysis engine warning: %s" % (response['warning'])
+            elif not response.get('isDuringSearch', False):
+                with self.lock:
+                    entry = self.pending.pop((query_id, response.get('turnNumber')), None)
+                if entry is not None:
+                    entry[0].finish(response, None)
+        # The process is gone, fail everything sent to it
+        self.finish_query(p, None, leela.EngineDied("The analysis engine exited before answering"))
+
+    # Fail every turn of query_id sent to p, or with query_id None every turn sent to p
+    def finish_query(self, p, query_id, error):
+        with self.lock:
+            keys = [k for (k, (pending, owner)) in self.pending.items() if owner is p and (query_id is None or k[0] == query_id)]
+            entries = [self.pending.pop(k) for k in keys]
+        for (pending, owner) in entries:
+            pending.finish(None, error)
+
+    # Write all of requests in one go without waiting on replies. Each request lists the turns it is for in
+    # analyzeTurns. Returns a list for each request with a PendingQuery for each of its turns.
+    def query_many(self, requests):
+        with self.lock:
+            if not self.is_alive():
+                raise leela.EngineDied("The analysis engine is not running")
+            lines = []
+            queries = []
+            for request in requests:
+                self.next_id += 1
+                query_id = str(self.next_id)
+                lines.append(json.dumps(dict(request, id=query_id)) + "\n")
+                queries.append([PendingQuery(query_id, turn, self.p) for turn in request['analyzeTurns']])
+            for pending in sum(queries, []):
+                self.pending[(pending.id, pending.turn)] = (pending, self.p)
+            try:
+                self.p.stdin.write("".join(lines))
+                self.p.stdin.flush()
+            except IOError:
+                for pending in sum(queries, []):
+                    del self.pending[(pending.id, pending.turn)]
+                raise leela.EngineDied("The analysis engine exited before reading its queries")
+        return queries
+
+    # The reply for pending. The engine may take as long as it needs over all the queries it has, but not
+    # stay silent for more than timeout seconds while this one waits: then it is taken to be stuck and killed.
+    def wait(self, pending, timeout):
+        while True:
+            #Waiting in short steps keeps the wait interruptible by ctrl-c
+            if pending.wait(min(1.0, timeout)):
+                break
+            if time.time() - max(pending.sent, self.last_reply) > timeout:
+                self.kill(pending.owner)
+                raise leela.EngineTimeout("No reply from the analysis engine to query %s in %d seconds" % (pending.id, timeout))
+        if pending.error is not None:
+            raise pending.error
+        return pending.response
+
+#Engine handle with the same interface as leela.CLI, sending analyses as queries to a shared AnalysisProcess
+class BatchCLI(leela.CLI):
+    def __init__(self, process, board_size, executable, is_handicap_game, komi, seconds_per_search, verbosity, visits=None, playouts=None):
+        leela.CLI.__init__(self, board_size, executable, is_handicap_game, komi, seconds_per_search, verbosity, visits, playouts)
+        self.process = process
+        self.started = False
+        #Replies on the way for submitted positions, by history
+        self.submitted = {}
+
+    def budget_key(self):
+        return "json" + leela.CLI.budget_key(self)
+
+    def start(self):
+        self.process.acquire()
+        self.started = True
+
+    def stop(self):
+        if self.started:
+            self.started = False
+            self.process.release()
+
+    def is_alive(self):
+        return self.started and self.process.is_alive()
+
+    # Every query carries its whole position, there's no board to keep in sync
+    def reset(self):
+        pass
+
+    def goto_position(self):
+        pass
+
+    # How long the engine may go without answering anything before it counts as stuck
+    def reply_timeout(self):
+        return 20 + self.seconds_per_search * 2
+
+    # Send the positions after each of histories for analysis, all in one write. Histories that are
+    # the start of a longer one go in its query as another turn to analyze, so the positions of one
+    # game's main line make a single query.
+    def submit_positions(self, histories):
+        groups = []
+        for history in sorted(set(tuple(h) for h in histories), key=len, reverse=True):
+            stones = setup_stone_count(history)
+            for group in groups:
+                if group[0][:len(history)] == history and group[1] == stones:
+                    group[2].append(history)
+                    break
+            else:
+                groups.append((history, stones, [history]))
+        if len(groups) == 0:
+            return
+        requests = [self.make_query(list(longest), [len(h) - stones for h in group]) for (longest, stones, group) in groups]
+        with timeline.span('submit', 'gtp', {'positions': sum(len(group) for (_, _, group) in groups)}):
+            queries = self.process.query_many(requests)
+        for ((longest, stones, group), pending_turns) in zip(groups, queries):
+            for (history, pending) in zip(group, pending_turns):
+                self.submitted[history] = pending
+
+    # The query for the turns of history, counted in moves after any setup stones
+    def make_query(self, history, turns):
+        stones = setup_stone_count(history)
+        def color_and_move(cmd):
+            (_, color, move) = cmd.split()
+            return ["B" if color == "black" else "W", move.upper()]
+        moves = [color_and_move(cmd) for cmd in history[stones:]]
+        if len(moves) > 0:
+            initial_player = moves[0][0]
+        elif stones > 0:
+            initial_player = "W" if history[0].split()[1] == "black" else "B"
+        else:
+            initial_player = "W" if self.is_handicap_game else "B"
+        request = {
+            'initialStones': [color_and_move(cmd) for cmd in history[:stones]],
+            'moves': moves,
+            'initialPlayer': initial_player,
+            'rules': "chinese",
+            'komi': self.komi,
+            'boardXSize': self.board_size,
+            'boardYSize': self.board_size,
+            'analyzeTurns': turns,
+        }
+        budgets = [b for b in [self.visits, self.playouts] if b is not None]
+        if len(budgets) > 0:
+            request['maxVisits'] = min(budgets)
+        else:
+            request['overrideSettings'] = {'maxTime': self.seconds_per_search - 1}
+        return request
+    def parse_response(self, response):
+        move_list = []
+        for info in response.get('moveInfos', []):
+            move_list.append({
+                'pos': self.parse_position(info['move'].lower()),
+                'visits': int(info['visits']),
+                'winrate': float(info['winrate']),
+                'policy_prob': float(info.get('prior', 0.0)),
+                'pv': [self.parse_position(p.lower()) for p in info.get('pv', [])],
+            })
+        move_list = sorted(move_list, key=lambda info: info['visits'], reverse=True)
+        move_list = [info for (i,info) in enumerate(move_list) if i == 0 or info['visits'] > 0]
+        if len(move_list) == 0:
+            raise leela.EngineError("The analysis engine reported no moves")
+        stats = {
+            'best': move_list[0]['pos'],
+            'chosen': move_list[0]['pos'],
+            'winrate': move_list[0]['winrate'],
+            'visits': sum(info['visits'] for info in move_list),
+        }
+        return stats, move_list
+
+    # Whether pending failed, or went to a process that has since been replaced and won't answer it
+    def lost(self, pending):
+        return pending.failed() or (not pending.done and pending.owner is not self.process.p)
+
+    def analyze(self):
+        with timeline.span('analyze', 'position'):
+            pending = self.submitted.pop(tuple(self.history), None)
+            if pending is None or self.lost(pending):
+                # Submitted positions lost along with this one, to a crash or restart, go out again with it
+                lost = [list(h) for (h, p) in self.submitted.items() if self.lost(p)]
+                self.submit_positions(lost + [self.history])
+                pending = self.submitted.pop(tuple(self.history))
+            response = self.process.wait(pending, self.reply_timeout())
+            with timeline.span('parse', 'parse'):
+                stats, move_list = self.parse_response(response)
+        if self.verbosity > 0:
+            print >>sys.stderr, "Best move: %s" % (stats['best'])
+            print >>sys.stderr, "Winrate: %f" % (stats['winrate'])
+            print >>sys.stderr, "Visits: %d" % (stats['visits'])
+        return stats, move_list
+
+# How many commands at the start of history place handicap or other setup stones rather than play
+# moves: a run of stones of one colour, which no game played move by move starts with
+def setup_stone_count(history):
+    colors = [cmd.split()[1] for cmd in history]
+    count = 0
+    while count < len(colors) and colors[count] == colors[0]:
+        count += 1
+    return count if count > 1 else 0
@@ -0,0 +1,561 @@
+import os
+import re
+import sys
+import time
+import pickle
+import sqlite3
+from collections import OrderedDict
+import thread
+from threading import Lock
+from sgftools import cacheformat
+
+#Caches of finished analyses, so an interrupted run picks up where it left
+#off. Entries are (stats, move_list) pairs stored under a key naming the
+#position and search budget, within a namespace.
+#
+#Entries are keyed by the position itself, so they're shared between every
+#game that reaches it, in the namespace named by SHARED. Older versions keyed
+#them by the moves played, in a namespace per game named after the sgf file's
+#path, and Checkpoints still finds those.
+#
+#PickleDirCache is the original layout, one file per position in a directory
+#per namespace:
+#
+#  ~/.leela_checkpoints/positions/position_<position hash>_<budget>
+#  ~/.leela_checkpoints/<md5 of the sgf path>/analyze_<history hash>_<budget>
+#
+#SQLiteCache keeps every entry of a cache directory in one indexed database
+#file instead, which stays fast with hundreds of thousands of entries where a
+#directory of tiny files does not. The first time it is opened in a directory
+#holding pickle files, it imports them.
+#
+#A key ends in the search budget, like 11sec or lz1600visits_stop3x0.01. When
+#there's no entry for the budget asked for, an entry for the same position
+#searched with more of the same kind of budget (a larger number, everything
+#else equal) is just as good, and with any_budget an entry for any budget at
+#all is taken, the one with the most visits. The database keeps each entry's
+#budget and visits in columns of their own to choose between them.
+#
+#Both store entries in cacheformat's compact encoding, optionally compressed,
+#and read the pickles older versions stored as well.
+
+DB_FILENAME = 'cache.sqlite'
+
+#Namespace of the entries keyed by position
+SHARED = 'positions'
+
+#Key prefixes of entries keyed by position, and of those keyed by the moves of one game
+KEY_PREFIXES = ('position_', 'analyze_')
+
+#Most host parameters sqlite allows in one statement in older versions
+MAX_BATCH = 500
+
+#How many entries SQLiteCache reads before writing down when they were last used
+ACCESS_FLUSH = 100
+
+budget_re = re.compile(r'([0-9]+(?:\.[0-9]+)?)(sec|visits|playouts)')
+
+# Split a key into the position part and the budget
+def split_key(key):
+    (prefix, position_hash, budget) = key.split('_', 2)
+    return (prefix + '_' + position_hash, budget)
+
+# A budget as its kind, the budget with its amount taken out, and its amount. Budgets limiting
+# both visits and playouts can't be ordered, so their kind is the whole budget.
+def parse_budget(budget):
+    terms = budget_re.findall(budget)
+    if len(terms) != 1:
+        return (budget, 0.0)
+    return (budget_re.sub(lambda M: '*' + M.group(2), budget), float(terms[0][0]))
+
+# The position, budget kind, amount and visits of a stored entry
+def entry_metadata(key, value):
+    (position, budget) = split_key(key)
+    (kind, amount) = parse_budget(budget)
+    return (position, kind, amount, value[0].get('visits', 0))
+
+# Among (key, kind, amount, visits) entries of one position, the best to use instead of the one for
+# budget, or None
+def choose_stronger(entries, budget, any_budget):
+    (kind, amount) = parse_budget(budget)
+    if any_budget:
+        candidates = entries
+        rank = lambda entry: (entry[3], entry[2], entry[0])
+    else:
+        candidates = [e for e in entries if e[1] == kind and e[2] >= amount]
+        rank = lambda entry: (entry[2], entry[3], entry[0])
+    if len(candidates) == 0:
+        return None
+    return max(candidates, key=rank)[0]
+
+class PickleDirCache(object):
+    def __init__(self, ckpt_dir, game, verbosity, compress=False):
+        self.dir = os.path.join(ckpt_dir, game)
+        self.verbosity = verbosity
+        self.compress = compress
+        self.prefetched = {}
+        #Budgets stored for each position, as (key, kind, amount, visits), listed the first time they're needed
+        self.index = None
+        if verbosity > 1:
+            print >>sys.stderr, "Checkpoint dir:", self.dir
+
+    def get(self, key):
+        if key in self.prefetched:
+            return self.prefetched.pop(key)
+        fn = os.path.join(self.dir, key)
+        if self.verbosity > 2:
+            print >>sys.stderr, "Looking for checkpoint file:", fn
+        if not os.path.exists(fn):
+            return None
+        if self.verbosity > 1:
+            print >>sys.stderr, "Loading checkpoint file:", fn
+        try:
+            with open(fn, 'rb') as f:
+                value = cacheformat.decode(f.read())
+        except (IOError, ValueError):
+            #Removed by cache maintenance since, or a file of an older version cut short by an interrupted run
+            return None
+        self.touch([key])
+        return value
+
+    # Note that entries were used. The modification time tells cache maintenance when an entry was last used.
+    def touch(self, keys):
+        for key in keys:
+            try:
+                os.utime(os.path.join(self.dir, key), None)
+            except OSError:
+                pass
+
+    def get_many(self, keys):
+        found = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                found[key] = value
+        return found
+
+    # Look up keys that will be asked for soon in one go, so that later gets don't touch the disk.
+    # Returns the keys that were found.
+    def prefetch(self, keys):
+        found = self.get_many(keys)
+        self.prefetched.update(found)
+        return set(found.keys())
+
+    # The entry for the position of key stored with the strongest budget, as (key, value), or None.
+    # File names don't tell how many visits a search made, so with any_budget the candidates are loaded.
+    def get_stronger(self, key, any_budget):
+        (position, budget) = split_key(key)
+        if self.index is None:
+            self.index = {}
+            if os.path.exists(self.dir):
+                for name in os.listdir(self.dir):
+                    if name.startswith(KEY_PREFIXES):
+                        self.index_entry(name, None)
+        entries = self.index.get(position, [])
+        loaded = {}
+        if any_budget:
+            for (k, kind, amount, visits) in list(entries):
+                value = self.get(k)
+                if value is None:
+                    self.forget(position, k)
+                else:
+                    loaded[k] = value
+            entries = [(k, kind, amount, loaded[k][0].get('visits', 0)) for (k, kind, amount, visits) in self.index.get(position, [])]
+        while True:
+            stronger = choose_stronger(entries, budget, any_budget)
+            if stronger is None:
+                return None
+            value = loaded[stronger] if stronger in loaded else self.get(stronger)
+            if value is not None:
+                return (stronger, value)
+            self.forget(position, stronger)
+            entries = [e for e in entries if e[0] != stronger]
+
+    # Drop an entry from the index that was deleted or couldn't be read since it was listed
+    def forget(self, position, key):
+        entries = [e for e in self.index.get(position, []) if e[0] != key]
+        if len(entries) > 0:
+            self.index[position] = entries
+        else:
+            self.index.pop(position, None)
+
+    def index_entry(self, key, value):
+        (position, budget) = split_key(key)
+        (kind, amount) = parse_budget(budget)
+        visits = value[0].get('visits', 0) if value is not None else 0
+        entries = self.index.setdefault(position, [])
+        entries[:] = [e for e in entries if e[0] != key] + [(key, kind, amount, visits)]
+
+    def put(self, key, value):
+        if not os.path.exists(self.dir):
+            try:
+                os.mkdir(self.dir)
+            except OSError:
+                #Made by another run in the meantime
+                pass
+        write_atomically(os.path.join(self.dir, key), cacheformat.encode(value, self.compress))
+        if self.index is not None:
+            self.index_entry(key, value)
+
+    def close(self):
+        self.prefetched = {}
+
+class SQLiteCache(object):
+    def __init__(self, ckpt_dir, game, verbosity, compress=False):
+        self.filename = os.path.join(ckpt_dir, DB_FILENAME)
+        self.game = game
+        self.verbosity = verbosity
+        self.compress = compress
+        self.prefetched = {}
+        #Keys read since last writing down when entries were used
+        self.touched = set()
+        #Engine pool workers share the connection, one statement at a time
+        self.lock = Lock()
+        if verbosity > 1:
+            print >>sys.stderr, "Checkpoint database:", self.filename
+        #Other runs may be writing to the same database, wait for them rather than failing
+        self.db = sqlite3.connect(self.filename, timeout=60, check_same_thread=False)
+        self.db.text_factory = str
+        with self.lock:
+            #Readers don't block the writer and the other way around, and a commit doesn't wait on fsync
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            with self.db:
+                self.db.execute('CREATE TABLE IF NOT EXISTS entries (game TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, '
+                                'position TEXT, budget_kind TEXT, budget REAL, visits INTEGER, accessed REAL, PRIMARY KEY (game, key))')
+                self.db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+                add_metadata_columns(self.db)
+                self.db.execute('CREATE INDEX IF NOT EXISTS entries_position ON entries (game, position)')
+                if self.db.execute("SELECT 1 FROM meta WHERE name = 'pickle_import'").fetchone() is None:
+                    count = import_pickle_dirs(self.db, ckpt_dir)
+                    self.db.execute("INSERT INTO meta (name, value) VALUES ('pickle_import', ?)", (str(count),))
+                    if count > 0:
+                        print >>sys.stderr, "Imported %d cached analyses from checkpoint files in %s" % (count, ckpt_dir)
+
+    def get(self, key):
+        if key in self.prefetched:
+            return self.prefetched.pop(key)
+        if self.verbosity > 2:
+            print >>sys.stderr, "Looking for checkpoint:", key
+        with self.lock:
+            row = self.db.execute('SELECT value FROM entries WHERE game = ? AND key = ?', (self.game, key)).fetchone()
+        if row is None:
+            return None
+        if self.verbosity > 1:
+            print >>sys.stderr, "Loading checkpoint:", key
+        value = self.decode(key, row[0])
+        if value is not None:
+            self.touch([key])
+        return value
+
+    def get_many(self, keys):
+        keys = list(keys)
+        found = {}
+        for i in range(0, len(keys), MAX_BATCH - 1):
+            batch = keys[i:i + MAX_BATCH - 1]
+            query = 'SELECT key, value FROM entries WHERE game = ? AND key IN (%s)' % (','.join('?' * len(batch)))
+            with self.lock:
+                rows = self.db.execute(query, [self.game] + batch).fetchall()
+            for (key, data) in rows:
+                value = self.decode(key, data)
+                if value is not None:
+                    found[key] = value
+        self.touch(found.keys())
+        return found
+
+    # A stored entry, or None if it can't be read, which counts as a miss so the position is searched again
+    def decode(self, key, data):
+        try:
+            return cacheformat.decode(str(data))
+        except ValueError as e:
+            if self.verbosity > 1:
+                print >>sys.stderr, "Ignoring unreadable checkpoint %s: %s" % (key, e)
+            return None
+
+    # Note that entries were used, for cache maintenance to keep the ones in use
+    def touch(self, keys):
+        with self.lock:
+            self.touched.update(keys)
+            if len(self.touched) >= ACCESS_FLUSH:
+                self.flush_access()
+
+    # Called with the lock held
+    def flush_access(self):
+        now = time.time()
+        with self.db:
+            self.db.executemany('UPDATE entries SET accessed = ? WHERE game = ? AND key = ?',
+                                [(now, self.game, key) for key in self.touched])
+        self.touched = set()
+
+    # The entry for the position of key stored with the strongest budget, as (key, value), or None
+    def get_stronger(self, key, any_budget):
+        (position, budget) = split_key(key)
+        with self.lock:
+            rows = self.db.execute('SELECT key, budget_kind, budget, visits FROM entries WHERE game = ? AND position = ?',
+                                   (self.game, position)).fetchall()
+        while True:
+            stronger = choose_stronger(rows, budget, any_budget)
+            if stronger is None:
+                return None
+            value = self.get(stronger)
+            if value is not None:
+                if self.verbosity > 1:
+                    print >>sys.stderr, "Using checkpoint %s for %s" % (stronger, key)
+                return (stronger, value)
+            #Unreadable, try the next best
+            rows = [row for row in rows if row[0] != stronger]
+
+    # Look up keys that will be asked for soon in one query, so that later gets don't touch the database.
+    # Returns the keys that were found.
+    def prefetch(self, keys):
+        found = self.get_many(keys)
+        self.prefetched.update(found)
+        return set(found.keys())
+
+    def put(self, key, value):
+        with self.lock:
+            with self.db:
+                insert_entry(self.db, 'INSERT OR REPLACE', self.game, key, value, self.compress)
+
+    def close(self):
+        self.prefetched = {}
+        with self.lock:
+            if len(self.touched) > 0:
+                self.flush_access()
+            self.db.close()
+
+# Copy the entries of every per game pickle directory under ckpt_dir into db, returns how many were copied.
+# The pickle files are left where they are.
+def import_pickle_dirs(db, ckpt_dir):
+    count = 0
+    for game in sorted(os.listdir(ckpt_dir)):
+        game_dir = os.path.join(ckpt_dir, game)
+        if not os.path.isdir(game_dir):
+            continue
+        for key in sorted(os.listdir(game_dir)):
+            if not key.startswith(KEY_PREFIXES):
+                continue
+            try:
+                with open(os.path.join(game_dir, key), 'rb') as f:
+                    value = cacheformat.decode(f.read())
+            except Exception:
+                #A file cut short by an interrupted run, it would have been recomputed anyway
+                continue
+            insert_entry(db, 'INSERT OR IGNORE', game, key, value)
+            count += 1
+    return count
+
+def insert_entry(db, insert, game, key, value, compress=False):
+    data = sqlite3.Binary(cacheformat.encode(value, compress))
+    db.execute(insert + ' INTO entries (game, key, value, position, budget_kind, budget, visits, accessed) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+               (game, key, data) + entry_metadata(key, value) + (time.time(),))
+
+METADATA_COLUMNS = [('position', 'TEXT'), ('budget_kind', 'TEXT'), ('budget', 'REAL'), ('visits', 'INTEGER'), ('accessed', 'REAL')]
+
+# Databases made before entries had all their metadata in columns get it filled in, once
+def add_metadata_columns(db):
+    columns = [row[1] for row in db.execute('PRAGMA table_info(entries)')]
+    missing = [name for (name, column_type) in METADATA_COLUMNS if name not in columns]
+    for (name, column_type) in METADATA_COLUMNS:
+        if name in missing:
+            db.execute('ALTER TABLE entries ADD COLUMN %s %s' % (name, column_type))
+    if 'position' in missing:
+        for (game, key, data) in db.execute('SELECT game, key, value FROM entries').fetchall():
+            try:
+                value = cacheformat.decode(str(data))
+            except ValueError:
+                #Unreadable, it's searched again and replaced when next needed
+                continue
+            db.execute('UPDATE entries SET position = ?, budget_kind = ?, budget = ?, visits = ? WHERE game = ? AND key = ?',
+                       entry_metadata(key, value) + (game, key))
+    if 'accessed' in missing:
+        db.execute('UPDATE entries SET accessed = ?', (time.time(),))
+
+# A connection to the cache database in ckpt_dir that refuses to change it, so an older database
+# isn't brought up to date or fed the checkpoint files either. python 2's sqlite3 can't open a
+# database read only by uri, query_only makes every write fail instead.
+def open_read_only(ckpt_dir):
+    db = sqlite3.connect(os.path.join(ckpt_dir, DB_FILENAME), timeout=60)
+    db.text_factory = str
+    db.execute('PRAGMA query_only = ON')
+    return db
+
+# Replace fn with data so that a reader sees either the old file or the whole new one, never part of it
+def write_atomically(fn, data):
+    (directory, name) = os.path.split(fn)
+    tmp_fn = os.path.join(directory, '.%s.%d.%d.tmp' % (name, os.getpid(), thread.get_ident()))
+    with open(tmp_fn, 'wb') as f:
+        f.write(data)
+    try:
+        os.rename(tmp_fn, fn)
+    except OSError:
+        #Windows won't rename over an existing file
+        os.remove(fn)
+        os.rename(tmp_fn, fn)
+
+FORMATS = {
+    'sqlite': SQLiteCache,
+    'pickle': PickleDirCache,
+}
+
+#Keeps the most recently used entries of another cache in memory, so positions looked up again
+#during a run are served without going back to disk. Holds at most max_entries entries and
+#max_bytes of them, counting each by its pickled size. Hits are passed on to the other cache's
+#touch, so that its record of which entries are in use stays right for cache maintenance.
+class MemoryCache(object):
+    def __init__(self, cache, max_entries, max_bytes):
+        self.cache = cache
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = Lock()
+
+    def lookup(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            entry = self.entries.pop(key)
+            self.entries[key] = entry
+        self.cache.touch([entry[2]])
+        return entry[0]
+
+    # stored_key is the key value is stored under in the other cache, if it isn't key
+    def remember(self, key, value, stored_key=None):
+        if self.max_entries <= 0 or self.max_bytes <= 0:
+            return
+        size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            self.entries[key] = (value, size, stored_key or key)
+            self.bytes += size
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                (_, (_, evicted_size, _)) = self.entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def get(self, key):
+        value = self.lookup(key)
+        if value is None:
+            value = self.cache.get(key)
+            if value is not None:
+                self.remember(key, value)
+        return value
+
+    def get_many(self, keys):
+        found = {}
+        missing = []
+        for key in keys:
+            value = self.lookup(key)
+            if value is None:
+                missing.append(key)
+            else:
+                found[key] = value
+        for (key, value) in self.cache.get_many(missing).items():
+            self.remember(key, value)
+            found[key] = value
+        return found
+
+    # Entries held in memory are already as close as they can be
+    def prefetch(self, keys):
+        with self.lock:
+            held = set(key for key in keys if key in self.entries)
+        return held | self.cache.prefetch([key for key in keys if key not in held])
+
+    # A stronger entry found for key is remembered as key's, so asking again doesn't search for it again
+    def get_stronger(self, key, any_budget):
+        stronger = self.cache.get_stronger(key, any_budget)
+        if stronger is not None:
+            self.remember(key, stronger[1], stronger[0])
+        return stronger
+
+    def put(self, key, value):
+        self.cache.put(key, value)
+        self.remember(key, value)
+
+    def close(self):
+        self.cache.close()
+
+    def print_summary(self, out=sys.stderr):
+        print >>out, "In-memory result cache: %d hits, %d misses, %d evictions, holding %d entries in %.1fMB" % (
+            self.hits, self.misses, self.evictions, len(self.entries), self.bytes / 1048576.0)
+
+def open_cache(ckpt_dir, game, cache_format, verbosity, compress=False):
+    if not os.path.exists(ckpt_dir):
+        os.mkdir(ckpt_dir)
+    return FORMATS[cache_format](ckpt_dir, game, verbosity, compress)
+
+#The cache as sgfanalyze.py uses it. Each lookup gives the position's key, the key older versions
+#used for it in this game, and the gotools.Symmetry taking the position to the orientation its key
+#was made from. Entries by position are stored in that orientation and turned back on the way out,
+#so a rotated or reflected position finds them too. An entry only found under the old key is copied
+#over to the new one. Without an entry for the budget asked for, one with a stronger budget is used,
+#or with any_budget one with any budget.
+class Checkpoints(object):
+    def __init__(self, positions, legacy, any_budget=False):
+        self.positions = positions
+        self.legacy = legacy
+        self.any_budget = any_budget
+
+    def get(self, key, legacy_key, symmetry):
+        value = self.positions.get(key)
+        if value is not None:
+            return map_analysis(value, symmetry.undo)
+        value = self.legacy.get(legacy_key)
+        if value is not None:
+            self.put(key, value, symmetry)
+            return value
+        stronger = self.positions.get_stronger(key, self.any_budget)
+        if stronger is not None:
+            return map_analysis(stronger[1], symmetry.undo)
+        stronger = self.legacy.get_stronger(legacy_key, self.any_budget)
+        if stronger is not None:
+            (stored_key, value) = stronger
+            self.put(split_key(key)[0] + '_' + split_key(stored_key)[1], value, symmetry)
+            return value
+        return None
+
+    def put(self, key, value, symmetry):
+        self.positions.put(key, map_analysis(value, symmetry.apply))
+
+    # Takes the (key, legacy_key, symmetry) of each position
+    def prefetch(self, position_keys):
+        found = self.positions.prefetch([key for (key, legacy_key, symmetry) in position_keys])
+        self.legacy.prefetch([legacy_key for (key, legacy_key, symmetry) in position_keys if key not in found])
+
+    def close(self):
+        self.positions.close()
+        self.legacy.close()
+
+    def print_summary(self, out=sys.stderr):
+        self.positions.print_summary(out)
+
+# Copy of a (stats, move_list) entry with fn applied to every board point in it
+def map_analysis(value, fn):
+    (stats, move_list) = value
+    stats = dict(stats)
+    for field in ('best', 'chosen'):
+        if field in stats:
+            stats[field] = fn(stats[field])
+    mapped_list = []
+    for info in move_list:
+        info = dict(info)
+        info['pos'] = fn(info['pos'])
+        if 'pv' in info:
+            info['pv'] = [fn(pos) for pos in info['pv']]
+        mapped_list.append(info)
+    return (stats, mapped_list)
+
+# Entries by position go through a MemoryCache of at most memory_entries entries and memory_bytes
+def open_checkpoints(ckpt_dir, game, cache_format, verbosity, any_budget=False, memory_entries=0, memory_bytes=0, compress=False):
+    return Checkpoints(MemoryCache(open_cache(ckpt_dir, SHARED, cache_format, verbosity, compress), memory_entries, memory_bytes),
+                       open_cache(ckpt_dir, game, cache_format, verbosity, compress),
+                       any_budget)
@@ -0,0 +1,182 @@
+import struct
+import zlib
+import pickle
+
+#Compact encoding of the (stats, move_list) analyses stored in the cache,
+#a few times smaller than pickling them and quicker to read back:
+#
+#  'SGFA' <version byte> <flags byte> <body>
+#
+#The body, zlib compressed if the COMPRESSED flag is set, is the stats
+#record, the number of moves as a uint16, and a record per move. A record is
+#a uint32 with a bit set for each field of its schema that is present, then
+#the fixed width fields present in schema order, then the variable length
+#ones. Field types are
+#
+#  d  float64      q  int64      ?  bool      p  board point, uint16
+#  s  string, uint16 length then its bytes
+#  P  list of board points, uint16 count then a uint16 each
+#
+#with board points as 0 for a pass and 1 + 26 * column + row otherwise, all
+#little endian. An analysis with a field or value the schemas have no room
+#for is pickled instead, and decode tells the two apart by the magic, which
+#is also how it reads the pickles older versions wrote.
+
+MAGIC = 'SGFA'
+VERSION = 1
+
+#Flags
+COMPRESSED = 1
+
+#Fields of each kind of record, in the order they're stored. Fields can only be appended, and
+#removing or retyping one needs a new version.
+STATS_FIELDS = [
+    ('winrate', 'd'), ('mc_winrate', 'd'), ('nn_winrate', 'd'), ('margin', 's'),
+    ('visits', 'q'), ('playouts', 'q'), ('best', 'p'), ('chosen', 'p'),
+    ('bookmoves', 'q'), ('positions', 'q'),
+    ('search_seconds', 'd'), ('seconds_saved', 'd'), ('reused_visits', 'q'),
+    ('visits_saved', 'q'), ('playouts_saved', 'q'),
+]
+MOVE_FIELDS = [
+    ('pos', 'p'), ('visits', 'q'), ('winrate', 'd'), ('mc_winrate', 'd'), ('nn_winrate', 'd'),
+    ('nn_count', 'q'), ('policy_prob', 'd'), ('r_winrate', 'd'), ('r_count', 'q'), ('lcb', 'd'),
+    ('is_book', '?'), ('pv', 'P'),
+]
+
+STRUCT_CODES = {'d': 'd', 'q': 'q', '?': '?', 'p': 'H'}
+
+letters = 'abcdefghijklmnopqrstuvwxyz'
+POINTS = [''] + [a + b for a in letters for b in letters]
+POINT_CODES = dict((point, code) for (code, point) in enumerate(POINTS))
+
+header = struct.Struct('<4sBB')
+mask_struct = struct.Struct('<I')
+count_struct = struct.Struct('<H')
+
+# Everything about decoding a record with the fields of mask present, worked out once per mask
+class RecordLayout(object):
+    def __init__(self, fields, mask):
+        present = [(name, code) for (i, (name, code)) in enumerate(fields) if mask & (1 << i)]
+        self.fixed = [(name, code) for (name, code) in present if code in STRUCT_CODES]
+        self.variable = [(name, code) for (name, code) in present if code not in STRUCT_CODES]
+        self.struct = struct.Struct('<' + ''.join(STRUCT_CODES[code] for (name, code) in self.fixed))
+
+layouts = {}
+
+def record_layout(fields, mask):
+    key = (id(fields), mask)
+    layout = layouts.get(key)
+    if layout is None:
+        layout = layouts[key] = RecordLayout(fields, mask)
+    return layout
+
+def is_point(value):
+    return isinstance(value, basestring) and value in POINT_CODES
+
+def fits(code, value):
+    if code == 'd':
+        return type(value) is float
+    if code == 'q':
+        return type(value) in (int, long) and -2**63 <= value < 2**63
+    if code == '?':
+        return type(value) is bool
+    if code == 'p':
+        return is_point(value)
+    if code == 's':
+        return type(value) is str and len(value) < 65536
+    return type(value) is list and len(value) < 65536 and all(is_point(p) for p in value)
+
+# The record as a string, or None if it has fields that don't fit
+def encode_record(fields, record):
+    if len(record) > len(fields):
+        return None
+    mask = 0
+    fixed = []
+    variable = []
+    for (i, (name, code)) in enumerate(fields):
+        if name not in record:
+            continue
+        value = record[name]
+        if not fits(code, value):
+            return None
+        mask |= 1 << i
+        if code == 'p':
+            fixed.append(POINT_CODES[value])
+        elif code in STRUCT_CODES:
+            fixed.append(value)
+        elif code == 's':
+            variable.append(count_struct.pack(len(value)) + value)
+        else:
+            variable.append(struct.pack('<H%dH' % len(value), len(value), *[POINT_CODES[p] for p in value]))
+    layout = record_layout(fields, mask)
+    if len(layout.fixed) + len(layout.variable) != len(record):
+        #Fields the schema doesn't have
+        return None
+    return mask_struct.pack(mask) + layout.struct.pack(*fixed) + ''.join(variable)
+
+# Returns the record decoded from data at offset and the offset after it
+def decode_record(fields, data, offset):
+    (mask,) = mask_struct.unpack_from(data, offset)
+    offset += mask_struct.size
+    layout = record_layout(fields, mask)
+    values = layout.struct.unpack_from(data, offset)
+    offset += layout.struct.size
+    record = {}
+    for ((name, code), value) in zip(layout.fixed, values):
+        record[name] = POINTS[value] if code == 'p' else value
+    for (name, code) in layout.variable:
+        (length,) = count_struct.unpack_from(data, offset)
+        offset += count_struct.size
+        if code == 's':
+            record[name] = data[offset:offset + length]
+            offset += length
+        else:
+            record[name] = [POINTS[p] for p in struct.unpack_from('<%dH' % length, data, offset)]
+            offset += 2 * length
+    return (record, offset)
+
+def encode(value, compress=False):
+    body = None
+    if isinstance(value, tuple) and len(value) == 2 and isinstance(value[0], dict) and isinstance(value[1], list) and len(value[1]) < 65536:
+        (stats, move_list) = value
+        records = [encode_record(STATS_FIELDS, stats), count_struct.pack(len(move_list))]
+        records += [encode_record(MOVE_FIELDS, info) if isinstance(info, dict) else None for info in move_list]
+        if None not in records:
+            body = ''.join(records)
+    if body is None:
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    flags = 0
+    if compress:
+        packed = zlib.compress(body)
+        if len(packed) < len(body):
+            (body, flags) = (packed, COMPRESSED)
+    return header.pack(MAGIC, VERSION, flags) + body
+
+# Raises ValueError for an entry that is cut short, corrupt or from a newer version
+def decode(data):
+    if not data.startswith(MAGIC):
+        try:
+            return pickle.loads(data)
+        except Exception as e:
+            #Unpickling garbage can raise most anything
+            raise ValueError("Cached analysis can't be unpickled: %s" % (str(e) or e.__class__.__name__))
+    try:
+        (magic, version, flags) = header.unpack_from(data)
+    except struct.error:
+        raise ValueError("Cached analysis is cut short")
+    if version != VERSION:
+        raise ValueError("Cached analysis is in format version %d, this version reads %d" % (version, VERSION))
+    try:
+        body = data[header.size:]
+        if flags & COMPRESSED:
+            body = zlib.decompress(body)
+        (stats, offset) = decode_record(STATS_FIELDS, body, 0)
+        (count,) = count_struct.unpack_from(body, offset)
+        offset += count_struct.size
+        move_list = []
+        for i in range(count):
+            (info, offset) = decode_record(MOVE_FIELDS, body, offset)
+            move_list.append(info)
+    except (struct.error, zlib.error, IndexError):
+        raise ValueError("Cached analysis is cut short")
+    return (stats, move_list)
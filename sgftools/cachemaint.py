@@ -0,0 +1,255 @@
+import os
+import sys
+import time
+from sgftools import cache, cacheformat
+
+#Keeps a cache directory within a size budget. Maintenance can run while
+#analyses are using the cache: the database is changed in short transactions
+#that analyses wait out, and pickle files are only ever removed whole, which
+#doesn't disturb a reader that already has one open.
+#
+#It goes through these steps, each of which can be skipped:
+#
+#  merge    Move entries from per-game pickle directories into the database,
+#           deleting the files once they're in, and then the directories
+#           left empty. Only with the sqlite format.
+#  prune    Delete entries another entry of the same position makes
+#           redundant, because it was searched with more of the same kind
+#           of budget and so gets used in their place anyway.
+#  evict    While the entries take up more than the size budget, delete
+#           them in order: 'lru' the least recently used first, 'value'
+#           the ones made with the fewest visits, so the cheapest to redo,
+#           first.
+#  compact  Give the space freed in the database back to the filesystem.
+
+POLICIES = ['lru', 'value']
+
+#Temporary files and unreadable entries older than this are left over from runs that died
+STALE_SECONDS = 3600
+
+class Report(object):
+    def __init__(self):
+        self.merged = 0
+        self.pruned = 0
+        self.evicted = 0
+        self.removed_files = 0
+        self.removed_dirs = 0
+        self.bytes_before = 0
+        self.bytes_after = 0
+
+    def print_summary(self, out=sys.stdout):
+        print >>out, "Merged %d entries from checkpoint files, removing %d files and %d directories" % (
+            self.merged, self.removed_files, self.removed_dirs)
+        print >>out, "Pruned %d entries superseded by stronger searches" % (self.pruned)
+        print >>out, "Evicted %d entries" % (self.evicted)
+        print >>out, "Cache entries took %.1fMB, now %.1fMB" % (self.bytes_before / 1048576.0, self.bytes_after / 1048576.0)
+
+# Order of eviction for (key, size, visits, accessed) entries
+def eviction_order(entries, policy):
+    if policy == 'lru':
+        return sorted(entries, key=lambda entry: (entry[3], entry[0]))
+    return sorted(entries, key=lambda entry: (entry[2], entry[3], entry[0]))
+
+# Keys among (key, kind, amount) entries of one position that a stronger entry supersedes. Entries
+# whose value couldn't be read have no kind and are left alone
+def superseded(entries):
+    strongest = {}
+    for (key, kind, amount) in entries:
+        if kind is not None and '*' in kind:
+            strongest[kind] = max(strongest.get(kind, amount), amount)
+    return [key for (key, kind, amount) in entries if kind is not None and '*' in kind and amount < strongest[kind]]
+
+def is_stale(fn):
+    try:
+        return time.time() - os.path.getmtime(fn) > STALE_SECONDS
+    except OSError:
+        return False
+
+def remove_file(fn):
+    try:
+        os.remove(fn)
+        return True
+    except OSError:
+        return False
+
+def game_dirs(ckpt_dir):
+    for game in sorted(os.listdir(ckpt_dir)):
+        game_dir = os.path.join(ckpt_dir, game)
+        if os.path.isdir(game_dir):
+            yield (game, game_dir)
+
+# Delete leftover temporary files, and a directory left with nothing else in it. A dry run counts
+# the names in gone as already deleted.
+def clean_dir(game_dir, report, dry_run, gone=()):
+    names = [name for name in os.listdir(game_dir) if not (dry_run and name in gone)]
+    for name in list(names):
+        if name.endswith('.tmp') and is_stale(os.path.join(game_dir, name)):
+            if dry_run or remove_file(os.path.join(game_dir, name)):
+                report.removed_files += 1
+                names.remove(name)
+    if len(names) == 0:
+        if dry_run:
+            report.removed_dirs += 1
+            return
+        try:
+            os.rmdir(game_dir)
+            report.removed_dirs += 1
+        except OSError:
+            #Something was written to it in the meantime
+            pass
+
+def load_file(fn):
+    try:
+        with open(fn, 'rb') as f:
+            return cacheformat.decode(f.read())
+    except (IOError, ValueError):
+        return None
+
+# (game, key, size, position, budget kind, budget, visits, accessed) of every entry in db. A database
+# from before entries had their metadata in columns only gets them when next opened for writing, so
+# for a dry run they're worked out here the way that would fill them in.
+def entry_rows(db):
+    columns = [row[1] for row in db.execute('PRAGMA table_info(entries)')]
+    if all(name in columns for (name, column_type) in cache.METADATA_COLUMNS):
+        return db.execute('SELECT game, key, LENGTH(value), position, budget_kind, budget, visits, accessed FROM entries').fetchall()
+    now = time.time()
+    rows = []
+    for (game, key, data) in db.execute('SELECT game, key, value FROM entries'):
+        try:
+            metadata = cache.entry_metadata(key, cacheformat.decode(str(data)))
+        except ValueError:
+            metadata = (None, None, None, None)
+        rows.append((game, key, len(data)) + metadata + (now,))
+    return rows
+
+def maintain_sqlite(ckpt_dir, max_bytes, policy, steps, dry_run, verbosity):
+    report = Report()
+    #Opening the cache for writing migrates an older database and imports checkpoint files into it
+    if dry_run:
+        db = cache.open_read_only(ckpt_dir)
+        close = db.close
+    else:
+        db_cache = cache.SQLiteCache(ckpt_dir, cache.SHARED, verbosity)
+        db = db_cache.db
+        close = db_cache.close
+    try:
+        #Rows a dry run would have merged into the database
+        merged_rows = []
+        if 'merge' in steps:
+            for (game, game_dir) in game_dirs(ckpt_dir):
+                loaded = []
+                for key in sorted(os.listdir(game_dir)):
+                    fn = os.path.join(game_dir, key)
+                    if not key.startswith(cache.KEY_PREFIXES):
+                        continue
+                    value = load_file(fn)
+                    if value is None:
+                        #Unreadable, and too old to be one another run is still writing
+                        if is_stale(fn) and (dry_run or remove_file(fn)):
+                            report.removed_files += 1
+                        continue
+                    loaded.append((key, fn, value))
+                if not dry_run:
+                    with db:
+                        for (key, fn, value) in loaded:
+                            cache.insert_entry(db, 'INSERT OR IGNORE', game, key, value)
+                else:
+                    for (key, fn, value) in loaded:
+                        merged_rows.append((game, key, len(cacheformat.encode(value))) + cache.entry_metadata(key, value) + (time.time(),))
+                for (key, fn, value) in loaded:
+                    if dry_run or remove_file(fn):
+                        report.merged += 1
+                        report.removed_files += 1
+                clean_dir(game_dir, report, dry_run, set(key for (key, fn, value) in loaded))
+
+        rows = entry_rows(db)
+        present = set((row[0], row[1]) for row in rows)
+        rows += [row for row in merged_rows if (row[0], row[1]) not in present]
+        report.bytes_before = sum(row[2] for row in rows)
+        doomed = set()
+
+        if 'prune' in steps:
+            positions = {}
+            for (game, key, size, position, kind, amount, visits, accessed) in rows:
+                positions.setdefault((game, position), []).append((key, kind, amount))
+            for ((game, position), entries) in positions.items():
+                for key in superseded(entries):
+                    doomed.add((game, key))
+            report.pruned = len(doomed)
+
+        if 'evict' in steps and max_bytes is not None:
+            entries = [((game, key), size, visits or 0, accessed or 0.0) for (game, key, size, position, kind, amount, visits, accessed) in rows]
+            total = sum(size for (key, size, visits, accessed) in entries if key not in doomed)
+            for (key, size, visits, accessed) in eviction_order(entries, policy):
+                if total <= max_bytes:
+                    break
+                if key in doomed:
+                    continue
+                doomed.add(key)
+                total -= size
+                report.evicted += 1
+
+        doomed = sorted(doomed)
+        if not dry_run:
+            #Small transactions, so that analyses writing to the cache only ever wait a moment
+            for i in range(0, len(doomed), cache.MAX_BATCH):
+                with db:
+                    db.executemany('DELETE FROM entries WHERE game = ? AND key = ?', doomed[i:i + cache.MAX_BATCH])
+            if 'compact' in steps and len(doomed) > 0:
+                db.execute('VACUUM')
+                db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            report.bytes_after = db.execute('SELECT COALESCE(SUM(LENGTH(value)), 0) FROM entries').fetchone()[0]
+        else:
+            sizes = dict(((row[0], row[1]), row[2]) for row in rows)
+            report.bytes_after = report.bytes_before - sum(sizes.get(key, 0) for key in doomed)
+    finally:
+        close()
+    return report
+
+def maintain_pickle(ckpt_dir, max_bytes, policy, steps, dry_run, verbosity):
+    report = Report()
+    entries = []
+    pruned = set()
+    for (game, game_dir) in game_dirs(ckpt_dir):
+        positions = {}
+        for key in os.listdir(game_dir):
+            if not key.startswith(cache.KEY_PREFIXES):
+                continue
+            fn = os.path.join(game_dir, key)
+            try:
+                st = os.stat(fn)
+            except OSError:
+                continue
+            visits = 0
+            if policy == 'value' and 'evict' in steps:
+                value = load_file(fn)
+                visits = value[0].get('visits', 0) if value is not None else 0
+            entries.append((fn, st.st_size, visits, st.st_mtime))
+            (position, budget) = cache.split_key(key)
+            (kind, amount) = cache.parse_budget(budget)
+            positions.setdefault(position, []).append((fn, kind, amount))
+        if 'prune' in steps:
+            for same_position in positions.values():
+                for fn in superseded(same_position):
+                    if dry_run or remove_file(fn):
+                        pruned.add(fn)
+    report.pruned = len(pruned)
+    report.bytes_before = sum(size for (fn, size, visits, mtime) in entries)
+    entries = [entry for entry in entries if entry[0] not in pruned]
+    total = sum(size for (fn, size, visits, mtime) in entries)
+    if 'evict' in steps and max_bytes is not None:
+        for (fn, size, visits, mtime) in eviction_order(entries, policy):
+            if total <= max_bytes:
+                break
+            if dry_run or remove_file(fn):
+                total -= size
+                report.evicted += 1
+    report.bytes_after = total
+    for (game, game_dir) in game_dirs(ckpt_dir):
+        clean_dir(game_dir, report, dry_run)
+    return report
+
+def maintain(ckpt_dir, cache_format, max_bytes, policy, steps, dry_run, verbosity):
+    if cache_format == 'sqlite':
+        return maintain_sqlite(ckpt_dir, max_bytes, policy, steps, dry_run, verbosity)
+    return maintain_pickle(ckpt_dir, max_bytes, policy, steps, dry_run, verbosity)
@@ -0,0 +1,286 @@
+import os
+import sys
+import json
+import socket
+import functools
+import SocketServer
+from collections import deque
+from threading import Thread, Lock
+from sgftools import leela, engineloop, timeline
+
+#A long running server that keeps a set of leela engines warm and analyzes
+#positions for clients over a local unix socket. Each request and response
+#is one line of json:
+#
+#  {"id": 1, "board_size": 19, "komi": 7.5, "is_handicap_game": false,
+#   "seconds_per_search": 10, "visits": null, "playouts": null,
+#   "history": ["play black q16", ...]}
+#
+#  {"id": 1, "stats": {...}, "move_list": [...]}  or  {"id": 1, "error": "..."}
+#
+#A client may send several requests without waiting, responses are written
+#back as soon as each analysis finishes, which need not be in request order.
+
+DEFAULT_SOCKET = os.path.expanduser('~/.leela_daemon.sock')
+
+# json gives us back unicode strings, turn them back into the plain strings leela.CLI produces
+def to_str(obj):
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    if isinstance(obj, list):
+        return [to_str(x) for x in obj]
+    if isinstance(obj, dict):
+        return dict((to_str(k), to_str(v)) for (k,v) in obj.items())
+    return obj
+
+# Why request can't be analyzed, or None if it can. Requests are checked before they reach the
+# event loop, where a bad field would otherwise fail in the middle of starting an engine.
+def request_error(request):
+    if not isinstance(request, dict):
+        return "Request is not a json object"
+    for field in ['id', 'board_size', 'komi', 'is_handicap_game', 'seconds_per_search', 'history']:
+        if field not in request:
+            return "Request is missing %s" % (field)
+    if type(request['board_size']) not in (int, long) or not 2 <= request['board_size'] <= 25:
+        return "board_size must be a whole number from 2 to 25"
+    for field in ['komi', 'seconds_per_search']:
+        if type(request[field]) not in (int, long, float):
+            return "%s must be a number" % (field)
+    if request['seconds_per_search'] <= 0:
+        return "seconds_per_search must be positive"
+    if type(request['is_handicap_game']) is not bool:
+        return "is_handicap_game must be true or false"
+    for field in ['visits', 'playouts']:
+        value = request.get(field)
+        if value is not None and (type(value) not in (int, long) or value <= 0):
+            return "%s must be a positive whole number or null" % (field)
+    if not isinstance(request['history'], list):
+        return "history must be a list of play commands"
+    for cmd in request['history']:
+        parts = cmd.split() if isinstance(cmd, str) else []
+        if len(parts) != 3 or parts[0] != 'play' or parts[1] not in ('black', 'white'):
+            return "Not a play command in history: %s" % (json.dumps(cmd))
+    return None
+
+class EngineSlot(object):
+    def __init__(self, placement=None):
+        self.engine = None
+        #A layout.Placement for the slot's engines, or None for leela's defaults
+        self.placement = placement
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        write_lock = Lock()
+        def reply(response):
+            line = json.dumps(response) + "\n"
+            with write_lock:
+                try:
+                    self.wfile.write(line)
+                    self.wfile.flush()
+                except socket.error:
+                    pass
+
+        while True:
+            line = self.rfile.readline()
+            if line == "":
+                break
+            if line.strip() == "":
+                continue
+            try:
+                request = to_str(json.loads(line))
+            except ValueError:
+                reply({'id': None, 'error': "Malformed request"})
+                continue
+            error = request_error(request)
+            if error is not None:
+                reply({'id': request.get('id') if isinstance(request, dict) else None, 'error': error})
+                continue
+            self.server.analysis_daemon.submit(request, reply)
+
+class AnalysisServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+#All engines are driven by one EngineLoop on its own thread. Connection handler
+#threads hand requests over to it, and it runs each one on the next free engine.
+class AnalysisDaemon(object):
+    def __init__(self, executable, socket_path, num_engines, verbosity, placements=None):
+        self.executable = executable
+        self.socket_path = socket_path
+        self.num_engines = num_engines
+        self.verbosity = verbosity
+        self.loop = engineloop.EngineLoop()
+        if placements is None:
+            placements = [None] * num_engines
+        self.slots = [EngineSlot(placement) for placement in placements]
+        self.idle = list(self.slots)
+        self.jobs = deque()
+        self.server = None
+
+    # Called from connection handler threads
+    def submit(self, request, reply):
+        self.loop.call_soon_threadsafe(self.enqueue, request, reply)
+
+    def enqueue(self, request, reply):
+        self.jobs.append((request, reply))
+        self.dispatch()
+
+    def dispatch(self):
+        while len(self.jobs) > 0 and len(self.idle) > 0:
+            slot = self.idle.pop()
+            request, reply = self.jobs.popleft()
+            task = self.loop.spawn(self.run_job(slot, request))
+            task.add_done_callback(functools.partial(self.job_done, slot, request, reply))
+
+    # Runs on the event loop, so nothing one job does may escape from here and stop it for every client
+    def job_done(self, slot, request, reply, task):
+        try:
+            if task.error is not None:
+                if self.verbosity > 0:
+                    print >>sys.stderr, "Analysis failed, restarting leela: %s" % (task.error)
+                self.stop_engine(slot)
+                reply({'id': request.get('id'), 'error': str(task.error)})
+            else:
+                stats, move_list = task.result
+                reply({'id': request.get('id'), 'stats': stats, 'move_list': move_list})
+        except Exception as e:
+            print >>sys.stderr, "Failed to finish request %s: %s" % (request.get('id'), e)
+            try:
+                self.stop_engine(slot)
+            except Exception:
+                slot.engine = None
+            reply({'id': request.get('id'), 'error': "Internal error: %s" % (e)})
+        self.idle.append(slot)
+        self.dispatch()
+
+    def stop_engine(self, slot):
+        if slot.engine is not None:
+            slot.engine.stop()
+            slot.engine = None
+
+    def run_job(self, slot, request):
+        board_size = request['board_size']
+        is_handicap_game = request['is_handicap_game']
+        komi = request['komi']
+        seconds_per_search = request['seconds_per_search']
+        visits = request.get('visits')
+        playouts = request.get('playouts')
+
+        engine = slot.engine
+        # Replace an engine that died while it was idle
+        if engine is not None and not engine.is_alive():
+            self.stop_engine(slot)
+            engine = None
+        # Search limits are command line arguments, so changing them needs a fresh process
+        if engine is not None and (engine.visits != visits or engine.playouts != playouts):
+            self.stop_engine(slot)
+            engine = None
+
+        if engine is None:
+            engine = engineloop.AsyncCLI(self.loop,
+                                         board_size=board_size,
+                                         executable=self.executable,
+                                         is_handicap_game=is_handicap_game,
+                                         komi=komi,
+                                         seconds_per_search=seconds_per_search,
+                                         verbosity=self.verbosity,
+                                         visits=visits,
+                                         playouts=playouts)
+            if slot.placement is not None:
+                engine.threads = slot.placement.threads
+                engine.cpus = slot.placement.cpus
+            slot.engine = engine
+            yield engine.start_async()
+        elif (engine.board_size != board_size or engine.komi != komi or
+              engine.is_handicap_game != is_handicap_game or engine.seconds_per_search != seconds_per_search + 1):
+            yield engine.configure_async(board_size, is_handicap_game, komi, seconds_per_search)
+
+        engine.history = [str(cmd) for cmd in request['history']]
+        result = yield engine.analyze_async()
+        raise engineloop.Return(result)
+
+    def serve_forever(self):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self.server = AnalysisServer(self.socket_path, RequestHandler)
+        self.server.analysis_daemon = self
+
+        loop_thread = Thread(target=self.loop.run_forever)
+        loop_thread.start()
+        if self.verbosity > 0:
+            print >>sys.stderr, "Leela daemon listening on %s with %d engines" % (self.socket_path, self.num_engines)
+        try:
+            self.server.serve_forever()
+        finally:
+            def stop_engines():
+                for slot in self.slots:
+                    self.stop_engine(slot)
+            self.loop.call_soon_threadsafe(stop_engines)
+            self.loop.stop()
+            loop_thread.join()
+            self.server.server_close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+#Drop in replacement for leela.CLI that hands positions to a running daemon
+#instead of driving its own leela process
+class RemoteCLI(leela.CLI):
+    def __init__(self, socket_path, board_size, executable, is_handicap_game, komi, seconds_per_search, verbosity, visits=None, playouts=None):
+        leela.CLI.__init__(self, board_size, executable, is_handicap_game, komi, seconds_per_search, verbosity, visits, playouts)
+        self.socket_path = socket_path
+        self.sock = None
+        self.next_id = 0
+
+    def start(self):
+        if self.verbosity > 0:
+            print >>sys.stderr, "Connecting to leela daemon at %s..." % (self.socket_path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+        self.rfile = self.sock.makefile('r')
+
+    def stop(self):
+        if self.sock is not None:
+            self.rfile.close()
+            self.sock.close()
+            self.sock = None
+
+    def is_alive(self):
+        return self.sock is not None
+
+    # The daemon positions its own engines for every request
+    def reset(self):
+        pass
+
+    def goto_position(self):
+        pass
+
+    def analyze(self):
+        self.next_id += 1
+        request = {
+            'id': self.next_id,
+            'board_size': self.board_size,
+            'komi': self.komi,
+            'is_handicap_game': self.is_handicap_game,
+            'seconds_per_search': self.seconds_per_search - 1,
+            'visits': self.visits,
+            'playouts': self.playouts,
+            'history': self.history,
+        }
+        with timeline.span('analyze', 'position'):
+            try:
+                self.sock.sendall(json.dumps(request) + "\n")
+            except socket.error as e:
+                raise leela.EngineDied("Lost connection to leela daemon: %s" % (e))
+            while True:
+                line = self.rfile.readline()
+                if line == "":
+                    raise leela.EngineDied("Leela daemon closed the connection")
+                response = to_str(json.loads(line))
+                if response['id'] == self.next_id:
+                    break
+        if 'error' in response:
+            raise leela.CommandError([('analyze', "leela daemon: %s" % (response['error']))])
+
+        stats, move_list = response['stats'], response['move_list']
+        if self.verbosity > 0:
+            print >>sys.stderr, "Chosen move: %s" % (stats['chosen'])
+        return stats, move_list
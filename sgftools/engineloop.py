@@ -0,0 +1,533 @@
+import os
+import sys
+import time
+import heapq
+import errno
+import select
+import types
+from collections import deque, OrderedDict
+from threading import Lock
+from subprocess import Popen, PIPE
+from sgftools import leela, timeline
+
+#An event loop that drives any number of leela processes from a single thread,
+#in the style of asyncio (which python 2 doesn't have). Work is written as
+#generator coroutines: a coroutine yields a Request (or another coroutine) to
+#wait for it, gets the request's result sent back in, or has its error thrown
+#in, and finishes by raising Return(value).
+#
+#    def play_and_analyze(engine):
+#        yield engine.command("play black q16")
+#        stats, move_list = yield engine.analyze_async()
+#        raise Return(stats)
+#
+#    loop.run_until_complete(loop.gather([loop.spawn(play_and_analyze(e)) for e in engines]))
+#
+#Only select is used, so this needs a platform that can select on pipes.
+
+class EngineCancelled(leela.EngineError):
+    pass
+
+class Return(Exception):
+    def __init__(self, value=None):
+        Exception.__init__(self)
+        self.value = value
+
+#The pending result of some operation on the loop, which may complete with a
+#value, fail with an error, time out or be cancelled
+class Request(object):
+    def __init__(self, loop):
+        self.loop = loop
+        self.done = False
+        self.result = None
+        self.error = None
+        self.callbacks = []
+        self.deadline = None
+
+    def set_result(self, value):
+        if self.done:
+            return
+        self.result = value
+        self.finish()
+
+    def set_error(self, error):
+        if self.done:
+            return
+        self.error = error
+        self.finish()
+
+    def finish(self):
+        self.done = True
+        callbacks = self.callbacks
+        self.callbacks = []
+        for cb in callbacks:
+            self.loop.call_soon(cb, self)
+
+    def add_done_callback(self, cb):
+        if self.done:
+            self.loop.call_soon(cb, self)
+        else:
+            self.callbacks.append(cb)
+
+    def cancel(self):
+        self.set_error(EngineCancelled())
+
+    # Fail with EngineTimeout if not done within seconds from now, replacing any earlier timeout
+    def set_timeout(self, seconds):
+        deadline = time.time() + seconds
+        self.deadline = deadline
+        def expire():
+            if self.deadline == deadline:
+                self.set_error(leela.EngineTimeout("Timed out after %.1f seconds" % (seconds)))
+        self.loop.call_at(deadline, expire)
+
+    def get(self):
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+#Steps a coroutine along as the requests it waits on complete
+class Task(Request):
+    def __init__(self, loop, gen):
+        Request.__init__(self, loop)
+        self.gen = gen
+        self.waiting = None
+        loop.call_soon(self.step, None, None)
+
+    def step(self, value, error):
+        self.waiting = None
+        if self.done:
+            self.gen.close()
+            return
+        try:
+            if error is not None:
+                request = self.gen.throw(error)
+            else:
+                request = self.gen.send(value)
+        except StopIteration:
+            self.set_result(None)
+            return
+        except Return as r:
+            self.set_result(r.value)
+            return
+        except Exception as e:
+            self.set_error(e)
+            return
+        if isinstance(request, types.GeneratorType):
+            request = Task(self.loop, request)
+        self.waiting = request
+        request.add_done_callback(lambda r: self.step(r.result, r.error))
+
+    def cancel(self):
+        waiting = self.waiting
+        Request.cancel(self)
+        if waiting is not None:
+            waiting.cancel()
+
+class EngineLoop(object):
+    def __init__(self):
+        self.readers = {}
+        self.ready = deque()
+        self.timers = []
+        self.timer_seq = 0
+        self.lock = Lock()
+        self.wakeup_fds = None
+        self.stopped = False
+
+    def call_soon(self, fn, *args):
+        self.ready.append((fn, args))
+
+    # The only method that may be called from other threads
+    def call_soon_threadsafe(self, fn, *args):
+        with self.lock:
+            self.ready.append((fn, args))
+            if self.wakeup_fds is not None:
+                os.write(self.wakeup_fds[1], 'x')
+
+    def call_at(self, deadline, fn):
+        self.timer_seq += 1
+        heapq.heappush(self.timers, (deadline, self.timer_seq, fn))
+
+    # callback is called with each chunk of data read from fd, and with '' at eof
+    def add_reader(self, fd, callback):
+        self.readers[fd] = callback
+
+    def remove_reader(self, fd):
+        self.readers.pop(fd, None)
+
+    def spawn(self, gen):
+        return Task(self, gen)
+
+    # A request that completes with the list of results once all of requests have,
+    # or fails with the first error among them
+    def gather(self, requests):
+        requests = list(requests)
+        combined = Request(self)
+        remaining = [len(requests)]
+        def on_done(r):
+            if r.error is not None:
+                combined.set_error(r.error)
+                return
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                combined.set_result([x.result for x in requests])
+        for r in requests:
+            r.add_done_callback(on_done)
+        if len(requests) == 0:
+            combined.set_result([])
+        return combined
+
+    def sleep(self, seconds):
+        request = Request(self)
+        self.call_at(time.time() + seconds, lambda: request.set_result(None))
+        return request
+
+    # Wait for input or a timer, then run every callback that became ready
+    def run_once(self, max_wait=None):
+        if len(self.ready) > 0:
+            timeout = 0
+        else:
+            timeout = max_wait
+            if len(self.timers) > 0:
+                until_timer = max(0, self.timers[0][0] - time.time())
+                timeout = until_timer if timeout is None else min(timeout, until_timer)
+
+        if len(self.readers) > 0:
+            try:
+                readable, _, _ = select.select(self.readers.keys(), [], [], timeout)
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                readable = []
+            for fd in readable:
+                callback = self.readers.get(fd)
+                if callback is not None:
+                    callback(os.read(fd, 65536))
+        elif timeout is None:
+            raise Exception("EngineLoop would wait forever with nothing to wait on")
+        elif timeout > 0:
+            time.sleep(timeout)
+
+        now = time.time()
+        while len(self.timers) > 0 and self.timers[0][0] <= now:
+            _, _, fn = heapq.heappop(self.timers)
+            fn()
+
+        count = len(self.ready)
+        for i in range(count):
+            fn, args = self.ready.popleft()
+            fn(*args)
+
+    def run_until_complete(self, request):
+        if isinstance(request, types.GeneratorType):
+            request = self.spawn(request)
+        while not request.done:
+            self.run_once()
+        return request.get()
+
+    # Run until stop() is called from another thread
+    def run_forever(self):
+        r, w = os.pipe()
+        with self.lock:
+            self.wakeup_fds = (r, w)
+        self.add_reader(r, lambda data: None)
+        try:
+            while not self.stopped:
+                self.run_once()
+        finally:
+            self.remove_reader(r)
+            with self.lock:
+                self.wakeup_fds = None
+            os.close(r)
+            os.close(w)
+
+    def stop(self):
+        def set_stopped():
+            self.stopped = True
+        self.call_soon_threadsafe(set_stopped)
+
+#Counterpart to leela.CLI whose commands return Requests and whose higher level
+#operations are coroutines, so that one EngineLoop can drive many of them at once.
+#Every command is written with its GTP id, and a reply completes the command whose
+#id it carries. A command that times out or is cancelled stays pending under its
+#id, so its eventual reply is still recognized and discarded.
+class AsyncCLI(leela.CLI):
+    def __init__(self, loop, board_size, executable, is_handicap_game, komi, seconds_per_search, verbosity, visits=None, playouts=None):
+        leela.CLI.__init__(self, board_size, executable, is_handicap_game, komi, seconds_per_search, verbosity, visits, playouts)
+        self.loop = loop
+        #Commands waiting for a reply as (cmd, request), by GTP command id
+        self.pending = OrderedDict()
+        self.partial = {}
+        self.open_pipes = 0
+        self.stderr_listener = None
+
+    def spawn_process(self):
+        if self.verbosity > 0:
+            print >>sys.stderr, "Starting leela..."
+        p = Popen(self.launch_command(), stdout=PIPE, stdin=PIPE, stderr=PIPE)
+        self.p = p
+        self.partial = {'stdout': '', 'stderr': ''}
+        self.open_pipes = 2
+        self.loop.add_reader(p.stdout.fileno(), lambda data: self.on_data(p, 'stdout', data))
+        self.loop.add_reader(p.stderr.fileno(), lambda data: self.on_data(p, 'stderr', data))
+
+    def on_data(self, p, source, data):
+        if data == '':
+            self.loop.remove_reader((p.stdout if source == 'stdout' else p.stderr).fileno())
+            if p is self.p:
+                self.open_pipes -= 1
+                if self.open_pipes == 0:
+                    self.on_eof()
+            return
+        if p is not self.p:
+            return
+        parts = (self.partial[source] + data).split('\n')
+        self.partial[source] = parts.pop()
+        for line in parts:
+            self.on_line(source, line + '\n')
+
+    def on_line(self, source, line):
+        if source == 'stderr':
+            if self.stderr_listener is not None:
+                self.stderr_listener(line)
+            return
+        # Leela follows GTP and answers "=id text" upon success, "?id text" upon failure.
+        M = leela.reply_re.match(line)
+        if M is not None and M.group(2) in self.pending:
+            (cmd, request) = self.pending.pop(M.group(2))
+            if M.group(1) == '=':
+                request.set_result(line)
+            else:
+                request.set_error(leela.CommandError([(cmd, M.group(3).strip())]))
+
+    def on_eof(self):
+        self.board_history = None
+        while len(self.pending) > 0:
+            (cmd, request) = self.pending.popitem(last=False)[1]
+            request.set_error(leela.EngineDied("Leela exited while running '%s'" % (cmd)))
+
+    # Write cmds to leela in a single write, without waiting on any replies. Returns a request for
+    # each command, which completes with leela's reply line.
+    def command_burst(self, cmds, timeout=20):
+        requests = [Request(self.loop) for cmd in cmds]
+        if self.p is None:
+            for request in requests:
+                request.set_error(leela.EngineDied("Leela is not running"))
+            return requests
+        ids = []
+        for cmd in cmds:
+            self.command_id += 1
+            ids.append(str(self.command_id))
+        try:
+            self.p.stdin.write("".join("%s %s\n" % (i, cmd) for (i, cmd) in zip(ids, cmds)))
+        except IOError:
+            for (cmd, request) in zip(cmds, requests):
+                request.set_error(leela.EngineDied("Leela exited before '%s'" % (cmd)))
+            return requests
+        for (i, cmd, request) in zip(ids, cmds, requests):
+            self.pending[i] = (cmd, request)
+            request.set_timeout(timeout)
+            if timeline.current is not None:
+                self.time_command(cmd, request)
+        return requests
+
+    def time_command(self, cmd, request):
+        started = timeline.clock()
+        request.add_done_callback(lambda r: timeline.current.add(cmd.split()[0], 'gtp', started, timeline.clock()))
+
+    # Write a single command, the returned request completes with leela's reply line
+    def command(self, cmd, timeout=20):
+        return self.command_burst([cmd], timeout)[0]
+
+    # Write all of cmds at once and complete when every reply is in
+    def commands(self, cmds, timeout=20):
+        return self.loop.gather(self.command_burst(cmds, timeout))
+
+    def start_async(self):
+        self.spawn_process()
+        # Leela only starts reading commands once it has finished loading
+        yield self.command('protocol_version', timeout=self.startup_timeout)
+        yield self.send_settings_async()
+
+    def send_settings_async(self):
+        if self.verbosity > 0:
+            print >>sys.stderr, "Setting board size %d and komi %f to Leela" % (self.board_size, self.komi)
+        self.board_history = None
+        yield self.commands(['boardsize %d' % (self.board_size),
+                             'komi %f' % (self.komi),
+                             'time_settings 0 %d 1' % (self.seconds_per_search)])
+        self.board_history = []
+
+    def configure_async(self, board_size, is_handicap_game, komi, seconds_per_search):
+        self.board_size = board_size
+        self.is_handicap_game = is_handicap_game
+        self.komi = komi
+        self.seconds_per_search = seconds_per_search + 1
+        yield self.send_settings_async()
+
+    def play_moves_async(self, cmds):
+        history = self.board_history
+        self.board_history = None
+        yield self.commands(cmds)
+        for cmd in cmds:
+            if cmd == "undo":
+                history.pop()
+            else:
+                history.append(cmd)
+        self.board_history = history
+
+    def goto_position_async(self):
+        cmds = self.sync_commands()
+        if cmds is not None:
+            try:
+                yield self.play_moves_async(cmds)
+                return
+            except (leela.EngineDied, leela.EngineTimeout, EngineCancelled):
+                raise
+            except leela.EngineError:
+                if self.verbosity > 1:
+                    print >>sys.stderr, "Incremental position sync failed, replaying from scratch"
+        yield self.command('clear_board')
+        self.board_history = []
+        yield self.play_moves_async(self.history)
+
+    # Analyze the position in self.history. As in leela.CLI.analyze, the commands bringing leela's board
+    # there, setting the clock and starting the search all go out in one write, without waiting on each other.
+    def analyze_async(self):
+        sync = self.sync_commands()
+        replay = sync is None
+        if replay:
+            sync = ['clear_board'] + self.history
+        color = self.whoseturn()
+        setup = sync + ['time_left black %d 1' % (self.seconds_per_search),
+                        'time_left white %d 1' % (self.seconds_per_search)]
+
+        parser = leela.AnalysisParser(self.parse_position, color == "white")
+        stall_timeout = 20 + self.seconds_per_search * 2
+        summary = Request(self.loop)
+        def on_stderr(line):
+            with timeline.span('parse', 'parse'):
+                D = parser.feed_stderr(line)
+            if D is not None:
+                if self.verbosity > 0:
+                    print >>sys.stderr, "Visited %d positions" % (D['visits'])
+                genmove.set_timeout(stall_timeout)
+            if parser.has_summary:
+                summary.set_result(None)
+
+        self.stderr_listener = on_stderr
+        # Leela plays the move it picks, so its board diverges from self.history here
+        self.board_history = None
+        requests = self.command_burst(setup + ['genmove %s' % (color)])
+        genmove = requests.pop()
+        genmove.set_timeout(stall_timeout)
+        try:
+            try:
+                reply = yield genmove
+            except (EngineCancelled, leela.EngineTimeout):
+                # Leela stops searching as soon as it sees more input
+                if self.p is not None:
+                    try:
+                        self.p.stdin.write("\n")
+                    except IOError:
+                        pass
+                raise
+            with timeline.span('parse', 'parse'):
+                parser.feed_stdout(reply)
+            if not parser.has_summary:
+                summary.set_timeout(1)
+                try:
+                    yield summary
+                except leela.EngineTimeout:
+                    pass
+        finally:
+            self.stderr_listener = None
+
+        # The setup commands were answered before the search started
+        errors = [r.error for r in requests if r.error is not None]
+        if len(errors) > 0:
+            sync_failed = all(isinstance(e, leela.CommandError) for e in errors) and all(r.error is None for r in requests[len(sync):])
+            if replay or not sync_failed:
+                raise errors[0]
+            # Leela searched the wrong position, so put it in the right one the slow way and search again
+            if self.verbosity > 1:
+                print >>sys.stderr, "Incremental position sync failed, replaying from scratch"
+            result = yield self.analyze_async()
+            raise Return(result)
+
+        if parser.played is not None and parser.played != "resign":
+            self.board_history = self.history + ["play %s %s" % (color, parser.played.lower())]
+        with timeline.span('parse', 'parse'):
+            result = parser.result()
+        raise Return(result)
+
+    def stop(self):
+        if self.verbosity > 0:
+            print >>sys.stderr, "Stopping leela..."
+        if self.p is not None:
+            p = self.p
+            self.loop.remove_reader(p.stdout.fileno())
+            self.loop.remove_reader(p.stderr.fileno())
+            self.on_eof()
+            self.p = None
+            try:
+                p.stdin.write('exit\n')
+            except IOError:
+                pass
+            try:
+                p.terminate()
+            except OSError:
+                pass
+            p.wait()
+
+#Synchronous wrapper with the same interface as leela.CLI, running each
+#operation to completion on a private EngineLoop
+class LoopCLI(AsyncCLI):
+    def __init__(self, *args, **kwargs):
+        AsyncCLI.__init__(self, EngineLoop(), *args, **kwargs)
+
+    def run(self, request):
+        return self.loop.run_until_complete(request)
+
+    def start(self):
+        self.run(self.start_async())
+
+    def send_command(self, cmd, drain=True, timeout=20):
+        self.send_commands(cmd.strip().split("\n"), drain, timeout)
+
+    def send_commands(self, cmds, drain=True, timeout=20):
+        replies = self.run(self.commands(cmds, timeout))
+        return [leela.reply_re.match(line).group(3).strip() for line in replies]
+
+    def reset(self):
+        self.board_history = None
+        self.run(self.command('clear_board'))
+        self.board_history = []
+
+    def configure(self, board_size, is_handicap_game, komi, seconds_per_search):
+        self.run(self.configure_async(board_size, is_handicap_game, komi, seconds_per_search))
+
+    def goto_position(self):
+        with timeline.span('goto_position', 'position'):
+            self.run(self.goto_position_async())
+
+    def boardstate(self):
+        lines = []
+        self.stderr_listener = lines.append
+        try:
+            self.run(self.command('showboard'))
+        finally:
+            self.stderr_listener = None
+        return "".join(lines)
+
+    def analyze(self):
+        if self.verbosity > 1:
+            self.goto_position()
+            print >>sys.stderr, "Analyzing state:"
+            print >>sys.stderr, self.whoseturn(), "to play"
+            print >>sys.stderr, self.boardstate()
+        with timeline.span('analyze', 'position'):
+            stats, move_list = self.run(self.analyze_async())
+        if self.verbosity > 0:
+            print >>sys.stderr, "Chosen move: %s" % (stats['chosen'])
+        return stats, move_list
@@ -0,0 +1,88 @@
+import sys
+import itertools
+from Queue import PriorityQueue, Empty
+from threading import Thread, Condition
+
+#A fixed set of engines, each owned by one worker thread. Positions are
+#submitted with the history to analyze and a function to run on the engine,
+#and results are collected by key in whatever order the caller wants them.
+#Queued tasks run lowest priority first, and in the order they were submitted
+#among equal priorities, so work submitted late can still go ahead of work
+#queued earlier.
+class EnginePool(object):
+    def __init__(self, make_engine, num_engines, verbosity):
+        self.make_engine = make_engine
+        self.num_engines = num_engines
+        self.verbosity = verbosity
+        self.tasks = PriorityQueue()
+        self.submitted = itertools.count()
+        self.results = {}
+        self.cond = Condition()
+        self.threads = []
+
+    def start(self):
+        if self.verbosity > 0:
+            print >>sys.stderr, "Starting pool of %d engines..." % (self.num_engines)
+        for i in range(self.num_engines):
+            t = Thread(target=self.worker_loop, args=(self.make_engine(),))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    #Drops any tasks still queued, each worker finishes its current task and exits
+    def stop(self):
+        try:
+            while True:
+                self.tasks.get_nowait()
+        except Empty:
+            pass
+        for t in self.threads:
+            self.tasks.put((float('inf'), next(self.submitted), None))
+        for t in self.threads:
+            t.join()
+        self.threads = []
+
+    def worker_loop(self, engine):
+        start_error = None
+        try:
+            engine.start()
+        except Exception:
+            start_error = sys.exc_info()
+
+        try:
+            while True:
+                (priority, order, task) = self.tasks.get()
+                if task is None:
+                    break
+                key, history, fn = task
+                if start_error is not None:
+                    self.put_result(key, None, start_error)
+                    continue
+                try:
+                    engine.history = list(history)
+                    self.put_result(key, fn(engine), None)
+                except Exception:
+                    self.put_result(key, None, sys.exc_info())
+        finally:
+            engine.stop()
+
+    def put_result(self, key, value, exc_info):
+        with self.cond:
+            self.results[key] = (value, exc_info)
+            self.cond.notify_all()
+
+    # Queue fn to be run on some engine whose history has been set to history
+    def submit(self, key, history, fn, priority=0):
+        self.tasks.put((priority, next(self.submitted), (key, list(history), fn)))
+
+    # Block until the task submitted under key finishes, and return its result,
+    # re-raising any exception it raised
+    def result(self, key):
+        with self.cond:
+            while key not in self.results:
+                #A timeout keeps the wait interruptible by ctrl-c
+                self.cond.wait(1.0)
+            value, exc_info = self.results.pop(key)
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return value
@@ -112,19 +112,22 @@ class Pattern(object):
             return ['fliplr'] + ['rot90'] * (alignment-4)
 
 class Goban(object):
-    def __init__( self, sgf ):
+    def __init__( self, sgf, size=19 ):
         self.sgf = sgf
+        self.SZ = size
         self.init_board_state()
 
+    # Board size from the sgf if there is one, otherwise the size given
     def init_board_state( self ):
-        c = self.sgf.cursor()
+        if self.sgf is not None:
+            c = self.sgf.cursor()
 
-        self.SZ = 19
+            self.SZ = 19
 
-        for k in c.node.keys():
-            v = c.node[k]
-            if v.name == 'SZ':
-                self.SZ = int( v[0] )
+            for k in c.node.keys():
+                v = c.node[k]
+                if v.name == 'SZ':
+                    self.SZ = int( v[0] )
 
         self.boardstate = [ ]
         for i in xrange(0, self.SZ):
@@ -154,7 +157,7 @@ class Goban(object):
         return p_rep
 
     def copy( self ):
-        g = Goban( self.sgf )
+        g = Goban( self.sgf, self.SZ )
         for i in xrange(0, self.SZ):
             for j in xrange(0, self.SZ):
                 g.boardstate[i][j] = self.boardstate[i][j]
@@ -188,7 +191,7 @@ class Goban(object):
                     self.boardstate[x][y] = 'w'
 
             if v.name == 'B':
-                if not is_pass( v[0] ) and not is_tenuki( v[0] ):
+                if not is_pass( v[0] ) and not is_tenuki( v[0], self.SZ ):
                     x,y = self.get_coords( v[0] )
                     self.boardstate[x][y] = 'b'
                     move = x,y
@@ -198,7 +201,7 @@ class Goban(object):
                     color = 'b'
 
             if v.name == 'W':
-                if not is_pass( v[0] ) and not is_tenuki( v[0] ):
+                if not is_pass( v[0] ) and not is_tenuki( v[0], self.SZ ):
                     x,y = self.get_coords( v[0] )
                     self.boardstate[x][y] = 'w'
                     move = x,y
@@ -213,6 +216,22 @@ class Goban(object):
 
         return killed
 
+    # Play color ('b' or 'w') at an sgf coordinate, returns the point the other side may not
+    # immediately retake because of ko, or None
+    def play( self, color, pos ):
+        if is_pass( pos ) or is_tenuki( pos, self.SZ ):
+            return None
+        x, y = self.get_coords( pos )
+        self.boardstate[x][y] = color
+        adjacent = [ (i, j) for (i, j) in self.get_adjacent( x, y ) if self.boardstate[i][j] not in (None, color) ]
+        killed = self.process_dead_stones( (x, y), color )
+        if killed != 1:
+            return None
+        grp, c = self.get_group( (x, y) )
+        if len( grp ) != 1 or self.get_liberties( grp ) != 1:
+            return None
+        return [ (i, j) for (i, j) in adjacent if self.boardstate[i][j] is None ][0]
+
     def get_adjacent( self, x, y ):
         positions = []
         if x > 0:
@@ -289,6 +308,61 @@ class Goban(object):
         return x, y
 
 
+# One of the eight ways to rotate and reflect a board onto itself: mirror left to right, then top
+# to bottom, then across the diagonal, each if its bit of index is set. Index 0 leaves it alone.
+class Symmetry(object):
+    def __init__( self, index, size ):
+        self.index = index
+        self.SZ = size
+
+    def is_identity( self ):
+        return self.index == 0
+
+    def transform( self, x, y ):
+        if self.index & 1:
+            x = self.SZ - 1 - x
+        if self.index & 2:
+            y = self.SZ - 1 - y
+        if self.index & 4:
+            x, y = y, x
+        return x, y
+
+    def untransform( self, x, y ):
+        if self.index & 4:
+            x, y = y, x
+        if self.index & 2:
+            y = self.SZ - 1 - y
+        if self.index & 1:
+            x = self.SZ - 1 - x
+        return x, y
+
+    def transform_board( self, boardstate ):
+        board = [ [ None ] * self.SZ for i in xrange( self.SZ ) ]
+        for i in xrange( self.SZ ):
+            for j in xrange( self.SZ ):
+                x, y = self.transform( i, j )
+                board[x][y] = boardstate[i][j]
+        return board
+
+    # Map an sgf coordinate, leaving passes and anything else that isn't a point on the board alone
+    def apply( self, pos ):
+        return self._map_pos( pos, self.transform )
+
+    def undo( self, pos ):
+        return self._map_pos( pos, self.untransform )
+
+    def _map_pos( self, pos, fn ):
+        if len( pos ) != 2 or is_tenuki( pos, self.SZ ):
+            return pos
+        x, y = ord( pos[0] ) - 97, ord( pos[1] ) - 97
+        if x < 0 or x >= self.SZ or y < 0 or y >= self.SZ:
+            return pos
+        x, y = fn( x, y )
+        return chr( x + 97 ) + chr( y + 97 )
+
+def symmetries( size ):
+    return [ Symmetry( i, size ) for i in xrange( 8 ) ]
+
 def split_continuations( sgf ):
     c = sgf.cursor()
     goban = Goban( sgf )
@@ -333,8 +407,9 @@ def add_numberings( sgf ):
 def is_pass( p ):
     return p == '' or p == '``'
 
-def is_tenuki( p ):
-    return p == 'tt'
+# 'tt' stands for a pass only on boards up to 19x19, on larger ones it is a point
+def is_tenuki( p, size=19 ):
+    return p == 'tt' and size <= 19
 
 def clean_sgf( sgf ):
     c = sgf.cursor()
@@ -0,0 +1,111 @@
+import sys
+import multiprocessing
+from distutils.spawn import find_executable
+
+#Splits the machine's cores between engine processes. Leela searches with
+#several threads, so the same cores can run one engine with many threads or
+#many engines with a few threads each. Fewer threads per engine wastes less
+#search effort on positions the threads would otherwise share, more threads
+#per engine finishes each position sooner, and which of those gets through a
+#game faster depends on the host and the engine.
+#
+#A layout gives each engine a thread count and, if pinning, the cpus it may
+#run on, handed out as consecutive blocks so engines don't compete for cores:
+#
+#  plan(16, 4, pin=True) -> 4 engines x 4 threads on cpus 0-3, 4-7, 8-11, 12-15
+
+class Placement(object):
+    def __init__(self, threads, cpus=None):
+        self.threads = threads
+        #cpu numbers the engine may run on, or None to leave it to the OS
+        self.cpus = cpus
+
+    def __repr__(self):
+        threads = "default threads" if self.threads is None else "%d threads" % (self.threads)
+        if self.cpus is None:
+            return threads
+        return "%s on cpus %s" % (threads, cpu_list(self.cpus))
+
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+# Whether engines can be pinned to cpus on this host
+def can_pin():
+    return sys.platform.startswith('linux') and find_executable('taskset') is not None
+
+# Split cores between engines, any cores left over go one each to the first engines.
+# With more engines than cores each engine gets one thread and engines share cores.
+def plan(cores, engines, pin=False):
+    placements = []
+    next_cpu = 0
+    for i in range(engines):
+        threads = max(1, cores // engines + (1 if i < cores % engines else 0))
+        cpus = None
+        if pin:
+            cpus = [(next_cpu + j) % cores for j in range(threads)]
+            next_cpu = (next_cpu + threads) % cores
+        placements.append(Placement(threads, cpus))
+    return placements
+
+# Placements for the --threads, --cores and --pin-cpus options of the scripts, or None to leave
+# every engine to leela's defaults. Raises ValueError for options that can't be met.
+def placements_from_args(threads, cores, engines, pin):
+    if threads is None and not pin:
+        return None
+    if cores is None:
+        cores = cpu_count()
+    if cores < 1:
+        raise ValueError("--cores must be at least 1")
+    if pin and not can_pin():
+        raise ValueError("--pin-cpus needs Linux with taskset installed")
+    if pin and cores > cpu_count():
+        raise ValueError("--pin-cpus can't pin to %d cores, this machine only has %d" % (cores, cpu_count()))
+    placements = plan(cores, engines, pin)
+    if threads is not None and threads != 'auto':
+        try:
+            threads = int(threads)
+        except ValueError:
+            raise ValueError("--threads must be a number or 'auto'")
+        if threads < 1:
+            raise ValueError("--threads must be at least 1")
+        for p in placements:
+            p.threads = threads
+    elif threads is None:
+        # Pinned but with leela's default thread count
+        for p in placements:
+            p.threads = None
+    return placements
+
+# Engine counts worth comparing on a host: powers of two up to the core count, and the core count itself
+def candidate_engine_counts(cores):
+    counts = []
+    engines = 1
+    while engines < cores:
+        counts.append(engines)
+        engines *= 2
+    counts.append(cores)
+    return counts
+
+def describe(placements):
+    thread_counts = sorted(set(p.threads for p in placements))
+    threads = "/".join("default" if t is None else str(t) for t in thread_counts)
+    pinned = " pinned" if any(p.cpus is not None for p in placements) else ""
+    return "%d engine%s x %s thread%s%s" % (len(placements), "" if len(placements) == 1 else "s",
+                                           threads, "" if thread_counts == [1] else "s", pinned)
+
+# taskset's cpu list syntax, with runs of consecutive cpus as ranges
+def cpu_list(cpus):
+    ranges = []
+    for cpu in sorted(set(cpus)):
+        if len(ranges) > 0 and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(str(a) if a == b else "%d-%d" % (a, b) for (a, b) in ranges)
+
+# Prefix for an engine command line that runs it on only these cpus
+def affinity_command(cpus):
+    return ['taskset', '-c', cpu_list(cpus)]
@@ -2,10 +2,14 @@ import os
 import sys
 import re
 import time
+import errno
+import select
 import hashlib
+from collections import deque
 from Queue import Queue, Empty
 from threading import Thread
 from subprocess import Popen, PIPE, STDOUT
+from sgftools import timeline, layout, gotools
 
 update_regex = r'Nodes: ([0-9]+), Win: ([0-9]+\.[0-9]+)\% \(MC:[0-9]+\.[0-9]+\%\/VN:[0-9]+\.[0-9]+\%\), PV:(( [A-Z][0-9]+)+)'
 update_regex_no_vn = r'Nodes: ([0-9]+), Win: ([0-9]+\.[0-9]+)\%, PV:(( [A-Z][0-9]+)+)'
@@ -19,62 +23,370 @@ move_regex_no_vn = r'^([A-Z][0-9]+) -> +([0-9]+) \(U: +(\-?[0-9]+\.[0-9]+)\%\) \
 best_regex = r'([0-9]+) visits, score (\-? ?[0-9]+\.[0-9]+)\% \(from \-? ?[0-9]+\.[0-9]+\%\) PV: (.*)'
 stats_regex = r'([0-9]+) visits, ([0-9]+) nodes(?:, ([0-9]+) playouts)(?:, ([0-9]+) p/s)'
 bookmove_regex = r'([0-9]+) book moves, ([0-9]+) total positions'
-finished_regex = r'= ([A-Z][0-9]+|resign|pass)'
-
-#Start a thread that perpetually reads from the given file descriptor
-#and pushes the result on to a queue, to simulate non-blocking io. We
-#could just use fcntl and make the file descriptor non-blocking, but
-#fcntl isn't available on windows so we do this horrible hack.
-class ReaderThread:
-    def __init__(self,fd):
+finished_regex = r'=[0-9]* ([A-Z][0-9]+|resign|pass)'
+reply_regex = r'^([=?])([0-9]*) ?(.*)$'
+
+update_re = re.compile(update_regex)
+update_no_vn_re = re.compile(update_regex_no_vn)
+status_re = re.compile(status_regex)
+status_no_vn_re = re.compile(status_regex_no_vn)
+move_re = re.compile(move_regex)
+move_no_vn_re = re.compile(move_regex_no_vn)
+best_re = re.compile(best_regex)
+stats_re = re.compile(stats_regex)
+bookmove_re = re.compile(bookmove_regex)
+finished_re = re.compile(finished_regex)
+reply_re = re.compile(reply_regex)
+
+class EngineError(Exception):
+    pass
+
+#Leela didn't answer a command in time
+class EngineTimeout(EngineError):
+    pass
+
+#Leela's process exited or closed its pipes
+class EngineDied(EngineError):
+    pass
+
+#Leela answered one or more commands with an error, failures lists (command, message) for each
+class CommandError(EngineError):
+    def __init__(self, failures):
+        EngineError.__init__(self, "Leela rejected " + ", ".join("'%s' (%s)" % (cmd, message) for (cmd, message) in failures))
+        self.failures = failures
+
+def to_fraction(v):
+    v = v.strip()
+    return 0.01 * float(v)
+
+#Line reader over both of the engine's output pipes. readline blocks until
+#either pipe has a complete line or the deadline passes, so callers wake as
+#soon as Leela writes something rather than polling on a fixed sleep.
+#Lines are returned as (source, line) with source 'stdout' or 'stderr'.
+#
+#Subclasses provide fill(timeout), which reads whatever is available within
+#timeout seconds into self.lines and sets self.eof once both pipes are closed.
+class PipeReader(object):
+    def __init__(self):
+        self.lines = deque()
+        self.eof = False
+
+    # Returns the next line, or None on timeout or once both pipes are closed
+    def readline(self, deadline):
+        while len(self.lines) == 0:
+            timeout = deadline - time.time()
+            if self.eof or timeout <= 0:
+                return None
+            self.fill(timeout)
+        return self.lines.popleft()
+
+    # Return all lines available right now without blocking
+    def read_all_lines(self):
+        self.fill(0)
+        lines = list(self.lines)
+        self.lines.clear()
+        return lines
+
+    # Put lines back so that they are returned again by the next reads
+    def pushback(self, lines):
+        self.lines.extendleft(reversed(lines))
+
+    def close(self):
+        pass
+
+#Readiness based reads with select on the raw pipe descriptors
+class SelectPipeReader(PipeReader):
+    def __init__(self, p):
+        PipeReader.__init__(self)
+        self.sources = {p.stdout.fileno(): 'stdout', p.stderr.fileno(): 'stderr'}
+        self.partial = {'stdout': '', 'stderr': ''}
+
+    def fill(self, timeout):
+        while len(self.sources) > 0:
+            try:
+                ready, _, _ = select.select(self.sources.keys(), [], [], timeout)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in ready:
+                source = self.sources[fd]
+                data = os.read(fd, 65536)
+                if data == '':
+                    del self.sources[fd]
+                    if self.partial[source] != '':
+                        self.lines.append((source, self.partial[source]))
+                        self.partial[source] = ''
+                    continue
+                parts = (self.partial[source] + data).split('\n')
+                self.partial[source] = parts.pop()
+                for part in parts:
+                    self.lines.append((source, part + '\n'))
+            # A zero timeout means drain everything that is available right now
+            if timeout > 0 or len(ready) == 0:
+                break
+        if len(self.sources) == 0:
+            self.eof = True
+
+#select doesn't work on pipes on windows, so there we start a thread per pipe
+#that perpetually reads from it and pushes lines on to a shared queue. We could
+#just use fcntl and make the file descriptors non-blocking, but fcntl isn't
+#available on windows either.
+class ThreadedPipeReader(PipeReader):
+    def __init__(self, p):
+        PipeReader.__init__(self)
         self.queue = Queue()
-        self.fd = fd
-        self.stopped = False
-    def stop(self):
-        #No lock since this is just a simple bool that only ever changes one way
-        self.stopped = True
-    def loop(self):
-        while not self.stopped and not self.fd.closed:
-            line = None
-            #fd.readline() should return due to eof once the process is closed
-            #at which point
+        self.open_count = 2
+        self.threads = [Thread(target=self.loop, args=(p.stdout, 'stdout')),
+                        Thread(target=self.loop, args=(p.stderr, 'stderr'))]
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+
+    def loop(self, fd, source):
+        while True:
             try:
-                line = self.fd.readline()
-            except IOError:
-                time.sleep(0.2)
-                pass
-            if line is not None and len(line) > 0:
-                self.queue.put(line)
-
-    def readline(self):
+                line = fd.readline()
+            except (IOError, ValueError):
+                line = ''
+            #readline returns the empty string only at eof, once the process is closed
+            if line == '':
+                self.queue.put((source, None))
+                return
+            self.queue.put((source, line))
+
+    def fill(self, timeout):
+        items = []
         try:
-            line = self.queue.get_nowait()
+            if timeout > 0:
+                items.append(self.queue.get(timeout=timeout))
+            while True:
+                items.append(self.queue.get_nowait())
         except Empty:
-            return ""
-        return line
+            pass
+        for (source, line) in items:
+            if line is None:
+                self.open_count -= 1
+            else:
+                self.lines.append((source, line))
+        if self.open_count == 0:
+            self.eof = True
+
+    def close(self):
+        for t in self.threads:
+            t.join(1.0)
+
+def open_pipe_reader(p):
+    if os.name == 'nt':
+        return ThreadedPipeReader(p)
+    return SelectPipeReader(p)
+
+#Parses Leela's output for one genmove a line at a time as it arrives, picking
+#the pattern to try from how the line starts. Status updates are returned from
+#feed_stderr as they come, and result() builds the final stats and move list.
+class AnalysisParser(object):
+    def __init__(self, parse_position, flip_winrate):
+        self.parse_position = parse_position
+        self.flip_winrate = flip_winrate
+        self.stats = {}
+        self.move_list = []
+        self.finished = False
+        self.summarized = False
+        #Raw move leela answered genmove with, once it has
+        self.played = None
+        #Whether we've seen the final statistics or the book move line
+        self.has_summary = False
+
+    def maybe_flip(self, winrate):
+        return ((1.0 - winrate) if self.flip_winrate else winrate)
+
+    def parse_seq(self, seq):
+        return [self.parse_position(p) for p in seq.split()]
+
+    def parse_status_update(self, line):
+        M = update_re.match(line)
+        if M is None:
+            M = update_no_vn_re.match(line)
 
-    def read_all_lines(self):
-        lines = []
-        while True:
-            try:
-                line = self.queue.get_nowait()
-            except Empty:
-                break
-            lines.append(line)
-        return lines
+        if M is not None:
+            visits = int(M.group(1))
+            winrate = to_fraction(M.group(2))
+            seq = self.parse_seq(M.group(3))
+            return {'visits': visits, 'winrate': winrate, 'seq': seq}
+        return {}
 
+    def feed_stdout(self, line):
+        if self.played is None:
+            M = finished_re.search(line)
+            if M is not None:
+                self.played = M.group(1)
+
+    # Returns the status update on this line, if any
+    def feed_stderr(self, line):
+        line = line.strip()
+        if line == "":
+            return None
+        stats = self.stats
+        maybe_flip = self.maybe_flip
+
+        if line.startswith('Nodes:'):
+            D = self.parse_status_update(line)
+            return D if 'visits' in D else None
+
+        if line.startswith('MC winrate='):
+            M = status_re.match(line)
+            if M is not None:
+                stats['mc_winrate'] = maybe_flip(float(M.group(1)))
+                stats['nn_winrate'] = maybe_flip(float(M.group(2)))
+                stats['margin'] = M.group(3)
+            M = status_no_vn_re.match(line)
+            if M is not None:
+                stats['mc_winrate'] = maybe_flip(float(M.group(1)))
+                stats['margin'] = M.group(2)
+            return None
 
-def start_reader_thread(fd):
-    rt = ReaderThread(fd)
-    def begin_loop():
-        rt.loop()
+        if line.startswith('================'):
+            self.finished = True
+            return None
+
+        if line[0].isdigit():
+            M = bookmove_re.match(line)
+            if M is not None:
+                stats['bookmoves'] = int(M.group(1))
+                stats['positions'] = int(M.group(2))
+                self.has_summary = True
+                return None
 
-    t = Thread(target=begin_loop)
-    t.start()
-    return rt
+            M = stats_re.match(line)
+            if M is not None:
+                self.has_summary = True
+                if self.finished and not self.summarized:
+                    stats['visits'] = int(M.group(1))
+                    stats['playouts'] = int(M.group(3))
+                    self.summarized = True
+                return None
+
+            if self.finished and not self.summarized:
+                M = best_re.match(line)
+                if M is not None:
+                    stats['best'] = self.parse_position(M.group(3).split()[0])
+                    stats['winrate'] = maybe_flip(to_fraction(M.group(2)))
+            return None
+
+        if ' -> ' in line:
+            M = move_re.match(line)
+            if M is not None:
+                info = {
+                    'pos': self.parse_position(M.group(1)),
+                    'visits': int(M.group(2)),
+                    'winrate': maybe_flip(to_fraction(M.group(3))),
+                    'mc_winrate': maybe_flip(to_fraction(M.group(4))),
+                    'nn_winrate': maybe_flip(to_fraction(M.group(5))),
+                    'nn_count': int(M.group(6)),
+                    'policy_prob': to_fraction(M.group(7)),
+                    'pv': self.parse_seq(M.group(8))
+                }
+                self.move_list.append(info)
+                return None
+
+            M = move_no_vn_re.match(line)
+            if M is not None:
+                U = maybe_flip(to_fraction(M.group(3)))
+                info = {
+                    'pos': self.parse_position(M.group(1)),
+                    'visits': int(M.group(2)),
+                    'winrate': U, 'mc_winrate': U,
+                    'r_winrate': maybe_flip(to_fraction(M.group(4))),
+                    'r_count': int(M.group(5)),
+                    'policy_prob': to_fraction(M.group(6)),
+                    'pv': self.parse_seq(M.group(7))
+                }
+                self.move_list.append(info)
+        return None
+
+    def result(self):
+        stats = self.stats
+        move_list = self.move_list
+
+        if self.played is not None:
+            if self.played == "resign":
+                stats['chosen'] = "resign"
+            else:
+                stats['chosen'] = self.parse_position(self.played)
+
+        if 'bookmoves' in stats and len(move_list)==0:
+            move_list.append({'pos': stats['chosen'], 'is_book': True})
+        else:
+            required_keys = ['mc_winrate', 'margin', 'best', 'winrate', 'visits']
+            for k in required_keys:
+                if k not in stats:
+                    print >>sys.stderr, "WARNING: analysis stats missing data %s" % (k)
+
+            move_list = sorted(move_list, key = (lambda info: 1000000000000000 if info['pos'] == stats['best'] else info['visits']), reverse=True)
+            move_list = [info for (i,info) in enumerate(move_list) if i == 0 or info['visits'] > 0]
+
+            #In the case where leela resigns, rather than resigning, just replace with the move Leela did think was best
+            if stats['chosen'] == "resign":
+                stats['chosen'] = stats['best']
+
+        return stats, move_list
+
+#Early stopping policy: a search has settled once the best move in its status
+#updates has stayed the same, and its winrate within tolerance, over the last
+#window updates
+#
+#leelazero.ZeroCLI ends a settled lz-analyze by sending its next command, which
+#is how Leela Zero documents lz-analyze ending. leela.CLI has no such command for
+#genmove, so it writes a bare newline and counts on the engine giving up its search
+#as soon as more input is pending, the way Leela ends pondering. That's what
+#fakeleela.py does, but it isn't documented for genmove of Leela 0.11 run with
+#--gtp --noponder as CLI starts it, and an engine that keeps searching would turn
+#every stop into a full search. So a stop leela doesn't answer within grace
+#seconds, or after which it reports more progress, counts as ignored: the search
+#is recorded as a full one, with nothing saved, and the rest of the run doesn't
+#try stopping early, with a warning.
+class EarlyStop(object):
+    def __init__(self, window, tolerance, grace=2.0):
+        self.window = window
+        self.tolerance = tolerance
+        self.grace = grace
+        #Set once an engine has kept searching after being asked to stop
+        self.ignored = False
+
+    #Results of stopped searches differ from full ones, so they get cached separately
+    def budget_key(self):
+        return "_stop%dx%g" % (self.window, self.tolerance)
+
+    def watch(self):
+        return ConvergenceWatcher(self.window, self.tolerance)
+
+    def stop_ignored(self):
+        if not self.ignored:
+            print >>sys.stderr, "WARNING: leela kept searching after being asked to stop early, it doesn't support --early-stop. Searches run their full budget from now on"
+        self.ignored = True
+
+#Follows the status updates of one search
+class ConvergenceWatcher(object):
+    def __init__(self, window, tolerance):
+        self.window = window
+        self.tolerance = tolerance
+        self.recent = deque()
+
+    # Record a status update, returns whether the search has settled
+    def update(self, D):
+        if len(D.get('seq', [])) == 0:
+            return False
+        self.recent.append((D['seq'][0], D['winrate']))
+        if len(self.recent) > self.window:
+            self.recent.popleft()
+        if len(self.recent) < self.window:
+            return False
+        moves = set(move for (move, winrate) in self.recent)
+        winrates = [winrate for (move, winrate) in self.recent]
+        return len(moves) == 1 and max(winrates) - min(winrates) <= self.tolerance
 
 class CLI(object):
-    def __init__(self, board_size, executable, is_handicap_game, komi, seconds_per_search, verbosity):
+    def __init__(self, board_size, executable, is_handicap_game, komi, seconds_per_search, verbosity, visits=None, playouts=None, early_stop=None):
         self.history=[]
         self.executable = executable
         self.verbosity = verbosity
@@ -82,7 +394,23 @@ class CLI(object):
         self.is_handicap_game = is_handicap_game
         self.komi = komi
         self.seconds_per_search = seconds_per_search + 1 #add one to account for lag time
+        #Optional fixed amounts of work per search, in which case seconds_per_search is only a cap
+        self.visits = visits
+        self.playouts = playouts
+        #An EarlyStop, to end searches before their budget is used up once they settle
+        self.early_stop = early_stop
+        #Whether positions are being searched in game order so that leela can keep its search tree from
+        #one position to the next, which makes results depend on what was searched before
+        self.reuse_tree = False
+        #Search threads for leela to use, or None for its default, and the cpus to pin it to, or None
+        self.threads = None
+        self.cpus = None
+        self.startup_timeout = 120
         self.p = None
+        self.command_id = 0
+        #The moves on leela's board, as play commands, or None if we're not sure
+        self.board_history = None
+        self.reader = None
 
     def convert_position(self, pos):
         abet = 'abcdefghijklmnopqrstuvwxyz'
@@ -103,6 +431,41 @@ class CLI(object):
 
         return "%s%s" % (abet[X], abet[Y])
 
+    # Describes how much search a result got, for use in checkpoint names. A fixed amount
+    # of work gives the same result on any machine, so then the time cap is left out.
+    def budget_key(self):
+        budget = ""
+        if self.visits is not None:
+            budget += "%dvisits" % (self.visits)
+        if self.playouts is not None:
+            budget += "%dplayouts" % (self.playouts)
+        if budget == "":
+            budget = str(self.seconds_per_search) + "sec"
+        if self.early_stop is not None:
+            budget += self.early_stop.budget_key()
+        if self.reuse_tree:
+            budget += "_reuse"
+        return budget
+
+    # Accounting for an early stopping search. What it saved is measured in the budget in force: visits_saved
+    # and playouts_saved are how many of those budgets were left, and seconds_saved is how much of the time
+    # budget was left when the search ended, when there is no other, as seconds_per_search is then only a cap.
+    # stopped_at is when the search was asked to stop, or None if it wasn't or didn't.
+    def record_search_time(self, stats, search_started, stopped_at):
+        stats['search_seconds'] = time.time() - search_started
+        if self.visits is not None:
+            stats['visits_saved'] = 0
+            if stopped_at is not None:
+                stats['visits_saved'] = max(0, self.visits - stats.get('visits', 0))
+        if self.playouts is not None:
+            stats['playouts_saved'] = 0
+            if stopped_at is not None:
+                stats['playouts_saved'] = max(0, self.playouts - stats.get('playouts', stats.get('visits', 0)))
+        if self.visits is None and self.playouts is None:
+            stats['seconds_saved'] = 0.0
+            if stopped_at is not None:
+                stats['seconds_saved'] = max(0.0, self.seconds_per_search - 1 - stats['search_seconds'])
+
     def history_hash(self):
         H = hashlib.md5()
         for cmd in self.history:
@@ -110,8 +473,45 @@ class CLI(object):
             H.update(c[0] + p)
         return H.hexdigest()
 
+    # Hash of the position history leads to rather than the moves, so the same position reached by
+    # different move orders or in different games hashes the same: the stones on the board, any
+    # ko ban, whose turn it is, komi and board size. Rotations and reflections of a position hash
+    # the same too, by hashing whichever of them sorts first. Returns the hash and the
+    # gotools.Symmetry taking this position to the one hashed.
+    def canonical_position(self):
+        goban = gotools.Goban(None, self.board_size)
+        ko = None
+        for cmd in self.history:
+            _, c, p = cmd.split()
+            ko = goban.play(c[0], self.parse_position(p))
+        canonical = None
+        for symmetry in gotools.symmetries(self.board_size):
+            columns = [''.join(state or '.' for state in column) for column in symmetry.transform_board(goban.boardstate)]
+            state = (columns, ko if ko is None else symmetry.transform(*ko))
+            if canonical is None or state < canonical[0]:
+                canonical = (state, symmetry)
+        ((columns, ko), symmetry) = canonical
+        H = hashlib.md5()
+        for column in columns:
+            H.update(column)
+        H.update(" %s %r %d %r" % (self.whoseturn(), float(self.komi), self.board_size, ko))
+        #A pass answered by a pass ends the game, so the same stones after passes are a different position.
+        #Left out when there are none, to keep the keys of positions cached before passes counted
+        passes = self.trailing_passes()
+        if passes > 0:
+            H.update(" passes %d" % passes)
+        return (H.hexdigest(), symmetry)
+
+    def trailing_passes(self):
+        passes = 0
+        for cmd in reversed(self.history):
+            if not cmd.endswith(' pass'):
+                break
+            passes += 1
+        return passes
+
     def add_move(self, color, pos):
-        if pos == '' or pos =='tt':
+        if pos == '' or gotools.is_tenuki(pos, self.board_size):
             pos = 'pass'
         else:
             pos = self.convert_position(pos)
@@ -136,66 +536,135 @@ class CLI(object):
             return 'white'
 
     def parse_status_update(self, message):
-        M = re.match(update_regex, message)
-        if M is None:
-            M = re.match(update_regex_no_vn, message)
-
-        if M is not None:
-            visits = int(M.group(1))
-            winrate = self.to_fraction(M.group(2))
-            seq = M.group(3)
-            seq = [self.parse_position(p) for p in seq.split()]
-
-            return {'visits': visits, 'winrate': winrate, 'seq': seq}
-        return {}
+        return AnalysisParser(self.parse_position, False).parse_status_update(message)
 
     # Drain all remaining stdout and stderr current contents
     def drain(self):
-        so = self.stdout_thread.read_all_lines()
-        se = self.stderr_thread.read_all_lines()
+        so = []
+        se = []
+        for (source, line) in self.reader.read_all_lines():
+            if source == 'stdout':
+                so.append(line)
+            else:
+                se.append(line)
         return (so,se)
 
-    # Send command and wait for ack
-    def send_command(self, cmd, expected_success_count=1, drain=True, timeout=20):
-        self.p.stdin.write(cmd + "\n")
-        sleep_per_try = 0.1
-        tries = 0
-        success_count = 0
-        while tries * sleep_per_try <= timeout and self.p is not None:
-            time.sleep(sleep_per_try)
-            tries += 1
-            # Readline loop
-            while True:
-                s = self.stdout_thread.readline()
-                # Leela follows GTP and prints a line starting with "=" upon success.
-                if s.strip() == '=':
-                    success_count += 1
-                    if success_count >= expected_success_count:
-                        if drain:
-                            self.drain()
-                        return
-                # No output, so break readline loop and sleep and wait for more
-                if s == "":
+    # Send command and wait for ack. cmd may hold several newline separated commands,
+    # in which case we wait for all of their responses and fail if any of them failed.
+    def send_command(self, cmd, drain=True, timeout=20):
+        self.send_commands(cmd.strip().split("\n"), drain=drain, timeout=timeout)
+
+    # Write all of cmds in one go, tagged with GTP command ids, and wait for every reply.
+    # Returns the text of each reply, or raises CommandError naming each command that failed.
+    def send_commands(self, cmds, drain=True, timeout=20):
+        with timeline.span("+".join(sorted(set(c.split()[0] for c in cmds))), 'gtp', {'commands': len(cmds)}):
+            ids = self.write_commands(cmds)
+            replies = {}
+            seen = []
+            deadline = time.time() + timeout
+            while len(replies) < len(ids):
+                item = self.reader.readline(deadline)
+                # Timed out, or Leela closed its pipes
+                if item is None:
                     break
-        raise Exception("Failed to send command '%s' to Leela" % (cmd))
+                seen.append(item)
+                (source, s) = item
+                if source == 'stdout':
+                    self.match_reply(s, ids, replies)
+            if len(replies) < len(ids):
+                if self.p is None or self.reader.eof:
+                    raise EngineDied("Leela exited while running '%s'" % ("', '".join(cmds)))
+                raise EngineTimeout("Leela did not answer '%s' within %d seconds" % ("', '".join(cmds), timeout))
+            if drain:
+                self.drain()
+            else:
+                self.reader.pushback(seen)
+            self.check_replies(cmds, ids, replies)
+            return [replies[i][1] for i in ids]
 
-    def start(self):
+    # Write cmds numbered with fresh GTP ids, returning the ids
+    def write_commands(self, cmds):
+        ids = []
+        lines = []
+        for cmd in cmds:
+            self.command_id += 1
+            ids.append(str(self.command_id))
+            lines.append("%d %s\n" % (self.command_id, cmd))
+        self.write("".join(lines))
+        return ids
+
+    # Leela follows GTP and answers "=id text" upon success, "?id text" upon failure.
+    # Records the reply in replies if line is the reply to one of ids, and returns its id.
+    def match_reply(self, line, ids, replies):
+        M = reply_re.match(line)
+        if M is None or M.group(2) not in ids:
+            return None
+        replies[M.group(2)] = (M.group(1) == '=', M.group(3).strip())
+        return M.group(2)
+
+    def check_replies(self, cmds, ids, replies):
+        failures = [(cmd, replies[i][1]) for (cmd, i) in zip(cmds, ids) if i in replies and not replies[i][0]]
+        if len(failures) > 0:
+            raise CommandError(failures)
+
+    # Write to leela's stdin, a closed pipe means leela is gone
+    def write(self, text):
+        if self.p is None:
+            raise EngineDied("Leela is not running")
+        try:
+            self.p.stdin.write(text)
+        except IOError:
+            raise EngineDied("Leela exited before reading '%s'" % (text.strip()))
+
+    def is_alive(self):
+        return self.p is not None and self.p.poll() is None
+
+    # Leela only starts reading commands once it has finished loading, so the
+    # first acknowledged command tells us it is ready
+    def wait_ready(self, timeout):
+        self.send_command('protocol_version', timeout=timeout)
+
+    def launch_command(self):
         xargs = []
+        if self.visits is not None:
+            xargs += ['--visits', str(self.visits)]
+        if self.playouts is not None:
+            xargs += ['--playouts', str(self.playouts)]
+        if self.threads is not None:
+            xargs += ['--threads', str(self.threads)]
+        cmd = [self.executable, '--gtp', '--noponder'] + xargs
+        if self.cpus is not None:
+            cmd = layout.affinity_command(self.cpus) + cmd
+        return cmd
 
+    def start(self):
         if self.verbosity > 0:
             print >>sys.stderr, "Starting leela..."
 
-        p = Popen([self.executable, '--gtp', '--noponder'] + xargs, stdout=PIPE, stdin=PIPE, stderr=PIPE)
+        p = Popen(self.launch_command(), stdout=PIPE, stdin=PIPE, stderr=PIPE)
         self.p = p
-        self.stdout_thread = start_reader_thread(p.stdout)
-        self.stderr_thread = start_reader_thread(p.stderr)
+        self.reader = open_pipe_reader(p)
 
-        time.sleep(2)
+        self.wait_ready(self.startup_timeout)
+        self.send_settings()
+
+    def send_settings(self):
         if self.verbosity > 0:
             print >>sys.stderr, "Setting board size %d and komi %f to Leela" % (self.board_size, self.komi)
-        self.send_command('boardsize %d' % (self.board_size))
-        self.send_command('komi %f' % (self.komi))
-        self.send_command('time_settings 0 %d 1' % (self.seconds_per_search))
+        self.board_history = None
+        self.send_commands(['boardsize %d' % (self.board_size),
+                            'komi %f' % (self.komi),
+                            'time_settings 0 %d 1' % (self.seconds_per_search)])
+        self.board_history = []
+
+    # Switch a running leela over to another game's settings without restarting it
+    def configure(self, board_size, is_handicap_game, komi, seconds_per_search):
+        self.board_size = board_size
+        self.is_handicap_game = is_handicap_game
+        self.komi = komi
+        self.seconds_per_search = seconds_per_search + 1
+        if self.p is not None:
+            self.send_settings()
 
     def stop(self):
         if self.verbosity > 0:
@@ -203,22 +672,24 @@ class CLI(object):
 
         if self.p is not None:
             p = self.p
-            stdout_thread = self.stdout_thread
-            stderr_thread = self.stderr_thread
+            reader = self.reader
             self.p = None
-            self.stdout_thread = None
-            self.stderr_thread = None
-            stdout_thread.stop()
-            stderr_thread.stop()
+            self.reader = None
+            self.board_history = None
             try:
                 p.stdin.write('exit\n')
             except IOError:
                 pass
-            time.sleep(0.1)
+            # Give leela a moment to exit on its own, returning as soon as its pipes close
+            deadline = time.time() + 0.5
+            while reader.readline(deadline) is not None:
+                pass
             try:
                 p.terminate()
             except OSError:
                 pass
+            p.wait()
+            reader.close()
 
     def playmove(self, pos):
         color = self.whoseturn()
@@ -226,180 +697,203 @@ class CLI(object):
         self.history.append(cmd)
 
     def reset(self):
+        self.board_history = None
         self.send_command('clear_board')
+        self.board_history = []
 
     def boardstate(self):
         self.send_command("showboard",drain=False)
         (so,se) = self.drain()
         return "".join(se)
 
+    # Commands taking leela's board from board_history to history by undoing back to their longest
+    # common prefix and playing forward from there, or None if we don't know what position leela
+    # is in or replaying from scratch would be cheaper.
+    def sync_commands(self):
+        if self.board_history is None:
+            return None
+        common = 0
+        for (a,b) in zip(self.board_history, self.history):
+            if a != b:
+                break
+            common += 1
+        undo_count = len(self.board_history) - common
+        if undo_count >= 1 + common:
+            return None
+        return ["undo"] * undo_count + self.history[common:]
+
+    # Bring leela's board to self.history using as few commands as possible.
+    # If the incremental route fails, for example on a rejected undo, replay everything from scratch.
     def goto_position(self):
-        count = len(self.history)
-        cmd = "\n".join(self.history)
-        self.send_command(cmd,expected_success_count=count)
+        with timeline.span('goto_position', 'position'):
+            cmds = self.sync_commands()
+            if cmds is not None:
+                try:
+                    self.play_moves(cmds)
+                    return
+                except (EngineDied, EngineTimeout):
+                    raise
+                except EngineError:
+                    if self.verbosity > 1:
+                        print >>sys.stderr, "Incremental position sync failed, replaying from scratch"
+
+            self.reset()
+            self.play_moves(self.history)
+
+    # Send a batch of board changing commands, tracking what position leela is in
+    def play_moves(self, cmds):
+        if len(cmds) == 0:
+            return
+        history = self.board_history
+        self.board_history = None
+        self.send_commands(cmds)
+        for cmd in cmds:
+            if cmd == "undo":
+                history.pop()
+            else:
+                history.append(cmd)
+        self.board_history = history
 
+    # Analyze the position in self.history. The commands bringing leela's board there, setting
+    # the clock and starting the search all go out at once, without waiting on each other.
     def analyze(self):
-        p = self.p
-        if self.verbosity > 1:
-            print >>sys.stderr, "Analyzing state:"
-            print >>sys.stderr, self.whoseturn(), "to play"
-            print >>sys.stderr, self.boardstate()
-
-        self.send_command('time_left black %d 1\n' % (self.seconds_per_search))
-        self.send_command('time_left white %d 1\n' % (self.seconds_per_search))
-
-        cmd = "genmove %s\n" % (self.whoseturn())
-        p.stdin.write(cmd)
-
-        updated = 0
-        stderr = []
-        stdout = []
-
-        while updated < 20 + self.seconds_per_search * 2 and self.p is not None:
-            O,L = self.drain()
-            stdout.extend(O)
-            stderr.extend(L)
-
-            D = self.parse_status_update("".join(L))
-            if 'visits' in D:
+        with timeline.span('analyze', 'position'):
+            if self.verbosity > 1:
+                self.goto_position()
+                print >>sys.stderr, "Analyzing state:"
+                print >>sys.stderr, self.whoseturn(), "to play"
+                print >>sys.stderr, self.boardstate()
+
+            sync = self.sync_commands()
+            replay = sync is None
+            if replay:
+                sync = ['clear_board'] + self.history
+            color = self.whoseturn()
+            cmds = sync + ['time_left black %d 1' % (self.seconds_per_search),
+                           'time_left white %d 1' % (self.seconds_per_search),
+                           'genmove %s' % (color)]
+
+            stderr = []
+            stdout = []
+            parser = AnalysisParser(self.parse_position, color == "white")
+            replies = {}
+            watcher = self.early_stop.watch() if self.early_stop is not None and not self.early_stop.ignored else None
+            stopped_at = None
+            updates_after_stop = 0
+            def feed(source, line):
+                if self.verbosity > 2:
+                    (stdout if source == 'stdout' else stderr).append(line)
+                with timeline.span('parse', 'parse'):
+                    if source == 'stdout':
+                        if self.match_reply(line, ids, replies) == genmove_id:
+                            parser.feed_stdout(line)
+                        return None
+                    return parser.feed_stderr(line)
+
+            # Give up if leela goes this long without reporting progress
+            stall_timeout = 20 + self.seconds_per_search * 2
+            with timeline.span('genmove', 'gtp', {'commands': len(cmds)}):
+                # Leela plays the move it picks, so its board diverges from self.history here
+                self.board_history = None
+                ids = self.write_commands(cmds)
+                genmove_id = ids[-1]
+                search_started = time.time()
+
+                deadline = time.time() + stall_timeout
+                while not (genmove_id in replies and parser.has_summary) and self.p is not None:
+                    item = self.reader.readline(deadline)
+                    if item is None:
+                        break
+                    D = feed(*item)
+                    if D is not None:
+                        if self.verbosity > 0:
+                            print >>sys.stderr, "Visited %d positions" % (D['visits'])
+                        deadline = time.time() + stall_timeout
+                        if stopped_at is not None:
+                            updates_after_stop += 1
+                        elif watcher is not None and watcher.update(D):
+                            # Leela should stop searching and answer as soon as it sees more input, see EarlyStop
+                            if self.verbosity > 0:
+                                print >>sys.stderr, "Search settled, stopping early"
+                            self.write("\n")
+                            stopped_at = time.time()
+                # One update may already have been on its way, more mean the search went on
+                if stopped_at is not None and genmove_id in replies and (time.time() - stopped_at > self.early_stop.grace or updates_after_stop > 1):
+                    self.early_stop.stop_ignored()
+                    stopped_at = None
+
+                if not (genmove_id in replies and parser.has_summary):
+                    # Nudge leela and collect whatever else it has to say
+                    try:
+                        self.write("\n")
+                    except EngineDied:
+                        pass
+                    deadline = time.time() + 1
+                    while True:
+                        item = self.reader.readline(deadline)
+                        if item is None:
+                            break
+                        feed(*item)
+                for item in self.reader.read_all_lines():
+                    feed(*item)
+
+            if genmove_id not in replies:
+                if self.reader.eof:
+                    raise EngineDied("Leela exited while running 'genmove %s'" % (color))
+                raise EngineTimeout("Leela did not answer 'genmove %s' within %d seconds" % (color, stall_timeout))
+            try:
+                self.check_replies(sync, ids, replies)
+            except CommandError:
+                # Leela searched the wrong position, so put it in the right one the slow way and search again
+                if replay:
+                    raise
+                if self.verbosity > 1:
+                    print >>sys.stderr, "Incremental position sync failed, replaying from scratch"
+                return self.analyze()
+            self.check_replies(cmds, ids, replies)
+            if parser.played != "resign":
+                self.board_history = self.history + ["play %s %s" % (color, parser.played.lower())]
+
+            if self.verbosity > 2:
+                self.dump_output(stdout, stderr)
+            with timeline.span('parse', 'parse'):
+                stats, move_list = parser.result()
+            if self.early_stop is not None:
+                self.record_search_time(stats, search_started, stopped_at)
+            if self.reuse_tree and 'visits' in stats and 'playouts' in stats:
+                # Visits at the root beyond this search's own playouts came with the reused tree
+                stats['reused_visits'] = max(0, stats['visits'] - stats['playouts'])
                 if self.verbosity > 0:
-                    print >>sys.stderr, "Visited %d positions" % (D['visits'])
-                updated = 0
-            updated += 1
-            if re.search(finished_regex, ''.join(stdout)) is not None:
-                if re.search(stats_regex, ''.join(stderr)) is not None or re.search(bookmove_regex, ''.join(stderr)) is not None:
-                    break
-            time.sleep(1)
+                    print >>sys.stderr, "Reused %d of %d visits" % (stats['reused_visits'], stats['visits'])
+            if self.verbosity > 0:
+                print >>sys.stderr, "Chosen move: %s" % (stats['chosen'])
+                if 'best' in stats:
+                    print >>sys.stderr, "Best move: %s" % (stats['best'])
+                    print >>sys.stderr, "Winrate: %f" % (stats['winrate'])
+                    print >>sys.stderr, "Visits: %d" % (stats['visits'])
 
-        p.stdin.write("\n")
-        time.sleep(1)
-        O,L = self.drain()
-        stdout.extend(O)
-        stderr.extend(L)
-
-        stats, move_list = self.parse(stdout, stderr)
-        if self.verbosity > 0:
-            print >>sys.stderr, "Chosen move: %s" % (stats['chosen'])
-            if 'best' in stats:
-                print >>sys.stderr, "Best move: %s" % (stats['best'])
-                print >>sys.stderr, "Winrate: %f" % (stats['winrate'])
-                print >>sys.stderr, "Visits: %d" % (stats['visits'])
-
-        return stats, move_list
+            return stats, move_list
 
     def to_fraction(self, v):
-        v = v.strip()
-        return 0.01 * float(v)
+        return to_fraction(v)
+
+    def dump_output(self, stdout, stderr):
+        print >>sys.stderr, "LEELA STDOUT"
+        print >>sys.stderr, "".join(stdout)
+        print >>sys.stderr, "END OF LEELA STDOUT"
+        print >>sys.stderr, "LEELA STDERR"
+        print >>sys.stderr, "".join(stderr)
+        print >>sys.stderr, "END OF LEELA STDERR"
 
+    # Parse a complete transcript of leela's output for the current position
     def parse(self, stdout, stderr):
         if self.verbosity > 2:
-            print >>sys.stderr, "LEELA STDOUT"
-            print >>sys.stderr, "".join(stdout)
-            print >>sys.stderr, "END OF LEELA STDOUT"
-            print >>sys.stderr, "LEELA STDERR"
-            print >>sys.stderr, "".join(stderr)
-            print >>sys.stderr, "END OF LEELA STDERR"
-
-        stats = {}
-        move_list = []
-
-        flip_winrate = self.whoseturn() == "white"
-        def maybe_flip(winrate):
-            return ((1.0 - winrate) if flip_winrate else winrate)
-
-        finished=False
-        summarized=False
-        for line in stderr:
-            line = line.strip()
-            if line.startswith('================'):
-                finished=True
-
-            M = re.match(bookmove_regex, line)
-            if M is not None:
-                stats['bookmoves'] = int(M.group(1))
-                stats['positions'] = int(M.group(2))
-
-            M = re.match(status_regex, line)
-            if M is not None:
-                stats['mc_winrate'] = maybe_flip(float(M.group(1)))
-                stats['nn_winrate'] = maybe_flip(float(M.group(2)))
-                stats['margin'] = M.group(3)
-
-            M = re.match(status_regex_no_vn, line)
-            if M is not None:
-                stats['mc_winrate'] = maybe_flip(float(M.group(1)))
-                stats['margin'] = M.group(2)
-
-            M = re.match(move_regex, line)
-            if M is not None:
-                pos = self.parse_position(M.group(1))
-                visits = int(M.group(2))
-                W = maybe_flip(self.to_fraction(M.group(3)))
-                U = maybe_flip(self.to_fraction(M.group(4)))
-                Vp = maybe_flip(self.to_fraction(M.group(5)))
-                Vn = int(M.group(6))
-                N = self.to_fraction(M.group(7))
-                seq = M.group(8)
-                seq = [self.parse_position(p) for p in seq.split()]
-
-                info = {
-                    'pos': pos,
-                    'visits': visits,
-                    'winrate': W, 'mc_winrate': U, 'nn_winrate': Vp, 'nn_count': Vn,
-                    'policy_prob': N, 'pv': seq
-                }
-                move_list.append(info)
-
-            M = re.match(move_regex_no_vn, line)
-            if M is not None:
-                pos = self.parse_position(M.group(1))
-                visits = int(M.group(2))
-                U = maybe_flip(self.to_fraction(M.group(3)))
-                R = maybe_flip(self.to_fraction(M.group(4)))
-                Rn = int(M.group(5))
-                N = self.to_fraction(M.group(6))
-                seq = M.group(7)
-                seq = [self.parse_position(p) for p in seq.split()]
-
-                info = {
-                    'pos': pos,
-                    'visits': visits,
-                    'winrate': U, 'mc_winrate': U, 'r_winrate': R, 'r_count': Rn,
-                    'policy_prob': N, 'pv': seq
-                }
-                move_list.append(info)
-
-            if finished and not summarized:
-                M = re.match(best_regex, line)
-                if M is not None:
-                    stats['best'] = self.parse_position(M.group(3).split()[0])
-                    stats['winrate'] = maybe_flip(self.to_fraction(M.group(2)))
-
-                M = re.match(stats_regex, line)
-                if M is not None:
-                    stats['visits'] = int(M.group(1))
-                    summarized=True
-
-        M = re.search(finished_regex, "".join(stdout))
-        if M is not None:
-            if M.group(1) == "resign":
-                stats['chosen'] = "resign"
-            else:
-                stats['chosen'] = self.parse_position(M.group(1))
-
-        if 'bookmoves' in stats and len(move_list)==0:
-            move_list.append({'pos': stats['chosen'], 'is_book': True})
-        else:
-            required_keys = ['mc_winrate', 'margin', 'best', 'winrate', 'visits']
-            for k in required_keys:
-                if k not in stats:
-                    print >>sys.stderr, "WARNING: analysis stats missing data %s" % (k)
-
-            move_list = sorted(move_list, key = (lambda info: 1000000000000000 if info['pos'] == stats['best'] else info['visits']), reverse=True)
-            move_list = [info for (i,info) in enumerate(move_list) if i == 0 or info['visits'] > 0]
-
-            #In the case where leela resigns, rather than resigning, just replace with the move Leela did think was best
-            if stats['chosen'] == "resign":
-                stats['chosen'] = stats['best']
-
-        return stats, move_list
+            self.dump_output(stdout, stderr)
+
+        with timeline.span('parse', 'parse'):
+            parser = AnalysisParser(self.parse_position, self.whoseturn() == "white")
+            for line in stdout:
+                parser.feed_stdout(line)
+            for line in stderr:
+                parser.feed_stderr(line)
+            return parser.result()
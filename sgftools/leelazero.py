@@ -0,0 +1,193 @@
+import sys
+import time
+from sgftools import leela, timeline
+
+#Drives engines with Leela Zero's continuous analysis command, lz-analyze,
+#instead of genmove. The engine reports its current view of every candidate
+#move on stdout several times a second:
+#
+#  info move D4 visits 120 winrate 5123 prior 1234 lcb 4980 order 0 pv D4 Q16 ... info move Q16 ...
+#
+#with winrate, prior and lcb in hundredths of a percent, from the point of
+#view of the player to move. The search keeps going until the next command,
+#so we stop it ourselves once the time or visit budget is used up. The board
+#is left as it was, since no move gets played.
+
+#How often to ask for info lines, in centiseconds as lz-analyze takes it
+report_interval = 10
+
+#Parses the info lines of one lz-analyze search into the same stats and
+#move list that leela.AnalysisParser makes from genmove's output
+class ZeroAnalysisParser(object):
+    def __init__(self, parse_position, flip_winrate):
+        self.parse_position = parse_position
+        self.flip_winrate = flip_winrate
+        self.move_list = []
+        self.visits = 0
+
+    def maybe_flip(self, winrate):
+        return ((1.0 - winrate) if self.flip_winrate else winrate)
+
+    def parse_info(self, fields):
+        info = {}
+        i = 0
+        while i + 1 < len(fields):
+            key = fields[i]
+            if key == 'pv':
+                info['pv'] = [self.parse_position(p) for p in fields[i+1:]]
+                break
+            info[key] = fields[i+1]
+            i += 2
+        if 'move' not in info or 'visits' not in info or 'winrate' not in info:
+            return None
+        result = {
+            'pos': self.parse_position(info['move']),
+            'visits': int(info['visits']),
+            'winrate': self.maybe_flip(int(info['winrate']) / 10000.0),
+            'policy_prob': int(info.get('prior', 0)) / 10000.0,
+            'pv': info.get('pv', []),
+        }
+        if 'lcb' in info:
+            result['lcb'] = self.maybe_flip(int(info['lcb']) / 10000.0)
+        return result
+
+    # Each info line replaces the last one, returns a status update if the line held any moves
+    def feed_stdout(self, line):
+        if not line.startswith('info '):
+            return None
+        move_list = []
+        for chunk in line.split('info ')[1:]:
+            info = self.parse_info(chunk.split())
+            if info is not None:
+                move_list.append(info)
+        if len(move_list) == 0:
+            return None
+        self.move_list = move_list
+        self.visits = sum(info['visits'] for info in move_list)
+        best = max(move_list, key=lambda info: info['visits'])
+        return {'visits': self.visits, 'winrate': best['winrate'], 'seq': best['pv']}
+
+    def result(self):
+        stats = {}
+        move_list = sorted(self.move_list, key=lambda info: info['visits'], reverse=True)
+        move_list = [info for (i,info) in enumerate(move_list) if i == 0 or info['visits'] > 0]
+        if len(move_list) > 0:
+            stats['best'] = move_list[0]['pos']
+            stats['chosen'] = move_list[0]['pos']
+            stats['winrate'] = move_list[0]['winrate']
+            stats['visits'] = self.visits
+        return stats, move_list
+
+#Leela Zero backend with the same interface as leela.CLI
+class ZeroCLI(leela.CLI):
+    def budget_key(self):
+        return "lz" + leela.CLI.budget_key(self)
+
+    def search_budget(self):
+        budgets = [b for b in [self.visits, self.playouts] if b is not None]
+        if len(budgets) == 0:
+            return None
+        return min(budgets)
+
+    # Analyze the position in self.history. Like leela.CLI.analyze, the commands bringing the
+    # board there go out together with the search command.
+    def analyze(self):
+        with timeline.span('analyze', 'position'):
+            if self.verbosity > 1:
+                self.goto_position()
+                print >>sys.stderr, "Analyzing state:"
+                print >>sys.stderr, self.whoseturn(), "to play"
+                print >>sys.stderr, self.boardstate()
+
+            sync = self.sync_commands()
+            replay = sync is None
+            if replay:
+                sync = ['clear_board'] + self.history
+            color = self.whoseturn()
+            cmds = sync + ['lz-analyze %s %d' % (color, report_interval)]
+
+            parser = ZeroAnalysisParser(self.parse_position, color == "white")
+            replies = {}
+            watcher = self.early_stop.watch() if self.early_stop is not None else None
+            stopped_at = None
+            budget = self.search_budget()
+            # seconds_per_search carries a second of slack for leela's own time management
+            search_seconds = self.seconds_per_search - 1
+            stall_timeout = 20 + self.seconds_per_search * 2
+
+            with timeline.span('lz-analyze', 'gtp', {'commands': len(cmds)}):
+                self.board_history = None
+                ids = self.write_commands(cmds)
+                analyze_id = ids[-1]
+                stop_ids = []
+                search_end = None
+                stall_deadline = time.time() + stall_timeout
+
+                while self.p is not None:
+                    deadline = stall_deadline
+                    if search_end is not None and len(stop_ids) == 0:
+                        deadline = min(deadline, search_end)
+                    item = self.reader.readline(deadline)
+                    if item is None:
+                        if search_end is not None and len(stop_ids) == 0 and time.time() >= search_end:
+                            stop_ids = self.stop_search()
+                            continue
+                        break
+                    (source, line) = item
+                    if source != 'stdout':
+                        continue
+                    reply_id = self.match_reply(line, ids + stop_ids, replies)
+                    if reply_id == analyze_id:
+                        if not replies[analyze_id][0]:
+                            break
+                        search_started = time.time()
+                        search_end = search_started + search_seconds
+                    elif reply_id is not None and reply_id in stop_ids:
+                        break
+                    elif reply_id is None:
+                        with timeline.span('parse', 'parse'):
+                            D = parser.feed_stdout(line)
+                        if D is not None:
+                            if self.verbosity > 0:
+                                print >>sys.stderr, "Visited %d positions" % (D['visits'])
+                            stall_deadline = time.time() + stall_timeout
+                            if budget is not None and D['visits'] >= budget and len(stop_ids) == 0:
+                                stop_ids = self.stop_search()
+                            if watcher is not None and len(stop_ids) == 0 and watcher.update(D):
+                                if self.verbosity > 0:
+                                    print >>sys.stderr, "Search settled, stopping early"
+                                stop_ids = self.stop_search()
+                                stopped_at = time.time()
+                self.drain()
+
+            if analyze_id not in replies or (replies[analyze_id][0] and not any(i in replies for i in stop_ids)):
+                if self.p is None or self.reader.eof:
+                    raise leela.EngineDied("Leela exited while running 'lz-analyze %s'" % (color))
+                raise leela.EngineTimeout("Leela did not finish 'lz-analyze %s' within %d seconds" % (color, stall_timeout))
+            try:
+                self.check_replies(sync, ids, replies)
+            except leela.CommandError:
+                if replay:
+                    raise
+                if self.verbosity > 1:
+                    print >>sys.stderr, "Incremental position sync failed, replaying from scratch"
+                return self.analyze()
+            self.check_replies(cmds, ids, replies)
+            self.board_history = list(self.history)
+
+            with timeline.span('parse', 'parse'):
+                stats, move_list = parser.result()
+            if len(move_list) == 0:
+                raise leela.EngineError("Leela reported no moves for 'lz-analyze %s'" % (color))
+            if watcher is not None:
+                self.record_search_time(stats, search_started, stopped_at)
+            if self.verbosity > 0:
+                print >>sys.stderr, "Best move: %s" % (stats['best'])
+                print >>sys.stderr, "Winrate: %f" % (stats['winrate'])
+                print >>sys.stderr, "Visits: %d" % (stats['visits'])
+
+            return stats, move_list
+
+    # Any command ends the search, returns the ids to wait on
+    def stop_search(self):
+        return self.write_commands(['protocol_version'])
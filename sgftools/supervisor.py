@@ -0,0 +1,66 @@
+import sys
+from sgftools import leela, timeline
+
+#Failures that mean the engine process itself is gone or stuck
+RESTARTABLE_ERRORS = (leela.EngineDied, leela.EngineTimeout)
+
+#Wraps an engine with the leela.CLI interface and keeps it running. When leela
+#exits or stops answering, the engine is stopped and started again, which sends
+#the board size, komi and time settings anew, then the position is replayed
+#from the move history and the operation is retried.
+#
+#Everything other than start, stop, goto_position and analyze is passed
+#straight through to the wrapped engine, including setting its history.
+class EngineSupervisor(object):
+    def __init__(self, make_engine, max_restarts, verbosity):
+        object.__setattr__(self, 'engine', make_engine())
+        object.__setattr__(self, 'max_restarts', max_restarts)
+        object.__setattr__(self, 'verbosity', verbosity)
+        object.__setattr__(self, 'started', False)
+        object.__setattr__(self, 'restart_count', 0)
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.engine, name, value)
+
+    def start(self):
+        object.__setattr__(self, 'started', True)
+        self.engine.start()
+
+    def stop(self):
+        object.__setattr__(self, 'started', False)
+        self.engine.stop()
+
+    def restart(self):
+        object.__setattr__(self, 'restart_count', self.restart_count + 1)
+        with timeline.span('restart', 'position'):
+            self.engine.stop()
+            self.engine.start()
+
+    # Run fn, restarting the engine whenever it dies or hangs, up to max_restarts times
+    def supervise(self, fn):
+        attempt = 0
+        while True:
+            try:
+                if self.started and not self.engine.is_alive():
+                    raise leela.EngineDied("Leela is not running")
+                return fn()
+            except RESTARTABLE_ERRORS as e:
+                if attempt >= self.max_restarts:
+                    raise
+                attempt += 1
+                print >>sys.stderr, "%s, restarting leela..." % (e)
+                try:
+                    self.restart()
+                except leela.EngineError as e:
+                    # Try starting again on the next attempt, the engine is checked before each one
+                    print >>sys.stderr, "Failed to restart leela: %s" % (e)
+
+    def goto_position(self):
+        self.supervise(self.engine.goto_position)
+
+    # analyze brings the engine to the position first, so this also replays it on a restarted engine
+    def analyze(self):
+        return self.supervise(self.engine.analyze)
@@ -0,0 +1,123 @@
+import os
+import sys
+import json
+import time
+import threading
+
+#Records timing spans of the work done talking to leela, so that they can be
+#looked at as a timeline in chrome://tracing or https://ui.perfetto.dev, and
+#summarized per kind of span.
+#
+#Recording is off unless a Timeline has been enabled, in which case span()
+#returns a context manager that records how long its block took:
+#
+#  with timeline.span('genmove', 'gtp'):
+#      ...
+
+#python 2 has no monotonic clock in the standard library, time.time is the
+#best portable clock it offers.
+clock = time.time
+
+current = None
+
+class Span(object):
+    __slots__ = ['timeline', 'name', 'category', 'args', 'start']
+
+    def __init__(self, timeline, name, category, args):
+        self.timeline = timeline
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.timeline.add(self.name, self.category, self.start, clock(), self.args)
+        return False
+
+class NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+null_span = NullSpan()
+
+class Timeline(object):
+    def __init__(self):
+        self.start_time = clock()
+        self.events = []
+        self.lock = threading.Lock()
+
+    def add(self, name, category, start, end, args=None):
+        event = (name, category, start, end, threading.current_thread().ident, args)
+        with self.lock:
+            self.events.append(event)
+
+    def span(self, name, category, args=None):
+        return Span(self, name, category, args)
+
+    # Chrome's trace event format, which perfetto also reads
+    def write_chrome_trace(self, filename):
+        pid = os.getpid()
+        with self.lock:
+            events = list(self.events)
+        trace_events = []
+        for (name, category, start, end, tid, args) in events:
+            event = {
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': int((start - self.start_time) * 1000000),
+                'dur': int((end - start) * 1000000),
+                'pid': pid,
+                'tid': tid,
+            }
+            if args is not None:
+                event['args'] = args
+            trace_events.append(event)
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, f)
+
+    # Per span name: (category, count, total, p50, p90, p99, max), durations in seconds
+    def summary(self):
+        with self.lock:
+            events = list(self.events)
+        durations = {}
+        categories = {}
+        for (name, category, start, end, tid, args) in events:
+            durations.setdefault(name, []).append(end - start)
+            categories[name] = category
+        result = {}
+        for (name, ds) in durations.items():
+            ds.sort()
+            result[name] = (categories[name], len(ds), sum(ds), percentile(ds, 50), percentile(ds, 90), percentile(ds, 99), ds[-1])
+        return result
+
+    def print_summary(self, out=sys.stderr):
+        summary = self.summary()
+        print >>out, "%-16s %-10s %7s %9s %9s %9s %9s %9s" % ("span", "category", "count", "total s", "p50 ms", "p90 ms", "p99 ms", "max ms")
+        for name in sorted(summary.keys(), key=lambda name: (summary[name][0], -summary[name][2])):
+            (category, count, total, p50, p90, p99, longest) = summary[name]
+            print >>out, "%-16s %-10s %7d %9.2f %9.2f %9.2f %9.2f %9.2f" % (name, category, count, total, p50*1000, p90*1000, p99*1000, longest*1000)
+
+# Nearest rank percentile of a sorted list
+def percentile(values, p):
+    if len(values) == 0:
+        return 0.0
+    rank = int(round(p / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+def enable():
+    global current
+    current = Timeline()
+    return current
+
+def span(name, category, args=None):
+    if current is None:
+        return null_span
+    return current.span(name, category, args)
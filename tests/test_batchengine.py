@@ -0,0 +1,115 @@
+import os, sys
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from sgftools import batchengine, leela
+
+FAKE_ENGINE = '"%s" "%s" --analysis' % (sys.executable, os.path.join(ROOT, 'fakeleela.py'))
+
+GAME = ['play black q16', 'play white d4', 'play black q3', 'play white d16', 'play black r10']
+HANDICAP_GAME = ['play black d4', 'play black q16', 'play white q4', 'play black d16']
+
+class SetupStoneTest(unittest.TestCase):
+    def test_setup_stone_count(self):
+        self.assertEqual(batchengine.setup_stone_count([]), 0)
+        self.assertEqual(batchengine.setup_stone_count(GAME), 0)
+        self.assertEqual(batchengine.setup_stone_count(GAME[:1]), 0)
+        self.assertEqual(batchengine.setup_stone_count(HANDICAP_GAME), 2)
+        self.assertEqual(batchengine.setup_stone_count(HANDICAP_GAME[:2]), 2)
+
+#Runs BatchCLI against fakeleela.py's stand-in analysis engine
+class BatchCLITest(unittest.TestCase):
+    def setUp(self):
+        self.environ = dict(os.environ)
+        os.environ.update({'FAKELEELA_STARTUP': '0', 'FAKELEELA_LATENCY': '0.05'})
+        self.process = batchengine.AnalysisProcess(FAKE_ENGINE, 0)
+        self.engines = []
+
+    def tearDown(self):
+        for engine in self.engines:
+            engine.stop()
+        os.environ.clear()
+        os.environ.update(self.environ)
+
+    def make_engine(self, is_handicap_game=False):
+        engine = batchengine.BatchCLI(self.process, board_size=19, executable=None, is_handicap_game=is_handicap_game,
+                                      komi=7.5, seconds_per_search=1, verbosity=0, visits=100)
+        engine.start()
+        self.engines.append(engine)
+        return engine
+
+    # Each position analyzed on its own, to compare the batched results with
+    def separately(self, histories, is_handicap_game=False):
+        engine = self.make_engine(is_handicap_game)
+        results = []
+        for history in histories:
+            engine.history = list(history)
+            results.append(engine.analyze())
+        engine.stop()
+        return results
+
+    def test_make_query(self):
+        engine = self.make_engine(True)
+        query = engine.make_query(HANDICAP_GAME, [1, 2])
+        self.assertEqual(query['initialStones'], [['B', 'D4'], ['B', 'Q16']])
+        self.assertEqual(query['moves'], [['W', 'Q4'], ['B', 'D16']])
+        self.assertEqual(query['initialPlayer'], 'W')
+        self.assertEqual(query['analyzeTurns'], [1, 2])
+        self.assertEqual(engine.make_query(HANDICAP_GAME[:2], [0])['initialPlayer'], 'W')
+        self.assertEqual(engine.make_query([], [0])['initialPlayer'], 'W')
+        self.assertEqual(engine.make_query(GAME, [5])['initialStones'], [])
+
+    def test_submitted_positions(self):
+        histories = [GAME[:n] for n in range(1, len(GAME) + 1)]
+        #A position off the main line can't share its query
+        histories.append(GAME[:2] + ['play black c3'])
+        expected = self.separately(histories)
+
+        engine = self.make_engine()
+        first_id = self.process.next_id
+        engine.submit_positions(histories)
+        self.assertEqual(self.process.next_id - first_id, 2)
+        #The fake engine answers the turns of a query last to first, so replies are matched by turn
+        for (history, result) in zip(histories, expected):
+            engine.history = list(history)
+            self.assertEqual(engine.analyze(), result)
+        self.assertEqual(engine.submitted, {})
+        self.assertEqual(self.process.next_id - first_id, 2)
+
+    def test_handicap_positions(self):
+        histories = [HANDICAP_GAME[:n] for n in range(2, len(HANDICAP_GAME) + 1)]
+        expected = self.separately(histories, True)
+        engine = self.make_engine(True)
+        first_id = self.process.next_id
+        engine.submit_positions(histories)
+        self.assertEqual(self.process.next_id - first_id, 1)
+        for (history, result) in zip(histories, expected):
+            engine.history = list(history)
+            self.assertEqual(engine.analyze(), result)
+
+    def test_lost_positions_resubmitted(self):
+        histories = [GAME[:n] for n in range(1, len(GAME) + 1)]
+        expected = self.separately(histories)
+
+        #An engine that hangs on its first answer, with the first turn timed out after a second
+        os.environ['FAKELEELA_HANG_EVERY'] = '1'
+        engine = self.make_engine()
+        engine.reply_timeout = lambda: 1
+        engine.submit_positions(histories)
+        engine.history = list(histories[0])
+        self.assertRaises(leela.EngineTimeout, engine.analyze)
+        self.assertFalse(self.process.is_alive())
+
+        #Restarted as the engine supervisor would, the rest go out again in one query
+        del os.environ['FAKELEELA_HANG_EVERY']
+        engine.stop()
+        engine.start()
+        first_id = self.process.next_id
+        for (history, result) in zip(histories, expected):
+            engine.history = list(history)
+            self.assertEqual(engine.analyze(), result)
+        self.assertEqual(self.process.next_id - first_id, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import os, sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from sgftools import cache
+
+ANALYSIS = ({'best': 'dd', 'chosen': 'dd', 'winrate': 0.5, 'visits': 1600}, [])
+
+class StrongerBudgetTest(unittest.TestCase):
+    def test_parse_budget(self):
+        self.assertEqual(cache.parse_budget('10sec'), ('*sec', 10.0))
+        self.assertEqual(cache.parse_budget('1600visits'), ('*visits', 1600.0))
+        self.assertEqual(cache.parse_budget('2.5sec_reuse'), ('*sec_reuse', 2.5))
+        self.assertEqual(cache.parse_budget('800playouts_stop3x0.01'), ('*playouts_stop3x0.01', 800.0))
+        #Neither budget of a visits and playouts limit says which is stronger
+        self.assertEqual(cache.parse_budget('100visits200playouts'), ('100visits200playouts', 0.0))
+
+    def entries(self, budgets_visits):
+        return [('position_abc_' + budget,) + cache.parse_budget(budget) + (visits,) for (budget, visits) in budgets_visits]
+
+    def test_choose_stronger(self):
+        entries = self.entries([('5sec', 900), ('20sec', 3000), ('10sec', 4000), ('1600visits', 1600), ('10sec_reuse', 9000)])
+        self.assertEqual(cache.choose_stronger(entries, '10sec', False), 'position_abc_20sec')
+        self.assertEqual(cache.choose_stronger(entries, '30sec', False), None)
+        self.assertEqual(cache.choose_stronger(entries, '1000visits', False), 'position_abc_1600visits')
+        self.assertEqual(cache.choose_stronger(entries, '2000visits', False), None)
+        self.assertEqual(cache.choose_stronger(entries, '800playouts', False), None)
+        #Budgets of other kinds count too, by how many visits the search made
+        self.assertEqual(cache.choose_stronger(entries, '30sec', True), 'position_abc_10sec_reuse')
+        self.assertEqual(cache.choose_stronger([], '10sec', True), None)
+
+    def test_choose_unordered_budget(self):
+        entries = self.entries([('100visits200playouts', 300), ('100visits300playouts', 400)])
+        self.assertEqual(cache.choose_stronger(entries, '100visits200playouts', False), 'position_abc_100visits200playouts')
+        self.assertEqual(cache.choose_stronger(entries, '50visits200playouts', False), None)
+
+class MemoryCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def accessed(self, db_cache, key):
+        return db_cache.db.execute('SELECT accessed FROM entries WHERE key = ?', (key,)).fetchone()[0]
+
+    def test_hits_touch_sqlite(self):
+        db_cache = cache.SQLiteCache(self.dir, cache.SHARED, 0)
+        memory = cache.MemoryCache(db_cache, 10, 1 << 20)
+        memory.put('position_a_10sec', ANALYSIS)
+        memory.put('position_b_20sec', ANALYSIS)
+        with db_cache.db:
+            db_cache.db.execute('UPDATE entries SET accessed = 0')
+        self.assertEqual(memory.get('position_a_10sec'), ANALYSIS)
+        #Found under the stronger key, then held in memory under the one asked for
+        self.assertEqual(memory.get_stronger('position_b_10sec', False), ('position_b_20sec', ANALYSIS))
+        with db_cache.lock:
+            db_cache.flush_access()
+        with db_cache.db:
+            db_cache.db.execute('UPDATE entries SET accessed = 0')
+        self.assertEqual(memory.get_many(['position_a_10sec', 'position_b_10sec']),
+                         {'position_a_10sec': ANALYSIS, 'position_b_10sec': ANALYSIS})
+        self.assertEqual(memory.hits, 3)
+        memory.close()
+        db_cache = cache.SQLiteCache(self.dir, cache.SHARED, 0)
+        self.assertTrue(self.accessed(db_cache, 'position_a_10sec') > 0)
+        self.assertTrue(self.accessed(db_cache, 'position_b_20sec') > 0)
+        db_cache.close()
+
+    def test_hits_touch_pickle_dir(self):
+        dir_cache = cache.PickleDirCache(self.dir, cache.SHARED, 0)
+        memory = cache.MemoryCache(dir_cache, 10, 1 << 20)
+        memory.put('position_a_10sec', ANALYSIS)
+        fn = os.path.join(self.dir, cache.SHARED, 'position_a_10sec')
+        os.utime(fn, (0, 0))
+        self.assertEqual(memory.get('position_a_10sec'), ANALYSIS)
+        self.assertEqual(memory.hits, 1)
+        self.assertTrue(os.path.getmtime(fn) > 0)
+
+if __name__ == '__main__':
+    unittest.main()
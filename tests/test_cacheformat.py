@@ -0,0 +1,93 @@
+import os, sys
+import pickle
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from sgftools import cacheformat, cache
+
+# An analysis like leela.CLI's, with a resignation and a pass thrown in
+LEELA_ANALYSIS = (
+    {'chosen': 'im', 'best': 'im', 'winrate': 0.4417, 'mc_winrate': 0.4417, 'nn_winrate': 0.4417,
+     'margin': 'B+3.5', 'visits': 3399, 'playouts': 3399, 'search_seconds': 2.5, 'seconds_saved': 0.0},
+    [{'pos': 'im', 'visits': 2000, 'winrate': 0.4417, 'mc_winrate': 0.4517, 'nn_winrate': 0.4317,
+      'nn_count': 2000, 'policy_prob': 0.132, 'pv': ['im', 'lc', 'rn', 'er', 'qn']},
+     {'pos': '', 'visits': 12, 'winrate': 0.25, 'mc_winrate': 0.25, 'r_winrate': 0.5, 'r_count': 3,
+      'policy_prob': 0.0, 'pv': ['', 'tt']}],
+)
+
+ZERO_ANALYSIS = (
+    {'best': 'dd', 'chosen': 'dd', 'winrate': 0.5, 'visits': 1600},
+    [{'pos': 'dd', 'visits': 1600, 'winrate': 0.5, 'policy_prob': 0.25, 'lcb': 0.49, 'pv': []}],
+)
+
+BOOK_ANALYSIS = ({'bookmoves': 3, 'positions': 12, 'chosen': 'resign'}, [{'pos': 'resign', 'is_book': True}])
+
+class CacheFormatTest(unittest.TestCase):
+    def test_round_trip(self):
+        for value in (LEELA_ANALYSIS, ZERO_ANALYSIS, ({}, [])):
+            for compress in (False, True):
+                data = cacheformat.encode(value, compress)
+                self.assertTrue(data.startswith(cacheformat.MAGIC))
+                self.assertEqual(cacheformat.decode(data), value)
+
+    def test_types_survive(self):
+        (stats, move_list) = cacheformat.decode(cacheformat.encode(LEELA_ANALYSIS))
+        self.assertTrue(type(stats['visits']) is int)
+        self.assertTrue(type(stats['winrate']) is float)
+        self.assertTrue(type(stats['margin']) is str)
+
+    def test_compression_flag(self):
+        value = (LEELA_ANALYSIS[0], LEELA_ANALYSIS[1] * 20)
+        compressed = cacheformat.encode(value, True)
+        self.assertTrue(ord(compressed[5]) & cacheformat.COMPRESSED)
+        self.assertTrue(len(compressed) < len(cacheformat.encode(value)))
+
+    def test_unencodable_is_pickled(self):
+        for value in (BOOK_ANALYSIS, ({'unknown_field': 1}, []), ({'visits': 1.5}, [])):
+            data = cacheformat.encode(value)
+            self.assertFalse(data.startswith(cacheformat.MAGIC))
+            self.assertEqual(cacheformat.decode(data), value)
+
+    def test_legacy_pickles(self):
+        for protocol in (0, pickle.HIGHEST_PROTOCOL):
+            self.assertEqual(cacheformat.decode(pickle.dumps(LEELA_ANALYSIS, protocol)), LEELA_ANALYSIS)
+
+    def test_bad_data(self):
+        data = cacheformat.encode(LEELA_ANALYSIS)
+        newer = data[:4] + chr(cacheformat.VERSION + 1) + data[5:]
+        for bad in (data[:-3], data[:5], newer, 'garbage', pickle.dumps(LEELA_ANALYSIS)[:-5]):
+            self.assertRaises(ValueError, cacheformat.decode, bad)
+
+class UnreadableEntryTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_sqlite_miss(self):
+        db_cache = cache.SQLiteCache(self.dir, cache.SHARED, 0)
+        db_cache.put('position_a_10sec', LEELA_ANALYSIS)
+        db_cache.put('position_b_10sec', ZERO_ANALYSIS)
+        with db_cache.db:
+            db_cache.db.execute("UPDATE entries SET value = ? WHERE key = 'position_a_10sec'", (buffer('SGFA\x01\x00\x05'),))
+        self.assertEqual(db_cache.get('position_a_10sec'), None)
+        self.assertEqual(db_cache.get_many(['position_a_10sec', 'position_b_10sec']), {'position_b_10sec': ZERO_ANALYSIS})
+        db_cache.put('position_b_20sec', LEELA_ANALYSIS)
+        with db_cache.db:
+            db_cache.db.execute("UPDATE entries SET value = ? WHERE key = 'position_b_20sec'", (buffer('garbage'),))
+        self.assertEqual(db_cache.get_stronger('position_b_10sec', False), ('position_b_10sec', ZERO_ANALYSIS))
+        db_cache.close()
+
+    def test_pickle_dir_miss(self):
+        dir_cache = cache.PickleDirCache(self.dir, cache.SHARED, 0)
+        dir_cache.put('position_a_10sec', LEELA_ANALYSIS)
+        self.assertEqual(dir_cache.get('position_a_10sec'), LEELA_ANALYSIS)
+        with open(os.path.join(self.dir, cache.SHARED, 'position_a_10sec'), 'wb') as f:
+            f.write('garbage')
+        self.assertEqual(dir_cache.get('position_a_10sec'), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import os, sys
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from sgftools import cache, cacheformat, cachemaint
+
+STEPS = ['merge', 'prune', 'evict', 'compact']
+
+def analysis(visits):
+    return ({'best': 'dd', 'chosen': 'dd', 'winrate': 0.5, 'visits': visits}, [])
+
+class DryRunTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        #A database from before entries had metadata columns, and checkpoint files not imported into it yet
+        self.db_file = os.path.join(self.dir, cache.DB_FILENAME)
+        db = sqlite3.connect(self.db_file)
+        db.execute('CREATE TABLE entries (game TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, PRIMARY KEY (game, key))')
+        for (key, visits) in [('position_a_10sec', 100), ('position_a_20sec', 200), ('position_b_10sec', 300)]:
+            db.execute('INSERT INTO entries (game, key, value) VALUES (?, ?, ?)',
+                       (cache.SHARED, key, sqlite3.Binary(cacheformat.encode(analysis(visits)))))
+        db.execute('INSERT INTO entries (game, key, value) VALUES (?, ?, ?)', (cache.SHARED, 'position_c_10sec', 'garbage'))
+        db.commit()
+        db.close()
+        os.mkdir(os.path.join(self.dir, 'game1'))
+        with open(os.path.join(self.dir, 'game1', 'analyze_x_10sec'), 'wb') as f:
+            f.write(cacheformat.encode(analysis(400)))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def snapshot(self):
+        with open(self.db_file, 'rb') as f:
+            return (f.read(), sorted(os.listdir(self.dir)), os.listdir(os.path.join(self.dir, 'game1')))
+
+    def test_dry_run_changes_nothing(self):
+        before = self.snapshot()
+        report = cachemaint.maintain(self.dir, 'sqlite', 0, 'lru', STEPS, True, 0)
+        self.assertEqual(self.snapshot(), before)
+        self.assertEqual((report.merged, report.removed_files, report.removed_dirs), (1, 1, 1))
+        self.assertEqual(report.pruned, 1)
+        #Getting within nothing takes everything left, the merged entry and the unreadable one too
+        self.assertEqual(report.evicted, 4)
+        dry_run = report
+
+        report = cachemaint.maintain(self.dir, 'sqlite', 0, 'lru', STEPS, False, 0)
+        self.assertEqual((report.merged, report.pruned, report.evicted), (1, 1, 4))
+        self.assertEqual(report.bytes_before, dry_run.bytes_before)
+        self.assertFalse(os.path.exists(os.path.join(self.dir, 'game1')))
+
+    def test_read_only(self):
+        db = cache.open_read_only(self.dir)
+        self.assertRaises(sqlite3.OperationalError, db.execute, 'ALTER TABLE entries ADD COLUMN visits INTEGER')
+        self.assertRaises(sqlite3.OperationalError, db.execute, 'DELETE FROM entries')
+        db.close()
+
+if __name__ == '__main__':
+    unittest.main()
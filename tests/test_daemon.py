@@ -0,0 +1,75 @@
+import os, sys
+import json
+import time
+import shutil
+import socket
+import tempfile
+import unittest
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from sgftools import daemon, leela
+
+REQUEST = {'id': 1, 'board_size': 19, 'komi': 7.5, 'is_handicap_game': False, 'seconds_per_search': 1,
+           'visits': None, 'playouts': None, 'history': ['play black q16', 'play white d4']}
+
+class RequestErrorTest(unittest.TestCase):
+    def test_good_request(self):
+        self.assertEqual(daemon.request_error(REQUEST), None)
+
+    def test_bad_requests(self):
+        bad = [dict(REQUEST, board_size='19'), dict(REQUEST, board_size=40), dict(REQUEST, komi=None),
+               dict(REQUEST, seconds_per_search=0), dict(REQUEST, is_handicap_game=1), dict(REQUEST, visits=-5),
+               dict(REQUEST, history='play black q16'), dict(REQUEST, history=['genmove black']), dict(REQUEST, history=[3])]
+        missing = dict(REQUEST)
+        del missing['komi']
+        for request in bad + [missing, [REQUEST], None]:
+            self.assertNotEqual(daemon.request_error(request), None)
+
+#Runs leeladaemon.py with fakeleela.py behind it
+class DaemonTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.dir, 'daemon.sock')
+        env = dict(os.environ, FAKELEELA_LATENCY='0.01', FAKELEELA_STARTUP='0')
+        self.p = subprocess.Popen([sys.executable, os.path.join(ROOT, 'leeladaemon.py'), '--leela', os.path.join(ROOT, 'fakeleela.py'),
+                                   '--socket', self.socket_path], env=env, stderr=open(os.devnull, 'w'))
+        deadline = time.time() + 10
+        while not os.path.exists(self.socket_path) and time.time() < deadline:
+            time.sleep(0.05)
+
+    def tearDown(self):
+        self.p.terminate()
+        self.p.wait()
+        shutil.rmtree(self.dir)
+
+    def test_bad_requests_get_errors(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.socket_path)
+        rfile = sock.makefile('r')
+        missing = dict(REQUEST, id=2)
+        del missing['history']
+        for request in ['not json', json.dumps(missing), json.dumps(dict(REQUEST, id=3, board_size='big')), json.dumps(REQUEST)]:
+            sock.sendall(request + '\n')
+        responses = [json.loads(rfile.readline()) for i in range(4)]
+        sock.close()
+        self.assertEqual([r['id'] for r in responses], [None, 2, 3, 1])
+        self.assertTrue(all('error' in r for r in responses[:3]))
+        self.assertTrue('stats' in responses[3] and len(responses[3]['move_list']) > 0)
+
+    def test_remote_error_is_command_error(self):
+        engine = daemon.RemoteCLI(self.socket_path, board_size=40, executable=None, is_handicap_game=False, komi=7.5,
+                                  seconds_per_search=1, verbosity=0)
+        engine.start()
+        try:
+            engine.history = ['play black q16']
+            self.assertRaises(leela.CommandError, engine.analyze)
+            engine.board_size = 19
+            (stats, move_list) = engine.analyze()
+            self.assertTrue('chosen' in stats)
+        finally:
+            engine.stop()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import os, sys
+import unittest
+from threading import Event
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from sgftools import enginepool
+
+class StubEngine(object):
+    def __init__(self, fail_start=False):
+        self.fail_start = fail_start
+        self.history = []
+        self.stopped = False
+
+    def start(self):
+        if self.fail_start:
+            raise RuntimeError("engine didn't start")
+
+    def stop(self):
+        self.stopped = True
+
+class EnginePoolTest(unittest.TestCase):
+    def test_priority_order(self):
+        engines = []
+        def make_engine():
+            engines.append(StubEngine())
+            return engines[-1]
+        pool = enginepool.EnginePool(make_engine, 1, 0)
+        pool.start()
+        #Holds up the only engine while the rest are queued
+        release = Event()
+        pool.submit('first', [], lambda engine: release.wait(10))
+        order = []
+        run = lambda engine: order.append(tuple(engine.history))
+        pool.submit('variation', ['play black c3'], run, priority=1)
+        pool.submit('main 1', ['play black q16'], run)
+        pool.submit('late variation', ['play black d4'], run, priority=1)
+        pool.submit('main 2', ['play black q3'], run)
+        release.set()
+        for key in ['first', 'variation', 'main 1', 'late variation', 'main 2']:
+            pool.result(key)
+        pool.stop()
+        #Lower priorities first, and in the order they were submitted within a priority
+        self.assertEqual(order, [('play black q16',), ('play black q3',), ('play black c3',), ('play black d4',)])
+        self.assertTrue(engines[0].stopped)
+
+    def test_errors_reach_result(self):
+        pool = enginepool.EnginePool(StubEngine, 2, 0)
+        pool.start()
+        def fail(engine):
+            raise ValueError("bad position")
+        pool.submit('bad', [], fail)
+        pool.submit('good', ['play black q16'], lambda engine: list(engine.history))
+        self.assertRaises(ValueError, pool.result, 'bad')
+        self.assertEqual(pool.result('good'), ['play black q16'])
+        pool.stop()
+
+    def test_start_error_reaches_result(self):
+        pool = enginepool.EnginePool(lambda: StubEngine(fail_start=True), 1, 0)
+        pool.start()
+        pool.submit('a', [], lambda engine: 1)
+        self.assertRaises(RuntimeError, pool.result, 'a')
+        pool.stop()
+
+if __name__ == '__main__':
+    unittest.main()
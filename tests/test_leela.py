@@ -0,0 +1,139 @@
+import os, sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from sgftools import leela
+
+FAKELEELA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'fakeleela.py')
+
+GAME = ['play black q16', 'play white d4', 'play black q3', 'play white d16', 'play black r10']
+
+#What leela 0.11 writes for one genmove, with a line of the board dump it prints first
+GENMOVE_STDERR = """
+ 19 . . . . . . . . . . . . . . . . . . . 19
+Nodes: 1200, Win: 54.10% (MC:52.00%/VN:55.00%), PV: D4 Q16 C3
+MC winrate=0.5210, NN eval=0.5530, score=B+3.5
+ D4 ->    1500 (W: 54.10%) (U: 52.10%) (V: 55.30%:   1500) (N: 41.2%) PV: D4 Q16 C3
+ C3 ->     400 (W: 51.00%) (U: 50.00%) (V: 52.00%:    400) (N: 12.0%) PV: C3 D4
+ E5 ->       0 (W:  0.00%) (U:  0.00%) (V:  0.00%:      0) (N:  3.0%) PV: E5
+====================================
+1500 visits, score 54.10% (from 52.10%) PV: D4 Q16 C3
+
+1900 visits, 1900 nodes, 1700 playouts, 950 p/s
+""".split('\n')
+
+def parse_position(pos):
+    return pos.lower()
+
+def make_cli():
+    return leela.CLI(board_size=19, executable=None, is_handicap_game=False, komi=7.5,
+                     seconds_per_search=1, verbosity=0)
+
+class SyncCommandsTest(unittest.TestCase):
+    def sync(self, board_history, history):
+        engine = make_cli()
+        engine.board_history = board_history
+        engine.history = history
+        return engine.sync_commands()
+
+    def test_unknown_board(self):
+        self.assertEqual(self.sync(None, GAME), None)
+
+    def test_play_forward(self):
+        self.assertEqual(self.sync([], GAME[:2]), GAME[:2])
+        self.assertEqual(self.sync(GAME[:3], GAME), GAME[3:])
+        self.assertEqual(self.sync(GAME, GAME), [])
+
+    def test_undo_to_common_prefix(self):
+        self.assertEqual(self.sync(GAME, GAME[:4]), ['undo'])
+        #A variation off the third move
+        variation = GAME[:2] + ['play black c3', 'play white r4']
+        self.assertEqual(self.sync(GAME[:4], variation), ['undo', 'undo', 'play black c3', 'play white r4'])
+        self.assertEqual(self.sync(variation, GAME), ['undo', 'undo'] + GAME[2:])
+
+    def test_replay_when_cheaper(self):
+        #clear_board and playing the moves kept is no more commands than undoing the rest
+        self.assertEqual(self.sync(GAME[:2], GAME[:1]), ['undo'])
+        self.assertEqual(self.sync(GAME[:4], GAME[:2]), ['undo', 'undo'])
+        self.assertEqual(self.sync(GAME, GAME[:2]), None)
+        self.assertEqual(self.sync(GAME[:2], []), None)
+        self.assertEqual(self.sync(GAME, ['play black d4']), None)
+
+class AnalysisParserTest(unittest.TestCase):
+    def parse(self, flip_winrate, stderr=GENMOVE_STDERR):
+        parser = leela.AnalysisParser(parse_position, flip_winrate)
+        updates = [parser.feed_stderr(line) for line in stderr]
+        parser.feed_stdout("=3 D4\n")
+        return (parser, [D for D in updates if D is not None])
+
+    def test_genmove(self):
+        (parser, updates) = self.parse(False)
+        self.assertEqual(updates, [{'visits': 1200, 'winrate': 0.541, 'seq': ['d4', 'q16', 'c3']}])
+        (stats, move_list) = parser.result()
+        self.assertEqual(stats, {'mc_winrate': 0.521, 'nn_winrate': 0.553, 'margin': 'B+3.5', 'best': 'd4', 'winrate': 0.541,
+                                 'visits': 1900, 'playouts': 1700, 'chosen': 'd4'})
+        #Moves nobody searched are dropped
+        self.assertEqual([info['pos'] for info in move_list], ['d4', 'c3'])
+        self.assertEqual(move_list[1], {'pos': 'c3', 'visits': 400, 'winrate': 0.51, 'mc_winrate': 0.5, 'nn_winrate': 0.52,
+                                        'nn_count': 400, 'policy_prob': 0.12, 'pv': ['c3', 'd4']})
+
+    def test_white_winrates_flip(self):
+        (parser, updates) = self.parse(True)
+        (stats, move_list) = parser.result()
+        self.assertAlmostEqual(stats['winrate'], 0.459)
+        self.assertAlmostEqual(stats['mc_winrate'], 0.479)
+        self.assertAlmostEqual(move_list[0]['winrate'], 0.459)
+
+    def test_summary_lines_before_search_ends(self):
+        #Lines shaped like the summary only count once the search has finished
+        early = ['1500 visits, score 10.00% (from 9.00%) PV: Q16', '100 visits, 100 nodes, 100 playouts, 50 p/s']
+        (parser, updates) = self.parse(False, early + GENMOVE_STDERR)
+        (stats, move_list) = parser.result()
+        self.assertEqual((stats['best'], stats['winrate'], stats['visits']), ('d4', 0.541, 1900))
+
+    def test_book_move(self):
+        parser = leela.AnalysisParser(parse_position, False)
+        parser.feed_stderr('3 book moves, 120 total positions')
+        parser.feed_stdout('= Q16\n')
+        self.assertEqual(parser.result()[1], [{'pos': 'q16', 'is_book': True}])
+        self.assertTrue(parser.has_summary)
+
+#Runs CLI against fakeleela.py, which searches 4 seconds with status updates every 0.2
+class EarlyStopTest(unittest.TestCase):
+    def setUp(self):
+        self.environ = dict(os.environ)
+        os.environ.update({'FAKELEELA_STARTUP': '0', 'FAKELEELA_LATENCY': '4', 'FAKELEELA_UPDATES': '20'})
+        self.early_stop = leela.EarlyStop(2, 0.01)
+        self.engine = leela.CLI(board_size=19, executable=FAKELEELA, is_handicap_game=False, komi=7.5,
+                                seconds_per_search=5, verbosity=0, early_stop=self.early_stop)
+
+    def tearDown(self):
+        self.engine.stop()
+        os.environ.clear()
+        os.environ.update(self.environ)
+
+    def analyze(self):
+        self.engine.start()
+        self.engine.history = ['play black q16']
+        started = time.time()
+        (stats, move_list) = self.engine.analyze()
+        return (stats, time.time() - started)
+
+    def test_stop(self):
+        (stats, seconds) = self.analyze()
+        self.assertTrue(seconds < 2)
+        self.assertTrue(stats['seconds_saved'] > 3)
+        self.assertFalse(self.early_stop.ignored)
+
+    def test_stop_ignored(self):
+        os.environ['FAKELEELA_STOP_ON_INPUT'] = '0'
+        (stats, seconds) = self.analyze()
+        self.assertTrue(seconds > 3.5)
+        self.assertEqual(stats['seconds_saved'], 0.0)
+        self.assertTrue(self.early_stop.ignored)
+        #The rest of the run searches without trying to stop
+        self.assertEqual(self.engine.analyze()[0]['seconds_saved'], 0.0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import os, sys
+import time
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from sgftools import leelazero
+
+FAKELEELA = os.path.join(ROOT, 'fakeleela.py')
+
+def parse_position(pos):
+    return pos.lower()
+
+class ZeroAnalysisParserTest(unittest.TestCase):
+    def test_info_line(self):
+        parser = leelazero.ZeroAnalysisParser(parse_position, False)
+        self.assertEqual(parser.feed_stdout("=2\n"), None)
+        D = parser.feed_stdout("info move D4 visits 120 winrate 5123 prior 1234 lcb 4980 order 0 pv D4 Q16 "
+                               "info move Q16 visits 300 winrate 4800 prior 2000 order 1 pv Q16 D4 C3\n")
+        self.assertEqual(D, {'visits': 420, 'winrate': 0.48, 'seq': ['q16', 'd4', 'c3']})
+        (stats, move_list) = parser.result()
+        self.assertEqual(stats, {'best': 'q16', 'chosen': 'q16', 'winrate': 0.48, 'visits': 420})
+        self.assertEqual([info['pos'] for info in move_list], ['q16', 'd4'])
+        self.assertEqual(move_list[1], {'pos': 'd4', 'visits': 120, 'winrate': 0.5123, 'policy_prob': 0.1234,
+                                        'lcb': 0.498, 'pv': ['d4', 'q16']})
+
+    def test_white_winrates_flip(self):
+        parser = leelazero.ZeroAnalysisParser(parse_position, True)
+        parser.feed_stdout("info move D4 visits 10 winrate 7000 prior 100 pv D4\n")
+        self.assertAlmostEqual(parser.result()[0]['winrate'], 0.3)
+
+#Drives ZeroCLI against fakeleela.py's lz-analyze
+class ZeroCLITest(unittest.TestCase):
+    def setUp(self):
+        self.environ = dict(os.environ)
+        os.environ['FAKELEELA_STARTUP'] = '0'
+        self.engine = None
+
+    def tearDown(self):
+        if self.engine is not None:
+            self.engine.stop()
+        os.environ.clear()
+        os.environ.update(self.environ)
+
+    def start(self, seconds_per_search, visits=None):
+        self.engine = leelazero.ZeroCLI(board_size=19, executable=FAKELEELA, is_handicap_game=False, komi=7.5,
+                                        seconds_per_search=seconds_per_search, verbosity=0, visits=visits)
+        self.engine.start()
+        self.engine.add_move('black', 'pd')
+        self.engine.add_move('white', 'dp')
+
+    def check_analysis(self, stats, move_list):
+        self.assertEqual(set(stats.keys()), set(['best', 'chosen', 'winrate', 'visits']))
+        self.assertEqual(stats['best'], move_list[0]['pos'])
+        self.assertEqual(stats['visits'], sum(info['visits'] for info in move_list))
+        self.assertTrue(0.0 <= stats['winrate'] <= 1.0)
+        for info in move_list:
+            self.assertTrue(set(['pos', 'visits', 'winrate', 'policy_prob', 'pv']) <= set(info.keys()))
+            self.assertTrue(len(info['pos']) == 2 and all(len(p) in (0, 2) for p in info['pv']))
+        visits = [info['visits'] for info in move_list]
+        self.assertEqual(visits, sorted(visits, reverse=True))
+
+    def test_time_budget(self):
+        os.environ['FAKELEELA_LATENCY'] = '0.2'
+        self.start(1)
+        started = time.time()
+        (stats, move_list) = self.engine.analyze()
+        self.assertTrue(time.time() - started < 5)
+        self.check_analysis(stats, move_list)
+        self.assertTrue(stats['visits'] > 0)
+
+    def test_visit_budget_stops_search(self):
+        #The search would run a minute on time alone, reaching the visits has to stop it
+        os.environ['FAKELEELA_LATENCY'] = '0.5'
+        self.start(60, visits=50)
+        started = time.time()
+        (stats, move_list) = self.engine.analyze()
+        self.assertTrue(time.time() - started < 10)
+        self.check_analysis(stats, move_list)
+        #The engine is ready for the next position, and gives the same analysis of the same one again
+        self.assertEqual(self.engine.analyze(), (stats, move_list))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import os, sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from sgftools import cache, gotools, leela
+
+ANALYSIS = ({'best': 'pd', 'chosen': 'dp', 'winrate': 0.55, 'visits': 1600},
+            [{'pos': 'pd', 'visits': 1000, 'winrate': 0.55, 'pv': ['pd', 'dp', '']},
+             {'pos': 'dp', 'visits': 600, 'winrate': 0.52, 'pv': ['dp', 'tt', 'qe']}])
+
+def make_cli(board_size=19):
+    return leela.CLI(board_size=board_size, executable=None, is_handicap_game=False, komi=7.5,
+                     seconds_per_search=1, verbosity=0)
+
+class SymmetryTest(unittest.TestCase):
+    def test_map_analysis_round_trip(self):
+        for symmetry in gotools.symmetries(19):
+            mapped = cache.map_analysis(ANALYSIS, symmetry.apply)
+            self.assertEqual(cache.map_analysis(mapped, symmetry.undo), ANALYSIS)
+            self.assertEqual(mapped[0]['best'], mapped[1][0]['pos'])
+            self.assertEqual(mapped[1][1]['pv'][1], 'tt')
+            self.assertEqual(mapped[1][0]['pv'][2], '')
+            if not symmetry.is_identity():
+                self.assertNotEqual(mapped, ANALYSIS)
+
+    def test_map_analysis_moves_points(self):
+        #Mirrored left to right, then top to bottom
+        mapped = cache.map_analysis(ANALYSIS, gotools.Symmetry(3, 19).apply)
+        self.assertEqual(mapped[0], {'best': 'dp', 'chosen': 'pd', 'winrate': 0.55, 'visits': 1600})
+        self.assertEqual(mapped[1][1]['pv'], ['pd', 'tt', 'co'])
+
+    def test_tt_is_a_point_on_large_boards(self):
+        self.assertTrue(gotools.is_tenuki('tt'))
+        self.assertFalse(gotools.is_tenuki('tt', 21))
+        self.assertEqual(gotools.Symmetry(1, 19).apply('tt'), 'tt')
+        self.assertEqual(gotools.Symmetry(1, 21).apply('tt'), 'bt')
+        engine = make_cli(21)
+        engine.add_move('black', 'tt')
+        self.assertEqual(engine.history, ['play black u2'])
+        engine = make_cli(19)
+        engine.add_move('black', 'tt')
+        self.assertEqual(engine.history, ['play black pass'])
+
+    def test_canonical_position_of_rotations(self):
+        engine = make_cli()
+        engine.add_move('black', 'pd')
+        engine.add_move('white', 'dp')
+        rotated = make_cli()
+        rotated.add_move('black', 'dp')
+        rotated.add_move('white', 'pd')
+        self.assertEqual(engine.canonical_position()[0], rotated.canonical_position()[0])
+
+    def test_passes_change_the_position(self):
+        engine = make_cli()
+        engine.add_move('black', 'pd')
+        engine.add_move('white', 'dp')
+        before = engine.canonical_position()[0]
+        engine.add_move('black', '')
+        engine.add_move('white', '')
+        self.assertEqual(engine.trailing_passes(), 2)
+        self.assertNotEqual(engine.canonical_position()[0], before)
+        engine.add_move('black', 'dd')
+        self.assertEqual(engine.trailing_passes(), 0)
+
+if __name__ == '__main__':
+    unittest.main()